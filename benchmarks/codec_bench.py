@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Benchmark for output image codecs.
+
+Compresses a built image with each codec supported by [build] compression
+and reports the compression ratio, compress throughput and decompress
+throughput, to choose the tradeoff for a fleet rollout. Throughput is
+measured against the raw image size, holes included, as flashing sees it.
+
+Usage:
+    python benchmarks/codec_bench.py --image build/<subdir>/<image>.img
+    python benchmarks/codec_bench.py --codec zstd --level 3 --level 19
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+
+def make_fixture(path: Path, size_mb: int) -> None:
+    """Write an image of compressible text, random data and holes."""
+    text = b"".join(f"line {i} of a fairly repetitive config file\n".encode() for i in range(30000))
+    with open(path, "wb") as f:
+        f.truncate(size_mb * 1024 * 1024)
+        for mb in range(0, size_mb, 4):
+            f.seek(mb * 1024 * 1024)
+            f.write(os.urandom(1024 * 1024) if mb % 16 == 0 else text[:1024 * 1024])
+
+
+def decompress_seconds(codec: str, compressed: Path) -> float:
+    began = time.perf_counter()
+    with open(compressed, "rb") as src:
+        subprocess.run(build.decompressor_command(codec), stdin=src, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - began
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark output image codecs.")
+    parser.add_argument("--image", type=Path, help="Raw image to compress (default: a generated fixture)")
+    parser.add_argument("--size-mb", type=int, default=512, help="Size of the generated fixture in MiB")
+    parser.add_argument("--codec", action="append", choices=[c for c in build.COMPRESSION_CODECS if c != "none"],
+                        help="Codec to benchmark (repeatable; default: all)")
+    parser.add_argument("--level", type=int, action="append", help="Compression level (repeatable; default: codec default)")
+    args = parser.parse_args()
+
+    codecs = args.codec or [c for c in build.COMPRESSION_CODECS if c != "none"]
+    levels = args.level or [None]
+
+    with tempfile.TemporaryDirectory(dir=Path.cwd()) as tmp:
+        image = args.image
+        if image is None:
+            image = Path(tmp) / "fixture.img"
+            make_fixture(image, args.size_mb)
+        size = image.stat().st_size
+        print(f"Image: {image} ({size // 1024 // 1024}MB)")
+        print(f"{'codec':<14} {'level':>5} {'ratio':>7} {'compress':>12} {'decompress':>12} {'size':>9}")
+        for codec in codecs:
+            for level in levels:
+                if level is not None:
+                    lowest, highest = build.COMPRESSION_LEVELS[codec]
+                    if not lowest <= level <= highest:
+                        continue
+                compressed = Path(tmp) / f"out{build.COMPRESSION_CODECS[codec]}"
+                result = build.stream_image(image, compressed, sparsify=False, codec=codec, level=level)
+                compressed_size = compressed.stat().st_size
+                unpack = decompress_seconds(codec, compressed)
+                mb = size / 1024 / 1024
+                print(f"{codec:<14} {level if level is not None else '-':>5} {size / compressed_size:7.1f} "
+                      f"{mb / result.seconds:8.1f} MB/s {mb / unpack:8.1f} MB/s "
+                      f"{build.format_bytes(compressed_size):>9}")
+                compressed.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for source image hashing.
+
+Compares the original 4 KiB read loop used by verify_checksum with the
+large-buffer path in build.file_sha256, and the sidecar record lookup that
+skips hashing entirely for unchanged files.
+
+Usage:
+    python benchmarks/hash_bench.py
+    python benchmarks/hash_bench.py --size-mb 2048 --file .cache/ubuntu.img.xz
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+
+def legacy_sha256(file_path: Path) -> str:
+    """The 4 KiB loop verify_checksum used before the sidecar record."""
+    sha256_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for byte_block in iter(lambda: f.read(4096), b""):
+            sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
+
+def time_call(label: str, func, file_path: Path, size: int, repeat: int) -> str:
+    best = float("inf")
+    result = ""
+    for _ in range(repeat):
+        began = time.perf_counter()
+        result = func(file_path)
+        best = min(best, time.perf_counter() - began)
+    rate = size / best / 1024 / 1024 if best > 0 else float("inf")
+    print(f"{label:<24} {best * 1000:10.1f} ms {rate:10.1f} MB/s")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark source image hashing paths.")
+    parser.add_argument("--file", type=Path, help="Existing file to hash (default: a temporary random file)")
+    parser.add_argument("--size-mb", type=int, default=512, help="Size of the temporary file in MiB")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per method (best time is reported)")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.file:
+        file_path = args.file
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        file_path = Path(tmp_dir.name) / "bench.bin"
+        with open(file_path, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+    try:
+        size = file_path.stat().st_size
+        print(f"Hashing {file_path} ({size // 1024 // 1024}MB, warm page cache)")
+        legacy = time_call("4 KiB loop", legacy_sha256, file_path, size, args.repeat)
+        current = time_call("file_sha256", build.file_sha256, file_path, size, args.repeat)
+        if legacy != current:
+            raise SystemExit("Digest mismatch between hashing paths")
+
+        build.record_verified_digest(file_path, current)
+        time_call("verification record", build.read_verified_digest, file_path, size, args.repeat)
+        build._verification_record_path(file_path).unlink()
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
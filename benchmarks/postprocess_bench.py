@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark for image post-processing.
+
+Compares the single-pass build.stream_image pipeline with the shell-local
+post-processor it replaced (fallocate -d, bmaptool create, xz -T0, cp of the
+bmap) on the same image. The shell steps each read the image separately, so
+their bytes read are estimated from the data they walk.
+
+Usage:
+    python benchmarks/postprocess_bench.py
+    python benchmarks/postprocess_bench.py --image build/<subdir>/<image>.img
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+LEGACY_SCRIPT = """
+IMG="$1"
+fallocate -d "$IMG" 2>/dev/null || { cp --sparse=always "$IMG" "$IMG.tmp" && mv "$IMG.tmp" "$IMG"; }
+if command -v bmaptool >/dev/null 2>&1; then
+    bmaptool create "$IMG" > "$IMG.bmap"
+fi
+xz -f -T0 "$IMG"
+if [ -f "$IMG.bmap" ]; then
+    cp "$IMG.bmap" "$IMG.xz.bmap"
+fi
+"""
+
+
+def make_fixture(path: Path, size_mb: int) -> None:
+    """Write an image with holes, random data and allocated runs of zeros."""
+    with open(path, "wb") as f:
+        f.truncate(size_mb * 1024 * 1024)
+        for mb in range(size_mb):
+            if mb % 8 in (0, 1):
+                f.seek(mb * 1024 * 1024)
+                f.write(os.urandom(1024 * 1024))
+            elif mb % 8 in (2, 3):
+                f.seek(mb * 1024 * 1024)
+                f.write(bytes(1024 * 1024))
+
+
+def allocated(path: Path) -> int:
+    return os.stat(path).st_blocks * 512
+
+
+def run_legacy(image: Path, mapped_bytes: int) -> tuple[float, int]:
+    """Run the shell post-processor; returns seconds and estimated bytes read."""
+    size = image.stat().st_size
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        data = sum(end - start for start, end in build.data_extents(fd, size))
+    finally:
+        os.close(fd)
+    began = time.perf_counter()
+    subprocess.run(["bash", "-c", LEGACY_SCRIPT, "legacy", str(image)], check=True)
+    seconds = time.perf_counter() - began
+    # fallocate -d reads the data extents, bmaptool the mapped blocks and xz the whole image
+    bmap_read = mapped_bytes if shutil.which("bmaptool") else 0
+    return seconds, data + bmap_read + size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark image post-processing.")
+    parser.add_argument("--image", type=Path, help="Raw image to benchmark (copied; default: a generated fixture)")
+    parser.add_argument("--size-mb", type=int, default=1024, help="Size of the generated fixture in MiB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=Path.cwd()) as tmp:
+        source = Path(tmp) / "source.img"
+        if args.image:
+            build.clone_file(args.image, source)
+        else:
+            make_fixture(source, args.size_mb)
+        size = source.stat().st_size
+        print(f"Image: {size // 1024 // 1024}MB, {allocated(source) // 1024 // 1024}MB allocated")
+
+        single_image = Path(tmp) / "single.img"
+        build.clone_file(source, single_image)
+        result = build.stream_image(single_image, single_image.with_name("single.img.xz"))
+        build.write_bmap(single_image.with_name("single.img.xz.bmap"), result.image_size, result.ranges)
+
+        legacy_image = Path(tmp) / "legacy.img"
+        build.clone_file(source, legacy_image)
+        legacy_seconds, legacy_read = run_legacy(legacy_image, result.mapped_bytes)
+
+        print(f"{'method':<14} {'seconds':>9} {'read':>10}")
+        print(f"{'shell':<14} {legacy_seconds:9.1f} {build.format_bytes(legacy_read):>10} (estimated)")
+        print(f"{'single pass':<14} {result.seconds:9.1f} {build.format_bytes(result.bytes_read):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,21 +9,46 @@ Usage:
     python build.py --config configs/my_config.toml
     python build.py --config configs/my_config.toml --dry-run
     python build.py --config configs/my_config.toml -y
+    python build.py --matrix configs/matrix_example.toml -y
+    python build.py personalize --config configs/my_config.toml --robots configs/robots_example.toml
+    python build.py bmap build/<subdir>/<image>.img
+    python build.py flash --config configs/my_config.toml /dev/sdb /dev/sdc
+    python build.py serve --socket /tmp/tb3-build.sock
 
 The [network] section is optional. If included with an SSID, network connection
 will be added automatically during the build.
 """
 
 import argparse
+import copy
+import ctypes
+import fcntl
+import gzip
 import hashlib
+import http.server
+import itertools
+import lzma
 import os
+import queue
+import re
 import shutil
+import socketserver
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
-from dataclasses import dataclass, field
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Optional, List
+from typing import Callable, Optional, List
 import json
 
 
@@ -64,6 +89,36 @@ ROS_DISTRO_UBUNTU_RELEASE_MAP: dict[str, str] = {
 
 VALID_ROS_DISTROS = set(ROS_DISTRO_UBUNTU_MAP.keys())
 
+# Output image codecs and the extension they add to the .img name
+COMPRESSION_CODECS: dict[str, str] = {
+    "xz": ".xz",
+    "zstd": ".zst",
+    "zstd-seekable": ".zst",
+    "none": "",
+}
+
+# Accepted compression_level range per codec
+COMPRESSION_LEVELS: dict[str, tuple[int, int]] = {
+    "xz": (0, 9),
+    "zstd": (1, 22),
+    "zstd-seekable": (1, 22),
+}
+
+# Build-only paths removed from the root filesystem by slim_image ("~" is the user's home)
+DEFAULT_SLIM_PATHS = [
+    "~/turtlebot3_ws/src/libcamera",
+    "~/turtlebot3_ws/log",
+    "~/opencr_update.tar.bz2",
+    "/var/lib/apt/lists/*",
+]
+
+# DDS middlewares and the RMW implementation each one selects ("default" leaves the distro's default)
+DDS_MIDDLEWARES: dict[str, str] = {
+    "default": "",
+    "cyclonedds": "rmw_cyclonedds_cpp",
+    "fastdds": "rmw_fastrtps_cpp",
+}
+
 
 @dataclass
 class BuildConfig:
@@ -78,7 +133,12 @@ class BuildConfig:
 
     # Build options
     skip_compression: bool = False
+    compression: str = "xz"
+    compression_level: Optional[int] = None
     skip_sparse: bool = False
+    base_image_cache: bool = False
+    slim_image: bool = False
+    slim_paths: List[str] = field(default_factory=lambda: list(DEFAULT_SLIM_PATHS))
 
     # Network settings (list of networks, empty list means no networks)
     networks: List[NetworkConfig] = field(default_factory=list)
@@ -94,6 +154,15 @@ class BuildConfig:
     ros_domain_id: int = 0
     ros_distro: str = "humble"
 
+    # DDS settings (optional - the middleware's defaults, multicast discovery)
+    dds_middleware: str = "default"
+    dds_peers: List[str] = field(default_factory=list)
+    dds_discovery_server: Optional[str] = None
+    dds_max_participants: Optional[int] = None
+    dds_multicast: bool = True
+    dds_shared_memory: Optional[bool] = None
+    dds_socket_buffer_size: Optional[str] = None
+
     # Source image
     source_url: str = "https://cdimage.ubuntu.com/releases/22.04.5/release/ubuntu-22.04.5-preinstalled-server-arm64+raspi.img.xz"
     checksum_url: str = "https://cdimage.ubuntu.com/releases/22.04.5/release/SHA256SUMS"
@@ -105,6 +174,13 @@ class BuildConfig:
     # Advanced options
     packer_builder_image: str = "docker.io/mkaczanowski/packer-builder-arm:latest"
     verbose: bool = False
+    apt_cache: bool = False
+    apt_repositories: List[str] = field(default_factory=list)
+    git_cache: bool = False
+    artifact_cache: bool = False
+    checkpoints: bool = False
+    checkpoint_budget: str = "40G"
+    build_jobs: Optional[int] = None
 
     # Computed fields
     computed_version: str = field(default="", init=False)
@@ -112,6 +188,8 @@ class BuildConfig:
     turtlebot3_model: str = field(default="", init=False)
     add_connection: bool = field(default=False, init=False)
     ubuntu_version: str = field(default="", init=False)
+    packer_builder_digest: str = field(default="", init=False)
+    compile_jobs: int = field(default=1, init=False)
 
     # Internal tracking (not user-configurable)
     _source_explicit: bool = field(default=False, init=False)
@@ -124,12 +202,43 @@ class BuildError(Exception):
 
 def load_config(config_path: Path) -> BuildConfig:
     """Load configuration from TOML file."""
+    return parse_config(read_config_data(config_path))
+
+
+def read_config_data(config_path: Path) -> dict:
+    """Read the raw TOML data of a configuration file."""
     if not config_path.exists():
         raise BuildError(f"Configuration file not found: {config_path}")
     
     with open(config_path, "rb") as f:
-        data = tomllib.load(f)
-    
+        return tomllib.load(f)
+
+
+def parse_networks(networks_data) -> List[NetworkConfig]:
+    """Parse a [[network]] array (or a single [network] table) into network configs."""
+    networks = []
+    # Handle both single table and array of tables
+    if isinstance(networks_data, list):
+        for net in networks_data:
+            ssid = net.get("ssid")
+            if ssid:
+                networks.append(NetworkConfig(
+                    ssid=ssid,
+                    password=net.get("password", "")
+                ))
+    else:
+        # Single network table (backward compatibility)
+        ssid = networks_data.get("ssid")
+        if ssid:
+            networks.append(NetworkConfig(
+                ssid=ssid,
+                password=networks_data.get("password", "")
+            ))
+    return networks
+
+
+def parse_config(data: dict) -> BuildConfig:
+    """Build a BuildConfig from parsed TOML data."""
     cfg = BuildConfig()
     
     # Parse image section
@@ -148,29 +257,17 @@ def load_config(config_path: Path) -> BuildConfig:
     if "build" in data:
         build = data["build"]
         cfg.skip_compression = build.get("skip_compression", cfg.skip_compression)
+        cfg.compression = build.get("compression", cfg.compression)
+        cfg.compression_level = build.get("compression_level", cfg.compression_level)
         cfg.skip_sparse = build.get("skip_sparse", cfg.skip_sparse)
+        cfg.base_image_cache = build.get("base_image_cache", cfg.base_image_cache)
+        cfg.slim_image = build.get("slim_image", cfg.slim_image)
+        cfg.slim_paths = build.get("slim_paths", cfg.slim_paths)
     
     # Parse network section (optional)
     # Support both single [[network]] and multiple [[network]] entries
     if "network" in data:
-        networks_data = data["network"]
-        # Handle both single table and array of tables
-        if isinstance(networks_data, list):
-            for net in networks_data:
-                ssid = net.get("ssid")
-                if ssid:
-                    cfg.networks.append(NetworkConfig(
-                        ssid=ssid,
-                        password=net.get("password", "")
-                    ))
-        else:
-            # Single network table (backward compatibility)
-            ssid = networks_data.get("ssid")
-            if ssid:
-                cfg.networks.append(NetworkConfig(
-                    ssid=ssid,
-                    password=networks_data.get("password", "")
-                ))
+        cfg.networks.extend(parse_networks(data["network"]))
         # Automatically enable add_connection if networks are configured
         if cfg.networks:
             cfg.add_connection = True
@@ -192,6 +289,17 @@ def load_config(config_path: Path) -> BuildConfig:
         cfg.ros_domain_id = ros.get("domain_id", cfg.ros_domain_id)
         cfg.ros_distro = ros.get("distro", cfg.ros_distro)
 
+    # Parse dds section (optional - defaults to the middleware's own settings)
+    if "dds" in data:
+        dds = data["dds"]
+        cfg.dds_middleware = dds.get("middleware", cfg.dds_middleware)
+        cfg.dds_peers = dds.get("peers", cfg.dds_peers)
+        cfg.dds_discovery_server = dds.get("discovery_server", cfg.dds_discovery_server)
+        cfg.dds_max_participants = dds.get("max_participants", cfg.dds_max_participants)
+        cfg.dds_multicast = dds.get("multicast", cfg.dds_multicast)
+        cfg.dds_shared_memory = dds.get("shared_memory", cfg.dds_shared_memory)
+        cfg.dds_socket_buffer_size = dds.get("socket_buffer_size", cfg.dds_socket_buffer_size)
+
     # Parse source section
     if "source" in data:
         cfg._source_explicit = True
@@ -210,6 +318,16 @@ def load_config(config_path: Path) -> BuildConfig:
         adv = data["advanced"]
         cfg.packer_builder_image = adv.get("packer_builder_image", cfg.packer_builder_image)
         cfg.verbose = adv.get("verbose", cfg.verbose)
+        cfg.apt_cache = adv.get("apt_cache", cfg.apt_cache)
+        cfg.apt_repositories = adv.get("apt_repositories", cfg.apt_repositories)
+        cfg.git_cache = adv.get("git_cache", cfg.git_cache)
+        cfg.artifact_cache = adv.get("artifact_cache", cfg.artifact_cache)
+        cfg.checkpoints = adv.get("checkpoints", cfg.checkpoints)
+        cfg.checkpoint_budget = adv.get("checkpoint_budget", cfg.checkpoint_budget)
+        cfg.build_jobs = adv.get("build_jobs", cfg.build_jobs)
+    
+    if cfg.skip_compression:
+        cfg.compression = "none"
     
     return cfg
 
@@ -263,6 +381,23 @@ def validate_config(cfg: BuildConfig) -> None:
     if cfg.ros_distro not in VALID_ROS_DISTROS:
         raise BuildError(f"Invalid ROS distro: {cfg.ros_distro}. Must be one of: {', '.join(sorted(VALID_ROS_DISTROS))}.")
 
+    if cfg.compression not in COMPRESSION_CODECS:
+        raise BuildError(f"Invalid compression: {cfg.compression}. Must be one of: {', '.join(COMPRESSION_CODECS)}.")
+
+    if cfg.compression_level is not None and cfg.compression in COMPRESSION_LEVELS:
+        lowest, highest = COMPRESSION_LEVELS[cfg.compression]
+        if not (lowest <= cfg.compression_level <= highest):
+            raise BuildError(f"Invalid compression_level for {cfg.compression}: {cfg.compression_level}. "
+                             f"Must be between {lowest} and {highest}.")
+
+    if not isinstance(cfg.slim_paths, list) or not all(isinstance(path, str) for path in cfg.slim_paths):
+        raise BuildError("Invalid slim_paths: must be a list of paths.")
+
+    if cfg.build_jobs is not None and (not isinstance(cfg.build_jobs, int) or cfg.build_jobs < 1):
+        raise BuildError(f"Invalid build_jobs: {cfg.build_jobs}. Must be a positive integer.")
+
+    validate_dds_config(cfg)
+
 
 def compute_derived_values(cfg: BuildConfig) -> None:
     """Compute derived values from the configuration."""
@@ -311,6 +446,11 @@ def get_build_subdirectory(cfg: BuildConfig) -> Path:
     return Path(cfg.output_directory) / subdir_name
 
 
+def get_image_path(cfg: BuildConfig) -> Path:
+    """Path of the raw image produced by Packer (before compression)."""
+    return get_build_subdirectory(cfg) / f"{cfg.name}-{cfg.opencr_model}-image-{cfg.computed_version}.img"
+
+
 def save_config_to_build_dir(cfg: BuildConfig, build_dir: Path) -> None:
     """Save the complete configuration (including defaults) to the build directory."""
     config_dict = {
@@ -328,7 +468,11 @@ def save_config_to_build_dir(cfg: BuildConfig, build_dir: Path) -> None:
         },
         "build": {
             "skip_compression": cfg.skip_compression,
-            "skip_sparse": cfg.skip_sparse
+            "compression": cfg.compression,
+            "skip_sparse": cfg.skip_sparse,
+            "base_image_cache": cfg.base_image_cache,
+            "slim_image": cfg.slim_image,
+            "slim_paths": cfg.slim_paths
         },
         "network": [
             {"ssid": net.ssid, "password": net.password}
@@ -345,23 +489,49 @@ def save_config_to_build_dir(cfg: BuildConfig, build_dir: Path) -> None:
             "domain_id": cfg.ros_domain_id,
             "distro": cfg.ros_distro
         },
+        "dds": {
+            "middleware": cfg.dds_middleware,
+            "peers": cfg.dds_peers,
+            "multicast": cfg.dds_multicast
+        },
         "source": {
             "url": cfg.source_url,
             "checksum_url": cfg.checksum_url
         },
         "advanced": {
             "packer_builder_image": cfg.packer_builder_image,
-            "verbose": cfg.verbose
+            "verbose": cfg.verbose,
+            "apt_cache": cfg.apt_cache,
+            "apt_repositories": cfg.apt_repositories,
+            "git_cache": cfg.git_cache,
+            "artifact_cache": cfg.artifact_cache,
+            "checkpoints": cfg.checkpoints,
+            "checkpoint_budget": cfg.checkpoint_budget
         },
         "_computed": {
             "computed_version": cfg.computed_version,
             "opencr_model": cfg.opencr_model,
             "turtlebot3_model": cfg.turtlebot3_model,
             "add_connection": cfg.add_connection,
-            "ubuntu_version": cfg.ubuntu_version
+            "ubuntu_version": cfg.ubuntu_version,
+            "packer_builder_digest": cfg.packer_builder_digest,
+            "compile_jobs": cfg.compile_jobs
         }
     }
 
+    if cfg.compression_level is not None:
+        config_dict["build"]["compression_level"] = cfg.compression_level
+    if cfg.build_jobs is not None:
+        config_dict["advanced"]["build_jobs"] = cfg.build_jobs
+    if cfg.dds_discovery_server is not None:
+        config_dict["dds"]["discovery_server"] = cfg.dds_discovery_server
+    if cfg.dds_max_participants is not None:
+        config_dict["dds"]["max_participants"] = cfg.dds_max_participants
+    if cfg.dds_shared_memory is not None:
+        config_dict["dds"]["shared_memory"] = cfg.dds_shared_memory
+    if cfg.dds_socket_buffer_size is not None:
+        config_dict["dds"]["socket_buffer_size"] = cfg.dds_socket_buffer_size
+
     config_path = build_dir / "build_config.toml"
     try:
         import tomli_w
@@ -378,7 +548,13 @@ def save_config_to_build_dir(cfg: BuildConfig, build_dir: Path) -> None:
             f.write(f"computed_version = {cfg.computed_version!r}\n")
             f.write(f"model_type = {cfg.model_type!r}\n")
             f.write(f"skip_compression = {cfg.skip_compression}\n")
+            f.write(f"compression = {cfg.compression!r}\n")
+            if cfg.compression_level is not None:
+                f.write(f"compression_level = {cfg.compression_level}\n")
             f.write(f"skip_sparse = {cfg.skip_sparse}\n")
+            f.write(f"base_image_cache = {cfg.base_image_cache}\n")
+            f.write(f"slim_image = {cfg.slim_image}\n")
+            f.write(f"slim_paths = {cfg.slim_paths!r}\n")
             f.write(f"add_connection = {cfg.add_connection}\n")
             f.write(f"networks_count = {len(cfg.networks)}\n")
             for i, net in enumerate(cfg.networks):
@@ -389,13 +565,34 @@ def save_config_to_build_dir(cfg: BuildConfig, build_dir: Path) -> None:
             f.write(f"lidar = {cfg.lidar!r}\n")
             f.write(f"ros_domain_id = {cfg.ros_domain_id}\n")
             f.write(f"ros_distro = {cfg.ros_distro!r}\n")
+            f.write(f"dds_middleware = {cfg.dds_middleware!r}\n")
+            f.write(f"dds_peers = {cfg.dds_peers!r}\n")
+            if cfg.dds_discovery_server is not None:
+                f.write(f"dds_discovery_server = {cfg.dds_discovery_server!r}\n")
+            if cfg.dds_max_participants is not None:
+                f.write(f"dds_max_participants = {cfg.dds_max_participants}\n")
+            f.write(f"dds_multicast = {cfg.dds_multicast}\n")
+            if cfg.dds_shared_memory is not None:
+                f.write(f"dds_shared_memory = {cfg.dds_shared_memory}\n")
+            if cfg.dds_socket_buffer_size is not None:
+                f.write(f"dds_socket_buffer_size = {cfg.dds_socket_buffer_size!r}\n")
             f.write(f"ubuntu_version = {cfg.ubuntu_version!r}\n")
             f.write(f"image_size = {cfg.image_size!r}\n")
             f.write(f"boot_size = {cfg.boot_size!r}\n")
             f.write(f"source_url = {cfg.source_url!r}\n")
             f.write(f"checksum_url = {cfg.checksum_url!r}\n")
             f.write(f"packer_builder_image = {cfg.packer_builder_image!r}\n")
+            f.write(f"packer_builder_digest = {cfg.packer_builder_digest!r}\n")
+            if cfg.build_jobs is not None:
+                f.write(f"build_jobs = {cfg.build_jobs}\n")
+            f.write(f"compile_jobs = {cfg.compile_jobs}\n")
             f.write(f"verbose = {cfg.verbose}\n")
+            f.write(f"apt_cache = {cfg.apt_cache}\n")
+            f.write(f"apt_repositories = {cfg.apt_repositories!r}\n")
+            f.write(f"git_cache = {cfg.git_cache}\n")
+            f.write(f"artifact_cache = {cfg.artifact_cache}\n")
+            f.write(f"checkpoints = {cfg.checkpoints}\n")
+            f.write(f"checkpoint_budget = {cfg.checkpoint_budget!r}\n")
 
 
 def display_config(cfg: BuildConfig) -> None:
@@ -422,11 +619,15 @@ MODEL: {cfg.model_type}
 LIDAR: {cfg.lidar}
 ROS_DISTRO: {cfg.ros_distro}
 ROS_DOMAIN_ID: {cfg.ros_domain_id}
+DDS: {describe_dds(cfg)}
 UBUNTU_VERSION: {cfg.ubuntu_version}
 USERNAME: {cfg.username}
 USER_PASSWORD: {user_password_display}
-SKIP_COMPRESSION: {cfg.skip_compression}
+COMPRESSION: {cfg.compression}{f" (level {cfg.compression_level})" if cfg.compression_level is not None else ""}
 SKIP_SPARSE: {cfg.skip_sparse}
+BASE_IMAGE_CACHE: {cfg.base_image_cache}
+SLIM_IMAGE: {cfg.slim_image}
+BUILD_JOBS: {cfg.build_jobs or "auto"}
 NETWORK: {network_status}{network_info}
 OUTPUT_DIR: {cfg.output_directory}
 BUILD_SUBDIR: {build_subdir}
@@ -441,22 +642,25 @@ def confirm_build() -> bool:
 
 def check_output_file(cfg: BuildConfig, auto_yes: bool = False) -> None:
     """Check if output file already exists and prompt for overwrite."""
-    build_subdir = get_build_subdirectory(cfg)
-    pattern = f"{cfg.name}-{cfg.turtlebot3_model}-image-{cfg.computed_version}.img*"
-    
-    if build_subdir.exists():
-        for f in build_subdir.glob(pattern):
-            if auto_yes:
-                print(f"Output file already exists: {f} - overwriting")
-                f.unlink()
-                return
-            response = input(f"Output file already exists: {f}. Overwrite? (y/n): ").strip().lower()
-            if response.startswith('y'):
-                print("Overwriting...")
-                f.unlink()
-                return
-            else:
-                raise BuildError(f"Output file already exists: {f}")
+    image_path = get_image_path(cfg)
+    # The raw image, each codec's compressed image and their bmaps
+    names = [image_path.name + suffix for suffix in dict.fromkeys(COMPRESSION_CODECS.values())]
+    names += [name + ".bmap" for name in names]
+
+    existing = [image_path.parent / name for name in names if (image_path.parent / name).exists()]
+    if not existing:
+        return
+    listing = f"{image_path.parent}/: {', '.join(f.name for f in existing)}"
+    if auto_yes:
+        print(f"Output files already exist in {listing} - overwriting")
+    else:
+        response = input(f"Output files already exist in {listing}. Overwrite? (y/n): ").strip().lower()
+        if not response.startswith('y'):
+            raise BuildError(f"Output files already exist in {listing}")
+        print("Overwriting...")
+    # Outputs of another codec would otherwise stay next to the new image
+    for f in existing:
+        f.unlink()
 
 
 def get_cache_dir() -> Path:
@@ -466,51 +670,653 @@ def get_cache_dir() -> Path:
     return cache_dir
 
 
-def download_file(url: str, dest: Path, timeout: int = 3600) -> None:
-    """Download a file with progress reporting."""
+CACHE_LOCK_DIR = "locks"
+
+
+class CacheLock:
+    """Exclusive lock on one cache entry, held across threads and build.py processes.
+
+    Backed by ``flock`` on ``.cache/locks/<name>.lock``. Every holder opens
+    the file itself, so threads of one process exclude each other too. A
+    build that waits finds the entry the holder produced, so concurrent
+    fetches of the same input coalesce into one.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.path = get_cache_dir() / CACHE_LOCK_DIR / (re.sub(r"[^\w.-]+", "_", name) + ".lock")
+        self._file = None
+
+    def __enter__(self) -> "CacheLock":
+        self.path.parent.mkdir(exist_ok=True)
+        self._file = open(self.path, "a")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for another build using {self.name}...")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+DOWNLOAD_READ_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+
+
+@dataclass
+class ConnectionStats:
+    """Bytes transferred and time spent by a single download connection."""
+    index: int
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+class _DownloadState:
+    """Shared state for a ranged download: journal, progress and in-order hashing.
+
+    Chunks complete out of order, so the SHA-256 is advanced over the
+    contiguous prefix of finished chunks by reading them back from the
+    ``.part`` file while they are still in the page cache.
+    """
+
+    def __init__(self, fd: int, journal_path: Path, url: str, size: int,
+                 chunk_size: int, done: set[int]) -> None:
+        self.fd = fd
+        self.journal_path = journal_path
+        self.url = url
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_count = (size + chunk_size - 1) // chunk_size
+        self.done = set(done)
+        self.sha256 = hashlib.sha256()
+        self.hashed_chunks = 0
+        self.downloaded = sum(self.chunk_length(i) for i in self.done)
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self._last_report = 0.0
+        self.report = progress_reporter()
+        self._advance_hash()
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def pending(self) -> List[int]:
+        return [i for i in range(self.chunk_count) if i not in self.done]
+
+    def add_bytes(self, count: int) -> None:
+        with self.lock:
+            self.downloaded += count
+            now = time.monotonic()
+            if now - self._last_report >= 0.5:
+                self._last_report = now
+                _print_download_progress(self.report, self.downloaded, self.size)
+
+    def discard_bytes(self, count: int) -> None:
+        """Roll back progress for a chunk that failed and will be retried."""
+        with self.lock:
+            self.downloaded -= count
+
+    def complete(self, index: int) -> None:
+        with self.lock:
+            self.done.add(index)
+            self._write_journal()
+            self._advance_hash()
+
+    def _advance_hash(self) -> None:
+        while self.hashed_chunks in self.done:
+            offset = self.hashed_chunks * self.chunk_size
+            remaining = self.chunk_length(self.hashed_chunks)
+            while remaining > 0:
+                block = os.pread(self.fd, min(remaining, DOWNLOAD_READ_SIZE), offset)
+                if not block:
+                    raise BuildError(f"Short read while hashing {self.journal_path}")
+                self.sha256.update(block)
+                offset += len(block)
+                remaining -= len(block)
+            self.hashed_chunks += 1
+
+    def _write_journal(self) -> None:
+        tmp_path = self.journal_path.with_name(self.journal_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "url": self.url,
+                "size": self.size,
+                "chunk_size": self.chunk_size,
+                "done": sorted(self.done),
+            }, f)
+        os.replace(tmp_path, self.journal_path)
+
+
+class ThreadOutput:
+    """Stand-in for ``sys.stdout`` that sends each thread's output to its own stream.
+
+    ``build.py serve`` installs one before any build starts and never swaps
+    it, so every build writes to its own log while others run. Threads
+    without a stream of their own write to the original stdout.
+    """
+
+    def __init__(self, console) -> None:
+        self.console = console
+        self._local = threading.local()
+
+    @property
+    def stream(self):
+        return getattr(self._local, "stream", None) or self.console
+
+    @contextmanager
+    def use(self, stream):
+        """Send the calling thread's output to ``stream`` inside the block."""
+        previous = getattr(self._local, "stream", None)
+        self._local.stream = stream
+        try:
+            yield stream
+        finally:
+            self._local.stream = previous
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+    def write(self, text: str) -> int:
+        return self.stream.write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def isatty(self) -> bool:
+        return self.stream.isatty()
+
+
+class ProgressDisplay:
+    """One status line shared by concurrent preparation tasks.
+
+    While active it stands in for ``sys.stdout``: complete lines printed by
+    any thread are written above the status line, which is then redrawn with
+    the latest status of every task. Without a terminal only the printed
+    lines are passed through. Under a ThreadOutput it leaves ``sys.stdout``
+    alone and only takes the output of the calling thread and its tasks.
+    """
+
+    def __init__(self, stream=None) -> None:
+        self.routed = sys.stdout if isinstance(sys.stdout, ThreadOutput) else None
+        self.stream = stream or (self.routed.stream if self.routed else sys.stdout)
+        self.live = self.stream.isatty()
+        self.statuses: dict[str, str] = {}
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self._drawn = 0
+
+    def __enter__(self) -> "ProgressDisplay":
+        global _progress_display
+        _progress_display = self
+        if self.routed:
+            self._routing = self.routed.use(self)
+            self._routing.__enter__()
+        else:
+            sys.stdout = self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _progress_display
+        with self.lock:
+            self._clear()
+            if self.routed:
+                self._routing.__exit__(None, None, None)
+            else:
+                sys.stdout = self.stream
+            _progress_display = None
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+    def run(self, task: str, func: Callable, *args, **kwargs):
+        """Call ``func`` with the progress reported from this thread shown as ``task``."""
+        self._local.task = task
+        self.update(task, "starting")
+        try:
+            if self.routed:
+                with self.routed.use(self):
+                    result = func(*args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        except BaseException:
+            self.update(task, "failed")
+            raise
+        finally:
+            if getattr(self._local, "buffer", ""):
+                self.write("\n")
+            self._local.task = None
+        self.update(task, "done")
+        return result
+
+    def reporter(self) -> Optional[Callable[[str], None]]:
+        """Return a status callback for the calling thread's task, if it runs one."""
+        task = getattr(self._local, "task", None)
+        if task is None:
+            return None
+        return lambda text: self.update(task, text)
+
+    def update(self, task: str, status: str) -> None:
+        with self.lock:
+            self.statuses[task] = status
+            self._draw()
+
+    def write(self, text: str) -> int:
+        # Lines are buffered per thread so concurrent prints do not interleave
+        *lines, self._local.buffer = (getattr(self._local, "buffer", "") + text).split("\n")
+        if lines:
+            with self.lock:
+                self._clear()
+                for line in lines:
+                    self.stream.write(line + "\n")
+                self._draw()
+        return len(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def isatty(self) -> bool:
+        return self.live
+
+    def _clear(self) -> None:
+        if self._drawn:
+            self.stream.write("\r" + " " * self._drawn + "\r")
+            self._drawn = 0
+
+    def _draw(self) -> None:
+        if not self.live or not self.statuses:
+            return
+        line = " | ".join(f"{task}: {status}" for task, status in self.statuses.items())
+        line = line[:shutil.get_terminal_size().columns - 1]
+        self._clear()
+        self.stream.write(line)
+        self.stream.flush()
+        self._drawn = len(line)
+
+
+# The display of the running preparation stage, if any
+_progress_display: Optional[ProgressDisplay] = None
+
+
+def progress_reporter() -> Callable[[str], None]:
+    """Return a callback that shows a progress line for the calling thread.
+
+    Inside a ProgressDisplay task the text becomes that task's status;
+    otherwise it overwrites the current console line.
+    """
+    display = _progress_display
+    report = display.reporter() if display else None
+    return report or (lambda text: print(f"\r{text}", end="", flush=True))
+
+
+def _print_download_progress(report: Callable[[str], None], downloaded: int, total_size: int) -> None:
+    if total_size > 0:
+        percent = min(downloaded * 100 / total_size, 100)
+        report(f"Progress: {percent:.1f}% ({downloaded // 1024 // 1024}MB / {total_size // 1024 // 1024}MB)")
+
+
+def _probe_download(url: str, timeout: int) -> tuple[int, bool]:
+    """Return the size of the remote file and whether it supports Range requests."""
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if response.status == 206:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit():
+                return int(total), True
+        length = response.headers.get("Content-Length", "")
+        return (int(length) if length.isdigit() else -1), False
+
+
+def _load_download_journal(journal_path: Path, url: str, size: int, chunk_size: int) -> set[int]:
+    """Return the chunks already completed by an interrupted download of the same file."""
+    try:
+        with open(journal_path) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if (journal.get("url"), journal.get("size"), journal.get("chunk_size")) != (url, size, chunk_size):
+        return set()
+    return set(journal.get("done", []))
+
+
+def _fetch_range(url: str, state: _DownloadState, index: int, stats: ConnectionStats, timeout: int) -> None:
+    """Download one chunk into its slot in the preallocated .part file."""
+    start = index * state.chunk_size
+    end = start + state.chunk_length(index) - 1
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+    offset = start
+    began = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            if response.status != 206:
+                raise BuildError(f"Server ignored range request for bytes {start}-{end}")
+            while offset <= end:
+                if state.stop.is_set():
+                    raise BuildError("Download cancelled")
+                block = response.read(min(DOWNLOAD_READ_SIZE, end + 1 - offset))
+                if not block:
+                    break
+                os.pwrite(state.fd, block, offset)
+                offset += len(block)
+                state.add_bytes(len(block))
+        if offset != end + 1:
+            raise BuildError(f"Connection closed early for bytes {start}-{end}")
+    except BaseException:
+        state.discard_bytes(offset - start)
+        raise
+    finally:
+        stats.bytes += offset - start
+        stats.seconds += time.monotonic() - began
+
+
+def _download_worker(url: str, state: _DownloadState, chunks: "queue.Queue[int]",
+                     stats: ConnectionStats, timeout: int) -> None:
+    while not state.stop.is_set():
+        try:
+            index = chunks.get_nowait()
+        except queue.Empty:
+            return
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            try:
+                _fetch_range(url, state, index, stats, timeout)
+                break
+            except (OSError, BuildError) as e:
+                if state.stop.is_set() or attempt == DOWNLOAD_RETRIES:
+                    raise
+                print(f"\nConnection {stats.index}: retrying chunk {index} ({e})")
+        state.complete(index)
+
+
+def _download_single_stream(url: str, part_path: Path, timeout: int) -> tuple[str, List[ConnectionStats]]:
+    """Fallback for servers without Range support: one stream, hashed as it arrives."""
+    stats = ConnectionStats(index=0)
+    sha256 = hashlib.sha256()
+    began = time.monotonic()
+    last_report = 0.0
+    report = progress_reporter()
+    with urllib.request.urlopen(url, timeout=timeout) as response, open(part_path, "wb") as f:
+        length = response.headers.get("Content-Length", "")
+        total_size = int(length) if length.isdigit() else -1
+        for block in iter(lambda: response.read(DOWNLOAD_READ_SIZE), b""):
+            f.write(block)
+            sha256.update(block)
+            stats.bytes += len(block)
+            if time.monotonic() - last_report >= 0.5:
+                last_report = time.monotonic()
+                _print_download_progress(report, stats.bytes, total_size)
+    stats.seconds = time.monotonic() - began
+    return sha256.hexdigest(), [stats]
+
+
+def _download_ranged(url: str, part_path: Path, journal_path: Path, size: int,
+                     connections: int, chunk_size: int, timeout: int) -> tuple[str, List[ConnectionStats]]:
+    done = _load_download_journal(journal_path, url, size, chunk_size)
+    if done and not part_path.exists():
+        done = set()
+    if done:
+        print(f"Resuming download ({len(done)} chunks already complete)")
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass  # Filesystem without fallocate support; the sparse file still works
+
+        state = _DownloadState(fd, journal_path, url, size, chunk_size, done)
+        chunks: "queue.Queue[int]" = queue.Queue()
+        for index in state.pending():
+            chunks.put(index)
+
+        all_stats = [ConnectionStats(index=i) for i in range(max(1, min(connections, chunks.qsize())))]
+        with _active_processes_lock:
+            _active_downloads.add(state)
+        try:
+            with ThreadPoolExecutor(max_workers=len(all_stats)) as pool:
+                futures = [pool.submit(_download_worker, url, state, chunks, stats, timeout)
+                           for stats in all_stats]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    state.stop.set()
+                    raise
+        finally:
+            with _active_processes_lock:
+                _active_downloads.discard(state)
+
+        if state.hashed_chunks != state.chunk_count:
+            raise BuildError(f"Download incomplete: {state.hashed_chunks}/{state.chunk_count} chunks")
+        os.fsync(fd)
+        return state.sha256.hexdigest(), all_stats
+    finally:
+        os.close(fd)
+
+
+def download_file(url: str, dest: Path, timeout: int = 3600,
+                  connections: int = DOWNLOAD_CONNECTIONS,
+                  chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    """Download a file with progress reporting and return its SHA-256.
+
+    Servers that support Range requests are fetched over several concurrent
+    connections into a preallocated ``.part`` file. A small JSON journal next
+    to it records finished chunks, so an interrupted download resumes where
+    it stopped. The digest is computed while the download runs.
+    """
     print(f"Downloading: {url}")
     print(f"Destination: {dest}")
-    
-    def report_progress(block_num: int, block_size: int, total_size: int) -> None:
-        downloaded = block_num * block_size
-        if total_size > 0:
-            percent = min(downloaded * 100 / total_size, 100)
-            print(f"\rProgress: {percent:.1f}% ({downloaded // 1024 // 1024}MB / {total_size // 1024 // 1024}MB)", end="", flush=True)
-    
-    urllib.request.urlretrieve(url, dest, reporthook=report_progress)
-    print()  # New line after progress
+
+    part_path = dest.with_name(dest.name + ".part")
+    journal_path = dest.with_name(dest.name + ".part.json")
+
+    size, ranged = _probe_download(url, timeout=min(timeout, 30))
+    began = time.monotonic()
+    if ranged and size > 0:
+        digest, all_stats = _download_ranged(url, part_path, journal_path, size,
+                                             connections, chunk_size, timeout)
+    else:
+        digest, all_stats = _download_single_stream(url, part_path, timeout)
+    elapsed = time.monotonic() - began
+    if _progress_display is None:
+        print()  # New line after progress
+
+    os.replace(part_path, dest)
+    journal_path.unlink(missing_ok=True)
+
+    total = sum(stats.bytes for stats in all_stats)
+    print(f"Downloaded {total // 1024 // 1024}MB in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-6) / 1024 / 1024:.1f}MB/s)")
+    for stats in all_stats:
+        print(f"  Connection {stats.index}: {stats.bytes // 1024 // 1024}MB, "
+              f"{stats.throughput / 1024 / 1024:.1f}MB/s")
+    return digest
 
 
-def verify_checksum(file_path: Path, expected_checksum: str) -> bool:
-    """Verify file checksum against expected value."""
-    print(f"Verifying checksum...")
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def file_sha256(file_path: Path) -> str:
+    """Compute the SHA-256 of a file using large reads into a reused buffer."""
     sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    computed = sha256_hash.hexdigest()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            sha256_hash.update(view[:count])
+    return sha256_hash.hexdigest()
+
+
+def _verification_record_path(file_path: Path) -> Path:
+    return file_path.with_name(file_path.name + ".verified.json")
+
+
+def read_verification_record(file_path: Path) -> Optional[dict]:
+    """Return the sidecar record of a file if the file is unchanged since it was hashed.
+
+    The sidecar record stores size, mtime and inode alongside the digest; any
+    difference means the file may have changed and must be hashed again.
+    """
+    try:
+        with open(_verification_record_path(file_path)) as f:
+            record = json.load(f)
+        st = file_path.stat()
+    except (OSError, ValueError):
+        return None
+    if (record.get("size"), record.get("mtime_ns"), record.get("inode")) != (st.st_size, st.st_mtime_ns, st.st_ino):
+        return None
+    return record
+
+
+def read_verified_digest(file_path: Path) -> Optional[str]:
+    """Return the recorded digest of a file if it is unchanged since it was hashed."""
+    record = read_verification_record(file_path)
+    return record.get("sha256") if record else None
+
+
+def record_verified_digest(file_path: Path, digest: str, **extra: str) -> None:
+    """Write the sidecar verification record for a file, with any extra fields."""
+    st = file_path.stat()
+    record_path = _verification_record_path(file_path)
+    tmp_path = record_path.with_name(record_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "sha256": digest.lower(),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "inode": st.st_ino,
+            **extra,
+        }, f, indent=2)
+    os.replace(tmp_path, record_path)
+
+
+def verify_checksum(file_path: Path, expected_checksum: str, reverify: bool = False) -> bool:
+    """Verify file checksum against expected value.
+
+    Unless ``reverify`` is set, a matching sidecar verification record is
+    trusted instead of hashing the whole file again.
+    """
+    computed = None if reverify else read_verified_digest(file_path)
+    if computed is not None:
+        print("Verifying checksum (using recorded digest, file unchanged)...")
+    else:
+        print(f"Verifying checksum...")
+        computed = file_sha256(file_path)
+        record_verified_digest(file_path, computed)
     return computed.lower() == expected_checksum.lower()
 
 
-def get_expected_checksum(checksum_url: str, filename: str) -> str:
-    """Fetch and parse checksum from URL."""
-    print(f"Fetching checksum from: {checksum_url}")
-    with urllib.request.urlopen(checksum_url, timeout=30) as response:
-        checksums = response.read().decode('utf-8')
-    
-    for line in checksums.strip().split('\n'):
-        parts = line.split()
-        if len(parts) >= 2:
-            checksum = parts[0]
-            name = parts[1].lstrip('*')  # Remove leading * if present
-            if filename in name or name in filename:
-                return checksum
-    
-    raise BuildError(f"Could not find checksum for {filename} in {checksum_url}")
+MANIFEST_TTL_SECONDS = 24 * 60 * 60
+
+# Parsed checksum manifests, keyed by checksum_url and shared by every caller in this process
+_manifest_index: dict[str, dict[str, str]] = {}
+# One lock per checksum_url, so a slow fetch only holds up callers waiting for the same manifest
+_manifest_locks: dict[str, threading.Lock] = {}
+_manifest_lock = threading.Lock()
+
+
+def parse_checksum_manifest(text: str) -> dict[str, str]:
+    """Parse a SHA256SUMS file into a filename -> digest index."""
+    entries: dict[str, str] = {}
+    for line in text.strip().split('\n'):
+        parts = line.split(maxsplit=1)
+        if len(parts) == 2:
+            checksum = parts[0].lower()
+            name = parts[1].strip().lstrip('*')  # Remove leading * if present
+            entries[Path(name).name] = checksum
+    return entries
+
+
+def _manifest_cache_path(checksum_url: str) -> Path:
+    key = hashlib.sha256(checksum_url.encode()).hexdigest()[:16]
+    return get_cache_dir() / "manifests" / f"{key}.json"
+
 
+def load_checksum_manifest(checksum_url: str, offline: bool = False) -> dict[str, str]:
+    """Return the filename -> digest index for a checksum URL.
 
-def download_source_image(cfg: BuildConfig) -> Path:
-    """Download source image if not already cached, verify checksum, and return local path."""
+    The index is loaded once per process. On disk it is cached in
+    ``.cache/manifests/`` and refetched once older than MANIFEST_TTL_SECONDS;
+    a stale copy is still used if the server cannot be reached. In offline
+    mode only the cached copy is used.
+    """
+    with _manifest_lock:
+        url_lock = _manifest_locks.setdefault(checksum_url, threading.Lock())
+    with url_lock:
+        if checksum_url in _manifest_index:
+            return _manifest_index[checksum_url]
+
+        cache_path = _manifest_cache_path(checksum_url)
+        cached = None
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        if cached is not None and (offline or time.time() - cached.get("fetched_at", 0) < MANIFEST_TTL_SECONDS):
+            entries = cached["entries"]
+        elif offline:
+            raise BuildError(f"No cached checksum manifest for {checksum_url} (offline mode)")
+        else:
+            print(f"Fetching checksum from: {checksum_url}")
+            try:
+                with urllib.request.urlopen(checksum_url, timeout=30) as response:
+                    entries = parse_checksum_manifest(response.read().decode('utf-8'))
+            except OSError as e:
+                if cached is None:
+                    raise BuildError(f"Could not fetch {checksum_url}: {e}") from e
+                print(f"Warning: Could not refresh {checksum_url} ({e}), using cached copy")
+                entries = cached["entries"]
+            else:
+                cache_path.parent.mkdir(exist_ok=True)
+                tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump({"url": checksum_url, "fetched_at": time.time(), "entries": entries}, f, indent=2)
+                os.replace(tmp_path, cache_path)
+
+        _manifest_index[checksum_url] = entries
+        return entries
+
+
+def get_expected_checksum(checksum_url: str, filename: str, offline: bool = False) -> str:
+    """Look up the expected checksum of a file in its checksum manifest."""
+    entries = load_checksum_manifest(checksum_url, offline=offline)
+    try:
+        return entries[filename]
+    except KeyError:
+        raise BuildError(f"Could not find checksum for {filename} in {checksum_url}") from None
+
+
+def download_source_image(cfg: BuildConfig, reverify: bool = False, offline: bool = False) -> Path:
+    """Download source image if not already cached, verify checksum, and return local path.
+
+    Cached images are verified against their sidecar record unless ``reverify``
+    forces a full hash. In offline mode the image and its checksum manifest
+    must already be cached. The returned path is the decompressed raw image
+    kept next to the download (see decompress_source_image). Builds of the
+    same image wait for each other, so it is downloaded once.
+    """
+    with CacheLock(f"source-{Path(cfg.source_url).name}"):
+        return _download_source_image(cfg, reverify=reverify, offline=offline)
+
+
+def _download_source_image(cfg: BuildConfig, reverify: bool = False, offline: bool = False) -> Path:
     cache_dir = get_cache_dir()
     
     # Extract filename from URL
@@ -523,151 +1329,3816 @@ def download_source_image(cfg: BuildConfig) -> Path:
         print(f"Found cached file: {local_path}")
         # Verify checksum even for cached files
         try:
-            expected_checksum = get_expected_checksum(cfg.checksum_url, filename)
-            if verify_checksum(local_path, expected_checksum):
-                print("Checksum verified (cached file is valid)")
-                return local_path
-            else:
-                print("Cached file checksum mismatch - re-downloading...")
-                local_path.unlink()
-        except Exception as e:
+            expected_checksum = get_expected_checksum(cfg.checksum_url, filename, offline=offline)
+        except BuildError as e:
+            if offline:
+                raise
             print(f"Warning: Could not verify cached file: {e}")
             print("Proceeding with cached file...")
-            return local_path
+            return decompress_source_image(local_path)
+        if verify_checksum(local_path, expected_checksum, reverify=reverify):
+            print("Checksum verified (cached file is valid)")
+            return decompress_source_image(local_path)
+        if offline:
+            raise BuildError(f"Cached file checksum mismatch: {local_path} (offline mode)")
+        print("Cached file checksum mismatch - re-downloading...")
+        local_path.unlink()
+    elif offline:
+        raise BuildError(f"Source image not cached: {local_path} (offline mode)")
     
-    # Download the file
-    download_file(cfg.source_url, local_path)
+    # Download the file (the digest is computed while it downloads)
+    digest = download_file(cfg.source_url, local_path)
+    record_verified_digest(local_path, digest)
     
     # Verify checksum
     try:
         expected_checksum = get_expected_checksum(cfg.checksum_url, filename)
-        if not verify_checksum(local_path, expected_checksum):
-            local_path.unlink()
-            raise BuildError("Downloaded file checksum verification failed")
-        print("Checksum verified")
-    except Exception as e:
+    except BuildError as e:
         print(f"Warning: Could not verify checksum: {e}")
+        return decompress_source_image(local_path)
+    if digest.lower() != expected_checksum.lower():
+        local_path.unlink()
+        raise BuildError("Downloaded file checksum verification failed")
+    print("Checksum verified")
     
-    return local_path
+    return decompress_source_image(local_path)
 
 
-def pull_packer_image(cfg: BuildConfig) -> None:
-    """Pull the Packer builder Docker image."""
-    print(f"Pulling Packer builder image: {cfg.packer_builder_image}")
-    process = subprocess.Popen(
-        ["sudo", "podman", "pull", cfg.packer_builder_image],
-        preexec_fn=os.setpgrp
-    )
-    try:
-        process.wait()
+SOURCE_DECOMPRESS_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def decompress_source_image(compressed_path: Path) -> Path:
+    """Return a sparse raw copy of an ``.img.xz`` source image, decompressing it once.
+
+    The raw image is kept in the cache next to the download. Its sidecar
+    record holds its own SHA-256 and the digest of the archive it came from,
+    so it is rebuilt only when the archive changes. Other files are returned
+    unchanged.
+    """
+    if compressed_path.suffix != ".xz":
+        return compressed_path
+    raw_path = compressed_path.with_suffix("")
+    source_digest = read_verified_digest(compressed_path) or file_sha256(compressed_path)
+    record = read_verification_record(raw_path)
+    if record and record.get("source_sha256") == source_digest:
+        print(f"Using cached raw source image: {raw_path}")
+        return raw_path
+
+    print(f"Decompressing {compressed_path} (multithreaded xz)...")
+    began = time.monotonic()
+    tmp_path = raw_path.with_name(raw_path.name + ".tmp")
+    sha256 = hashlib.sha256()
+    size = 0
+    written = 0
+    with open(compressed_path, "rb") as src, open(tmp_path, "wb") as dest:
+        process = subprocess.Popen(decompressor_command("xz"), stdin=src, stdout=subprocess.PIPE,
+                                   preexec_fn=os.setpgrp)
+        with _active_processes_lock:
+            _active_processes.add(process)
+        try:
+            while chunk := process.stdout.read(SOURCE_DECOMPRESS_CHUNK_SIZE):
+                sha256.update(chunk)
+                # Only non-zero blocks are written, leaving holes for the rest
+                for is_zero, first, last in zero_block_runs(chunk):
+                    if not is_zero:
+                        os.pwrite(dest.fileno(), memoryview(chunk)[first:last], size + first)
+                        written += last - first
+                size += len(chunk)
+            process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            with _active_processes_lock:
+                _active_processes.discard(process)
         if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, process.args)
-    except KeyboardInterrupt:
-        process.terminate()
-        process.wait()
-        raise
+            tmp_path.unlink(missing_ok=True)
+            raise BuildError(f"Failed to decompress {compressed_path}")
+        dest.truncate(size)
+    os.replace(tmp_path, raw_path)
+    record_verified_digest(raw_path, sha256.hexdigest(), source_sha256=source_digest)
+    print(f"Decompressed {format_bytes(size)} ({format_bytes(written)} data) in {time.monotonic() - began:.1f}s")
+    return raw_path
 
 
-def run_packer_build(cfg: BuildConfig, packer_file: str, source_image_path: Path) -> None:
-    """Run the Packer build."""
-    build_subdir = get_build_subdirectory(cfg)
-    
-    # Get the checksum for the source image
-    url_path = Path(cfg.source_url)
-    filename = url_path.name
-    try:
-        expected_checksum = get_expected_checksum(cfg.checksum_url, filename)
-        print(f"Using checksum: {expected_checksum}")
-    except Exception as e:
-        print(f"Warning: Could not fetch checksum: {e}")
-        expected_checksum = ""
-    
-    cmd = [
-        "sudo", "podman", "run", "--rm", "--privileged",
-        "--pid=host",
-        "-v", "/dev:/dev",
-        "-v", f"{os.getcwd()}:/build",
-        cfg.packer_builder_image,
-        "build",
-        "-var", f"NAME={cfg.name}",
-        "-var", f"VERSION={cfg.computed_version}",
-        "-var", f"SKIP_COMPRESSION={str(cfg.skip_compression).lower()}",
-        "-var", f"SKIP_SPARSE={str(cfg.skip_sparse).lower()}",
-        "-var", f"OPENCR_MODEL={cfg.opencr_model}",
-        "-var", f"TURTLEBOT3_MODEL={cfg.turtlebot3_model}",
-        "-var", f"ADD_CONNECTION={str(cfg.add_connection).lower()}",
-        "-var", f"NETWORKS={json.dumps([{'ssid': net.ssid, 'password': net.password} for net in cfg.networks])}",
-        "-var", f"USERNAME={cfg.username}",
-        "-var", f"USER_PASSWORD={cfg.user_password}",
-        "-var", f"LIDAR={cfg.lidar}",
-        "-var", f"ROS_DOMAIN_ID={cfg.ros_domain_id}",
-        "-var", f"ROS_DISTRO={cfg.ros_distro}",
-        "-var", f"BUILD_SUBDIR={build_subdir.name}",
-        "-var", f"SOURCE_IMAGE_PATH={source_image_path}",
-        "-var", f"IMAGE_CHECKSUM={expected_checksum}",
-        "-var", f"IMAGE_SIZE={cfg.image_size}",
-        "-var", f"BOOT_SIZE={cfg.boot_size}",
-        packer_file
-    ]
+def cached_source_image(cfg: BuildConfig) -> Optional[Path]:
+    """Return the raw source image download_source_image would return, if its records show it unchanged.
+
+    Nothing is fetched or hashed: the download and the raw image must both
+    have current verification records, and the raw image must come from that
+    download.
+    """
+    local_path = get_cache_dir() / Path(cfg.source_url).name
+    source_digest = read_verified_digest(local_path)
+    if source_digest is None:
+        return None
+    if local_path.suffix != ".xz":
+        return local_path
+    record = read_verification_record(local_path.with_suffix(""))
+    if not record or record.get("source_sha256") != source_digest:
+        return None
+    return local_path.with_suffix("")
+
+
+# Processes started by run_process, so interrupted parallel builds can be stopped
+_active_processes: set[subprocess.Popen] = set()
+_active_processes_lock = threading.Lock()
+# Ranged downloads in progress, stopped together with the processes
+_active_downloads: set["_DownloadState"] = set()
 
-    if cfg.verbose:
-        print(f"Running command: {' '.join(cmd)}")
 
-    process = subprocess.Popen(cmd, preexec_fn=os.setpgrp)
+def run_process(cmd: List[str], log_path: Optional[Path] = None,
+                on_line: Optional[Callable[[str], None]] = None) -> None:
+    """Run a command in its own process group and wait for it.
+
+    Output goes to the console, or to ``log_path`` when given. With
+    ``on_line``, output is streamed through the callback line by line on its
+    way there. The process is terminated if the build is interrupted.
+    """
+    log_file = open(log_path, "w") if log_path else None
     try:
-        process.wait()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, process.args)
-    except KeyboardInterrupt:
+        process = subprocess.Popen(
+            cmd,
+            preexec_fn=os.setpgrp,
+            stdout=subprocess.PIPE if on_line else log_file,
+            stderr=subprocess.STDOUT if log_file or on_line else None
+        )
+        with _active_processes_lock:
+            _active_processes.add(process)
+        try:
+            if on_line:
+                output = log_file or sys.stdout
+                for raw_line in process.stdout:
+                    line = raw_line.decode(errors="replace")
+                    output.write(line)
+                    output.flush()
+                    on_line(line)
+            process.wait()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        except KeyboardInterrupt:
+            process.terminate()
+            process.wait()
+            raise
+        finally:
+            with _active_processes_lock:
+                _active_processes.discard(process)
+    finally:
+        if log_file:
+            log_file.close()
+
+
+def terminate_active_processes() -> None:
+    """Terminate every process still running under run_process and stop running downloads."""
+    with _active_processes_lock:
+        processes = list(_active_processes)
+        for state in _active_downloads:
+            state.stop.set()
+    for process in processes:
         process.terminate()
+    for process in processes:
         process.wait()
-        raise
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Build TurtleBot3 custom Ubuntu images using TOML configuration files.",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
-Examples:
-  # Build with a config file
-  python build.py --config configs/production.toml
+def pull_packer_image(cfg: BuildConfig, log_path: Optional[Path] = None) -> None:
+    """Pull the Packer builder Docker image.
 
-  # Dry run to validate config
-  python build.py --config configs/production.toml --dry-run
+    With ``log_path`` the pull output goes to that file and its latest line
+    is reported as the progress of the calling task.
+    """
+    print(f"Pulling Packer builder image: {cfg.packer_builder_image}")
+    cmd = ["sudo", "podman", "pull", cfg.packer_builder_image]
+    if log_path is None:
+        run_process(cmd)
+        return
+    report = progress_reporter()
+    run_process(cmd, log_path=log_path, on_line=lambda line: report(line.strip()) if line.strip() else None)
 
-  # Build without confirmation prompt
-  python build.py --config configs/production.toml -y
 
-  # Verbose output
-  python build.py --config configs/production.toml --verbose
+def _builder_tarball_path(image: str) -> Path:
+    return get_cache_dir() / "builder-images" / (re.sub(r"[^\w.-]+", "_", image) + ".tar")
 
-Config File Structure:
-  The [network] section is optional. If included with an SSID, network
-  connection will be added automatically. Remove or comment out the entire
-  [network] section to skip network setup.
 
-  See configs/example.toml for a complete example.
-        """
-    )
-    
-    parser.add_argument(
-        "--config", "-c",
-        type=Path,
-        required=True,
-        help="Path to TOML configuration file"
-    )
-    
-    parser.add_argument(
-        "--packer-file", "-p",
-        default="packer_ubuntu_server.json",
-        help="Path to Packer configuration file (default: packer_ubuntu_server.json)"
-    )
-    
-    parser.add_argument(
-        "--dry-run", "-d",
-        action="store_true",
-        help="Show configuration without running build"
+def save_builder_tarball(image: str, digest: str) -> None:
+    """Keep a ``podman save`` tarball of the builder image for builds without a registry.
+
+    The tarball is only rewritten when the local image changed since it was saved.
+    """
+    tarball = _builder_tarball_path(image)
+    record_path = tarball.with_suffix(".json")
+    try:
+        with open(record_path) as f:
+            if json.load(f).get("digest") == digest and tarball.exists():
+                return
+    except (OSError, ValueError):
+        pass
+    tarball.parent.mkdir(exist_ok=True)
+    tmp_path = tarball.with_name(tarball.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    print(f"Saving builder image to {tarball}")
+    run_process(["sudo", "podman", "save", "--output", str(tmp_path), image])
+    take_ownership(tmp_path)
+    os.replace(tmp_path, tarball)
+    with open(record_path, "w") as f:
+        json.dump({"image": image, "digest": digest, "saved": time.time()}, f, indent=2)
+
+
+def load_builder_tarball(image: str) -> Optional[str]:
+    """Load the saved tarball of the builder image and return its ID, or None if there is none."""
+    tarball = _builder_tarball_path(image)
+    if not tarball.exists():
+        return None
+    print(f"Loading builder image from {tarball}")
+    run_process(["sudo", "podman", "load", "--input", str(tarball)])
+    return builder_image_digest(image)
+
+
+def ensure_builder_image(cfg: BuildConfig, refresh: bool = False, offline: bool = False,
+                         log_path: Optional[Path] = None) -> str:
+    """Make the Packer builder image available locally and return its image ID.
+
+    A locally present image is used as is unless ``refresh`` asks for a pull.
+    When the registry cannot be reached, or in offline mode, the tarball
+    saved in ``.cache/builder-images/`` after an earlier pull is loaded
+    instead. The ID is recorded on the config for build_config.toml.
+    """
+    with CacheLock(f"builder-{cfg.packer_builder_image}"):
+        return _ensure_builder_image(cfg, refresh=refresh, offline=offline, log_path=log_path)
+
+
+def _ensure_builder_image(cfg: BuildConfig, refresh: bool = False, offline: bool = False,
+                          log_path: Optional[Path] = None) -> str:
+    image = cfg.packer_builder_image
+    digest = builder_image_digest(image)
+    if digest and (offline or not refresh):
+        print(f"Using local Packer builder image: {image} ({digest[:12]})")
+    elif offline:
+        digest = load_builder_tarball(image)
+        if not digest:
+            raise BuildError(f"Builder image {image} is not available locally (offline mode)")
+    else:
+        try:
+            pull_packer_image(cfg, log_path=log_path)
+        except subprocess.CalledProcessError as e:
+            digest = digest or load_builder_tarball(image)
+            if not digest:
+                raise BuildError(f"Could not pull {image} and no saved builder image exists") from e
+            print(f"Warning: Could not pull {image}, using {digest[:12]}")
+        else:
+            digest = builder_image_digest(image)
+            if not digest:
+                raise BuildError(f"Builder image {image} missing after pull")
+            save_builder_tarball(image, digest)
+    cfg.packer_builder_digest = digest
+    return digest
+
+
+DDS_PROFILE_DIR = "/etc/turtlebot3/dds"
+DDS_HOST_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9.-]*$")
+DDS_DEFAULT_DISCOVERY_PORT = 11811
+CYCLONEDDS_NAMESPACE = "https://cdds.io/config"
+FASTDDS_NAMESPACE = "http://www.eprosima.com/XMLSchemas/fastRTPS_Profiles"
+# GUID prefix of a Fast DDS discovery server started with server ID 0 (fastdds discovery -i 0)
+FASTDDS_SERVER_PREFIX = "44.53.00.5f.45.50.52.4f.53.49.4d.41"
+
+
+def validate_dds_config(cfg: BuildConfig) -> None:
+    """Validate the [dds] section and the profile generated from it."""
+    if cfg.dds_middleware not in DDS_MIDDLEWARES:
+        raise BuildError(f"Invalid dds middleware: {cfg.dds_middleware}. "
+                         f"Must be one of: {', '.join(DDS_MIDDLEWARES)}.")
+    configured = (cfg.dds_peers or cfg.dds_discovery_server or cfg.dds_max_participants is not None
+                  or not cfg.dds_multicast or cfg.dds_shared_memory is not None
+                  or cfg.dds_socket_buffer_size is not None)
+    if cfg.dds_middleware == "default":
+        if configured:
+            raise BuildError("The [dds] settings need a middleware: set dds.middleware to 'cyclonedds' or 'fastdds'.")
+        return
+
+    if not isinstance(cfg.dds_peers, list) or not all(
+            isinstance(peer, str) and DDS_HOST_PATTERN.match(peer) for peer in cfg.dds_peers):
+        raise BuildError(f"Invalid dds peers: {cfg.dds_peers}. Must be a list of host names or IPv4 addresses.")
+    if cfg.dds_discovery_server is not None:
+        host, _, port = str(cfg.dds_discovery_server).partition(":")
+        if cfg.dds_middleware != "fastdds":
+            raise BuildError("dds.discovery_server is only supported with the fastdds middleware.")
+        if not DDS_HOST_PATTERN.match(host) or (port and not (port.isdigit() and 0 < int(port) < 65536)):
+            raise BuildError(f"Invalid dds discovery_server: {cfg.dds_discovery_server}. Must be HOST or HOST:PORT.")
+        if cfg.dds_peers:
+            raise BuildError("Set either dds.peers or dds.discovery_server, not both.")
+    if not cfg.dds_multicast and not (cfg.dds_peers or cfg.dds_discovery_server):
+        raise BuildError("dds.multicast = false needs dds.peers or dds.discovery_server, "
+                         "otherwise robots cannot discover each other.")
+    if cfg.dds_max_participants is not None and (
+            not isinstance(cfg.dds_max_participants, int) or cfg.dds_max_participants < 1):
+        raise BuildError(f"Invalid dds max_participants: {cfg.dds_max_participants}. Must be a positive integer.")
+    if cfg.dds_shared_memory and cfg.dds_middleware == "cyclonedds":
+        # Cyclone DDS only shares memory through an iceoryx RouDi daemon, which the image does not run
+        raise BuildError("dds.shared_memory is only supported with the fastdds middleware.")
+    if cfg.dds_socket_buffer_size is not None and parse_size(cfg.dds_socket_buffer_size) <= 0:
+        raise BuildError(f"Invalid dds socket_buffer_size: {cfg.dds_socket_buffer_size}.")
+
+    _, profile = dds_profile(cfg)
+    check_dds_profile(cfg, profile)
+
+
+def describe_dds(cfg: BuildConfig) -> str:
+    """One-line summary of the DDS settings for display_config."""
+    if cfg.dds_middleware == "default":
+        return "default"
+    parts = [cfg.dds_middleware]
+    if cfg.dds_discovery_server:
+        parts.append(f"discovery server {cfg.dds_discovery_server}")
+    if cfg.dds_peers:
+        parts.append(f"{len(cfg.dds_peers)} peers")
+    if not cfg.dds_multicast:
+        parts.append("no multicast")
+    if cfg.dds_max_participants is not None:
+        parts.append(f"max {cfg.dds_max_participants} participants")
+    if cfg.dds_shared_memory is not None:
+        parts.append(f"shared memory {'on' if cfg.dds_shared_memory else 'off'}")
+    if cfg.dds_socket_buffer_size is not None:
+        parts.append(f"{cfg.dds_socket_buffer_size} socket buffers")
+    return ", ".join(parts)
+
+
+def dds_discovery_server(cfg: BuildConfig) -> tuple[str, int]:
+    """Host and port of the Fast DDS discovery server."""
+    host, _, port = cfg.dds_discovery_server.partition(":")
+    return host, int(port) if port else DDS_DEFAULT_DISCOVERY_PORT
+
+
+def cyclonedds_profile(cfg: BuildConfig) -> str:
+    """Cyclone DDS configuration (CYCLONEDDS_URI) for the [dds] settings."""
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8" ?>',
+        "<!-- Generated by build.py from the [dds] section of the build config -->",
+        f'<CycloneDDS xmlns="{CYCLONEDDS_NAMESPACE}">',
+        '    <Domain Id="any">',
+        "        <General>",
+        f"            <AllowMulticast>{'default' if cfg.dds_multicast else 'false'}</AllowMulticast>",
+        "        </General>",
+        "        <Discovery>",
+    ]
+    if cfg.dds_max_participants is not None:
+        lines += [
+            "            <ParticipantIndex>auto</ParticipantIndex>",
+            f"            <MaxAutoParticipantIndex>{cfg.dds_max_participants - 1}</MaxAutoParticipantIndex>",
+        ]
+    if cfg.dds_peers:
+        lines.append("            <Peers>")
+        lines += [f'                <Peer address="{peer}"/>' for peer in cfg.dds_peers]
+        lines.append("            </Peers>")
+    lines.append("        </Discovery>")
+    if cfg.dds_socket_buffer_size is not None:
+        size = parse_size(cfg.dds_socket_buffer_size)
+        lines += [
+            "        <Internal>",
+            f'            <SocketReceiveBufferSize min="{size}B"/>',
+            f'            <SocketSendBufferSize min="{size}B"/>',
+            "        </Internal>",
+        ]
+    lines += ["    </Domain>", "</CycloneDDS>"]
+    return "\n".join(lines) + "\n"
+
+
+def fastdds_profile(cfg: BuildConfig) -> str:
+    """Fast DDS default participant profile (FASTRTPS_DEFAULT_PROFILES_FILE) for the [dds] settings."""
+    udp = ["<transport_id>udp_transport</transport_id>", "<type>UDPv4</type>"]
+    if cfg.dds_socket_buffer_size is not None:
+        size = parse_size(cfg.dds_socket_buffer_size)
+        udp += [f"<sendBufferSize>{size}</sendBufferSize>", f"<receiveBufferSize>{size}</receiveBufferSize>"]
+    # Fast DDS uses shared memory between local participants unless told otherwise
+    shared_memory = cfg.dds_shared_memory is not False
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8" ?>',
+        "<!-- Generated by build.py from the [dds] section of the build config -->",
+        f'<profiles xmlns="{FASTDDS_NAMESPACE}">',
+        "    <transport_descriptors>",
+        "        <transport_descriptor>",
+        *[f"            {line}" for line in udp],
+        "        </transport_descriptor>",
+    ]
+    if shared_memory:
+        lines += [
+            "        <transport_descriptor>",
+            "            <transport_id>shm_transport</transport_id>",
+            "            <type>SHM</type>",
+            "        </transport_descriptor>",
+        ]
+    lines += [
+        "    </transport_descriptors>",
+        '    <participant profile_name="turtlebot3" is_default_profile="true">',
+        "        <rtps>",
+        "            <userTransports>",
+        "                <transport_id>udp_transport</transport_id>",
+    ]
+    if shared_memory:
+        lines.append("                <transport_id>shm_transport</transport_id>")
+    lines += [
+        "            </userTransports>",
+        "            <useBuiltinTransports>false</useBuiltinTransports>",
+    ]
+    if cfg.dds_peers or cfg.dds_discovery_server or not cfg.dds_multicast:
+        lines.append("            <builtin>")
+        if cfg.dds_discovery_server:
+            host, port = dds_discovery_server(cfg)
+            lines += [
+                "                <discovery_config>",
+                "                    <discoveryProtocol>CLIENT</discoveryProtocol>",
+                "                    <discoveryServersList>",
+                f'                        <RemoteServer prefix="{FASTDDS_SERVER_PREFIX}">',
+                "                            <metatrafficUnicastLocatorList>",
+                "                                <locator><udpv4>"
+                f"<address>{host}</address><port>{port}</port></udpv4></locator>",
+                "                            </metatrafficUnicastLocatorList>",
+                "                        </RemoteServer>",
+                "                    </discoveryServersList>",
+                "                </discovery_config>",
+            ]
+        if cfg.dds_peers:
+            lines.append("                <initialPeersList>")
+            for peer in cfg.dds_peers:
+                lines.append(f"                    <locator><udpv4><address>{peer}</address></udpv4></locator>")
+            lines.append("                </initialPeersList>")
+        if not cfg.dds_multicast:
+            # An explicit unicast metatraffic locator stops Fast DDS from listening on multicast
+            lines += [
+                "                <metatrafficUnicastLocatorList>",
+                "                    <locator/>",
+                "                </metatrafficUnicastLocatorList>",
+            ]
+        lines.append("            </builtin>")
+    if cfg.dds_max_participants is not None:
+        lines += [
+            "            <allocation>",
+            "                <total_participants>",
+            "                    <initial>0</initial>",
+            f"                    <maximum>{cfg.dds_max_participants}</maximum>",
+            "                    <increment>1</increment>",
+            "                </total_participants>",
+            "            </allocation>",
+        ]
+    lines += ["        </rtps>", "    </participant>", "</profiles>"]
+    return "\n".join(lines) + "\n"
+
+
+def dds_profile(cfg: BuildConfig) -> tuple[str, str]:
+    """Return the file name and XML of the middleware profile for a build."""
+    if cfg.dds_middleware == "cyclonedds":
+        return "cyclonedds.xml", cyclonedds_profile(cfg)
+    return "fastdds.xml", fastdds_profile(cfg)
+
+
+def check_dds_profile(cfg: BuildConfig, profile: str) -> None:
+    """Parse a generated profile and check it carries every [dds] setting."""
+    try:
+        root = ElementTree.fromstring(profile)
+    except ElementTree.ParseError as e:
+        raise BuildError(f"Generated {cfg.dds_middleware} profile is not valid XML: {e}") from None
+
+    if cfg.dds_middleware == "cyclonedds":
+        ns = {"c": CYCLONEDDS_NAMESPACE}
+        if root.tag != f"{{{CYCLONEDDS_NAMESPACE}}}CycloneDDS":
+            raise BuildError(f"Generated cyclonedds profile has root element {root.tag}")
+        peers = [peer.get("address") for peer in root.findall("c:Domain/c:Discovery/c:Peers/c:Peer", ns)]
+        servers = []
+        limit = root.findtext("c:Domain/c:Discovery/c:MaxAutoParticipantIndex", namespaces=ns)
+        limit = int(limit) + 1 if limit is not None else None
+        buffer_paths = ["c:Domain/c:Internal/c:SocketReceiveBufferSize", "c:Domain/c:Internal/c:SocketSendBufferSize"]
+        buffers = [int(e.get("min", "0B").removesuffix("B")) for path in buffer_paths for e in root.findall(path, ns)]
+    else:
+        ns = {"f": FASTDDS_NAMESPACE}
+        if root.tag != f"{{{FASTDDS_NAMESPACE}}}profiles":
+            raise BuildError(f"Generated fastdds profile has root element {root.tag}")
+        participants = root.findall("f:participant[@is_default_profile='true']", ns)
+        if len(participants) != 1:
+            raise BuildError("Generated fastdds profile must have exactly one default participant profile")
+        rtps = participants[0].find("f:rtps", ns)
+        transports = {d.findtext("f:transport_id", namespaces=ns): d
+                      for d in root.findall("f:transport_descriptors/f:transport_descriptor", ns)}
+        used = [t.text for t in rtps.findall("f:userTransports/f:transport_id", ns)]
+        missing = [transport for transport in used if transport not in transports]
+        if missing:
+            raise BuildError(f"Generated fastdds profile uses undefined transports: {', '.join(missing)}")
+        peers = [a.text for a in rtps.findall("f:builtin/f:initialPeersList/f:locator/f:udpv4/f:address", ns)]
+        discovery = rtps.find("f:builtin/f:discovery_config", ns)
+        servers = []
+        if discovery is not None:
+            if discovery.findtext("f:discoveryProtocol", namespaces=ns) != "CLIENT":
+                raise BuildError("Generated fastdds profile configures discovery servers without the CLIENT protocol")
+            locators = "f:discoveryServersList/f:RemoteServer/f:metatrafficUnicastLocatorList/f:locator/f:udpv4"
+            servers = [(u.findtext("f:address", namespaces=ns), int(u.findtext("f:port", namespaces=ns)))
+                       for u in discovery.findall(locators, ns)]
+        limit = rtps.findtext("f:allocation/f:total_participants/f:maximum", namespaces=ns)
+        limit = int(limit) if limit is not None else None
+        buffers = [int(e.text) for d in transports.values()
+                   for e in d if e.tag in (f"{{{FASTDDS_NAMESPACE}}}sendBufferSize",
+                                           f"{{{FASTDDS_NAMESPACE}}}receiveBufferSize")]
+
+    if peers != cfg.dds_peers:
+        raise BuildError(f"Generated {cfg.dds_middleware} profile lists peers {peers}, expected {cfg.dds_peers}")
+    expected_servers = [dds_discovery_server(cfg)] if cfg.dds_discovery_server else []
+    if servers != expected_servers:
+        raise BuildError(f"Generated {cfg.dds_middleware} profile lists discovery servers {servers}, "
+                         f"expected {expected_servers}")
+    if limit != cfg.dds_max_participants:
+        raise BuildError(f"Generated {cfg.dds_middleware} profile limits participants to {limit}, "
+                         f"expected {cfg.dds_max_participants}")
+    expected_size = parse_size(cfg.dds_socket_buffer_size) if cfg.dds_socket_buffer_size is not None else None
+    if (buffers and set(buffers) != {expected_size}) or (expected_size is not None and len(buffers) != 2):
+        raise BuildError(f"Generated {cfg.dds_middleware} profile sets socket buffers {buffers}, "
+                         f"expected {expected_size}")
+
+
+def dds_setup(cfg: BuildConfig) -> dict:
+    """Settings 45_dds_setup.sh installs: the profile, its environment and socket buffer limits."""
+    if cfg.dds_middleware == "default":
+        return {}
+    name, profile = dds_profile(cfg)
+    path = f"{DDS_PROFILE_DIR}/{name}"
+    environment = {"RMW_IMPLEMENTATION": DDS_MIDDLEWARES[cfg.dds_middleware]}
+    if cfg.dds_middleware == "cyclonedds":
+        environment["CYCLONEDDS_URI"] = f"file://{path}"
+    else:
+        # Fast DDS 2.x reads the FASTRTPS_ name, later releases the FASTDDS_ one
+        environment["FASTRTPS_DEFAULT_PROFILES_FILE"] = path
+        environment["FASTDDS_DEFAULT_PROFILES_FILE"] = path
+    return {
+        "path": path,
+        "profile": profile,
+        "environment": environment,
+        "socket_buffer_size": parse_size(cfg.dds_socket_buffer_size) if cfg.dds_socket_buffer_size else 0,
+    }
+
+
+def packer_variables(cfg: BuildConfig, source_image_path: Path, image_checksum: str) -> dict[str, str]:
+    """Return the user variables passed to the Packer template."""
+    build_subdir = get_build_subdirectory(cfg)
+    return {
+        "NAME": cfg.name,
+        "VERSION": cfg.computed_version,
+        "SKIP_COMPRESSION": str(cfg.compression == "none").lower(),
+        "SKIP_SPARSE": str(cfg.skip_sparse).lower(),
+        "OPENCR_MODEL": cfg.opencr_model,
+        "TURTLEBOT3_MODEL": cfg.turtlebot3_model,
+        "ADD_CONNECTION": str(cfg.add_connection).lower(),
+        "NETWORKS": json.dumps([{'ssid': net.ssid, 'password': net.password} for net in cfg.networks]),
+        "USERNAME": cfg.username,
+        "USER_PASSWORD": cfg.user_password,
+        "LIDAR": cfg.lidar,
+        "ROS_DOMAIN_ID": str(cfg.ros_domain_id),
+        "ROS_DISTRO": cfg.ros_distro,
+        "BUILD_SUBDIR": build_subdir.name,
+        "SOURCE_IMAGE_PATH": str(source_image_path),
+        "IMAGE_CHECKSUM": image_checksum,
+        "IMAGE_SIZE": cfg.image_size,
+        "BOOT_SIZE": cfg.boot_size,
+        "BUILD_JOBS": str(cfg.compile_jobs),
+        "SLIM_IMAGE": str(cfg.slim_image).lower(),
+        "SLIM_PATHS": " ".join(cfg.slim_paths),
+        "DDS_CONFIG": json.dumps(dds_setup(cfg)),
+    }
+
+
+def run_packer(cfg: BuildConfig, packer_file: str, variables: dict[str, str],
+               log_path: Optional[Path] = None, metrics: Optional["BuildMetrics"] = None,
+               stage: str = "packer") -> None:
+    """Run Packer in the builder container with the given template and variables.
+
+    With ``metrics``, Packer output is parsed into timed phases recorded under ``stage``.
+    """
+    build_subdir = get_build_subdirectory(cfg)
+    cmd = [
+        "sudo", "podman", "run", "--rm", "--privileged",
+        "--pid=host",
+        "-v", "/dev:/dev",
+        "-v", f"{os.getcwd()}:/build",
+    ]
+    if log_path:
+        cmd += ["-e", f"PACKER_CACHE_DIR=/build/{build_subdir}/packer_cache"]
+    cmd += [cfg.packer_builder_image, "build"]
+    for name, value in variables.items():
+        cmd += ["-var", f"{name}={value}"]
+    cmd.append(str(packer_file))
+
+    if cfg.verbose:
+        print(f"Running command: {' '.join(cmd)}")
+
+    if metrics is None:
+        run_process(cmd, log_path=log_path)
+        return
+    metrics.begin_stage(stage)
+    try:
+        run_process(cmd, log_path=log_path, on_line=metrics.feed)
+    finally:
+        metrics.end_stage()
+
+
+def run_packer_build(cfg: BuildConfig, packer_file: str, source_image_path: Path, offline: bool = False,
+                     log_path: Optional[Path] = None, resume: bool = False) -> "BuildMetrics":
+    """Run the Packer build and return its timing and resource metrics.
+
+    When ``log_path`` is given, Packer output is written there and Packer uses
+    a cache directory inside the build subdirectory, so several builds can run
+    side by side. With ``base_image_cache`` enabled the build is split into a
+    cached base image and a per-robot overlay build. With ``checkpoints`` (or
+    ``resume``) each provisioner script runs as its own stage and the image is
+    checkpointed after it. The metrics are also written to
+    ``build_metrics.json`` in the build subdirectory, including for failed
+    builds.
+    """
+    build_subdir = get_build_subdirectory(cfg)
+    template = load_packer_template(packer_file)
+    working_source = None
+    if source_image_path.suffix == ".img":
+        # Decompressed source from the cache: hand Packer a reflink/sparse copy of it
+        template = derive_raw_source_template(template)
+        expected_checksum = read_verified_digest(source_image_path) or file_sha256(source_image_path)
+        working_source = build_subdir / "source.img"
+        working_source.unlink(missing_ok=True)
+        method = clone_file(source_image_path, working_source)
+        print(f"Source image: {working_source} ({method} of {source_image_path})")
+        source_image_path = working_source
+    else:
+        # Get the checksum for the source image (served from the shared manifest index)
+        url_path = Path(cfg.source_url)
+        filename = url_path.name
+        try:
+            expected_checksum = get_expected_checksum(cfg.checksum_url, filename, offline=offline)
+            print(f"Using checksum: {expected_checksum}")
+        except BuildError as e:
+            print(f"Warning: Could not fetch checksum: {e}")
+            expected_checksum = ""
+    
+    variables = packer_variables(cfg, source_image_path, expected_checksum)
+    mounts = chroot_cache_mounts(cfg)
+    artifacts = plan_artifacts(cfg, template, offline=offline) if cfg.artifact_cache else []
+    if artifacts:
+        variables.update(artifact_variables(artifacts))
+    metrics = BuildMetrics(build_subdir)
+    metrics.build_jobs = cfg.compile_jobs
+    status = "failed"
+    checkpointed = cfg.checkpoints or resume
+    if checkpointed and cfg.base_image_cache:
+        print("Note: checkpoints are not used with base_image_cache; the base image is cached instead")
+        checkpointed = False
+    try:
+        if cfg.base_image_cache:
+            run_layered_build(cfg, template, variables, source_image_path, expected_checksum,
+                              mounts=mounts, log_path=log_path, metrics=metrics)
+        elif checkpointed:
+            run_checkpointed_build(cfg, template, variables, expected_checksum, mounts=mounts,
+                                   log_path=log_path, metrics=metrics, resume=resume)
+        elif mounts or working_source:
+            rendered_path = build_subdir / "packer.json"
+            write_packer_template(add_chroot_mounts(template, mounts), rendered_path)
+            run_packer(cfg, str(rendered_path), variables, log_path=log_path, metrics=metrics)
+        else:
+            run_packer(cfg, packer_file, variables, log_path=log_path, metrics=metrics)
+        post_process_image(cfg, metrics=metrics)
+        status = "success"
+    except KeyboardInterrupt:
+        status = "interrupted"
+        raise
+    finally:
+        metrics.write(build_subdir / "build_metrics.json", status)
+        if working_source:
+            working_source.unlink(missing_ok=True)
+    if artifacts:
+        record_artifacts(cfg, artifacts, stored=True)
+    return metrics
+
+
+METRICS_SAMPLE_INTERVAL = 2.0
+
+# Packer output that starts a new timed phase, and the phase kind it starts. Post-processing
+# runs in build.py after Packer and is timed as its own "post-process" stage.
+PACKER_PHASE_PATTERNS = [
+    (re.compile(r"Provisioning with shell script: (\S+)"), "provisioner"),
+    (re.compile(r"Uploading (\S+) =>"), "upload"),
+]
+
+
+@dataclass
+class PhaseMetrics:
+    """Wall time and resource peaks of one phase of a Packer run."""
+    stage: str
+    kind: str
+    name: str
+    started: float
+    seconds: float = 0.0
+    peak_memory_bytes: int = 0
+    peak_disk_used_bytes: int = 0
+    peak_build_dir_bytes: int = 0
+
+
+def host_memory_used() -> int:
+    """Return the memory in use on the host, in bytes."""
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f}
+        return info["MemTotal"] - info["MemAvailable"]
+    except (OSError, KeyError, ValueError):
+        return 0
+
+
+def allocated_bytes(path: Path) -> int:
+    """Return the disk space allocated to the files under a directory."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+class BuildMetrics:
+    """Timed phases of the Packer runs of a build, parsed from Packer output.
+
+    A background thread samples host memory in use, used space on the build
+    filesystem and the size of the build subdirectory, and keeps the peak of
+    each for the current phase. The builder runs in a separate container
+    process tree, so memory is measured host-wide rather than per process.
+    """
+
+    def __init__(self, build_subdir: Path) -> None:
+        self.build_subdir = build_subdir
+        self.started = time.time()
+        self.phases: List[PhaseMetrics] = []
+        self.current: Optional[PhaseMetrics] = None
+        self.stage = ""
+        self.post_process: Optional[dict] = None
+        self.build_jobs: Optional[int] = None
+        self.slim: Optional[dict] = None
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def begin_stage(self, stage: str, kind: str = "builder", name: str = "builder") -> None:
+        """Start timing a stage; for Packer runs, output before the first provisioner is the builder phase."""
+        self.stage = stage
+        self.start_phase(kind, name)
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def end_stage(self) -> None:
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        with self.lock:
+            self._close_phase()
+
+    def feed(self, line: str) -> None:
+        """Start a new phase if a line of Packer output marks one."""
+        for pattern, kind in PACKER_PHASE_PATTERNS:
+            match = pattern.search(line)
+            if not match:
+                continue
+            if kind == "provisioner":
+                name = Path(match.group(1)).name
+                name = "inline" if name.startswith("packer-shell") else name
+            else:
+                name = match.group(1)
+            if self.current is None or (self.current.kind, self.current.name) != (kind, name):
+                self.start_phase(kind, name)
+            return
+
+    def start_phase(self, kind: str, name: str) -> None:
+        with self.lock:
+            self._close_phase()
+            self.current = PhaseMetrics(stage=self.stage, kind=kind, name=name, started=time.time())
+            self.phases.append(self.current)
+        self._sample()
+
+    def _close_phase(self) -> None:
+        if self.current:
+            self.current.seconds = time.time() - self.current.started
+            self.current = None
+
+    def _sample(self) -> None:
+        memory = host_memory_used()
+        disk_used = shutil.disk_usage(self.build_subdir).used
+        build_dir = allocated_bytes(self.build_subdir)
+        with self.lock:
+            if self.current:
+                self.current.peak_memory_bytes = max(self.current.peak_memory_bytes, memory)
+                self.current.peak_disk_used_bytes = max(self.current.peak_disk_used_bytes, disk_used)
+                self.current.peak_build_dir_bytes = max(self.current.peak_build_dir_bytes, build_dir)
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(METRICS_SAMPLE_INTERVAL):
+            self._sample()
+
+    def to_dict(self, status: str) -> dict:
+        phases = [
+            {**phase.__dict__, "started": round(phase.started - self.started, 3), "seconds": round(phase.seconds, 3)}
+            for phase in self.phases
+        ]
+        return {
+            "status": status,
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 3),
+            "peak_memory_bytes": max((p.peak_memory_bytes for p in self.phases), default=0),
+            "peak_disk_used_bytes": max((p.peak_disk_used_bytes for p in self.phases), default=0),
+            "peak_build_dir_bytes": max((p.peak_build_dir_bytes for p in self.phases), default=0),
+            "build_jobs": self.build_jobs,
+            "phases": phases,
+            "slim": self.slim,
+            "post_process": self.post_process,
+        }
+
+    def write(self, path: Path, status: str) -> None:
+        with self.lock:
+            record = self.to_dict(status)
+        with open(path, "w") as f:
+            json.dump(record, f, indent=2)
+            f.write("\n")
+
+
+def format_bytes(size: int) -> str:
+    """Format a byte count with a binary unit, e.g. "3.2G"."""
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+POSTPROCESS_BLOCK_SIZE = 4096
+POSTPROCESS_CHUNK_SIZE = 4 * 1024 * 1024
+POSTPROCESS_QUEUE_CHUNKS = 8
+ZSTD_SEEKABLE_FRAME_SIZE = 8 * 1024 * 1024
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_ZERO_CHUNK = bytes(POSTPROCESS_CHUNK_SIZE)
+_ZERO_BLOCK = bytes(POSTPROCESS_BLOCK_SIZE)
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_long, ctypes.c_long]
+
+
+@dataclass
+class PostProcessResult:
+    """Outcome of the single-pass post-processing of a built image."""
+    image_size: int
+    bytes_read: int
+    mapped_bytes: int
+    punched_bytes: int
+    seconds: float
+    ranges: List[tuple[int, int, str]] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+
+
+def zero_block_runs(chunk: bytes, block_size: int = POSTPROCESS_BLOCK_SIZE):
+    """Yield (is_zero, start, end) for the runs of all-zero and data blocks in a buffer."""
+    if chunk == _ZERO_CHUNK[:len(chunk)]:
+        yield True, 0, len(chunk)
+        return
+    view = memoryview(chunk)
+    runs = itertools.groupby(
+        range(0, len(chunk), block_size),
+        key=lambda i: view[i:i + block_size] == _ZERO_BLOCK[:len(view[i:i + block_size])]
+    )
+    for is_zero, blocks in runs:
+        blocks = list(blocks)
+        yield is_zero, blocks[0], min(blocks[-1] + block_size, len(chunk))
+
+
+def punch_hole(fd: int, offset: int, length: int) -> None:
+    """Deallocate a byte range of a file, keeping its size (reads return zeros)."""
+    if _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class _CompressorPipe:
+    """Feeds image data to a compressor process from a background thread.
+
+    Reading, zero detection and hashing carry on while the compressor works
+    through the queued chunks.
+    """
+
+    def __init__(self, cmd: List[str], output_path: Path) -> None:
+        self.output = open(output_path, "wb")
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.output, preexec_fn=os.setpgrp)
+        with _active_processes_lock:
+            _active_processes.add(self.process)
+        self.queue: queue.Queue = queue.Queue(maxsize=POSTPROCESS_QUEUE_CHUNKS)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self) -> None:
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.process.stdin.write(data)
+                except OSError as e:
+                    self.error = e
+
+    def write(self, data) -> None:
+        if self.error is not None:
+            raise BuildError(f"Compressor failed: {self.error}")
+        self.queue.put(data)
+
+    def close(self, abort: bool = False) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        if abort:
+            self.process.terminate()
+        self.process.wait()
+        with _active_processes_lock:
+            _active_processes.discard(self.process)
+        self.output.close()
+        if not abort and (self.error is not None or self.process.returncode != 0):
+            raise BuildError(f"Compressor exited with status {self.process.returncode}")
+
+
+def compressor_command(codec: str, level: Optional[int] = None, threads: bool = True) -> List[str]:
+    """Command that compresses stdin to stdout with the given codec."""
+    if codec == "xz":
+        cmd = ["xz", "-c"]
+    elif codec in ("zstd", "zstd-seekable"):
+        cmd = ["zstd", "-c", "-q"]
+        if level is not None and level > 19:
+            cmd.append("--ultra")
+    else:
+        raise BuildError(f"No compressor for codec: {codec}")
+    if threads:
+        cmd.append("-T0")
+    if level is not None:
+        cmd.append(f"-{level}")
+    return cmd
+
+
+def decompressor_command(codec: str, sparse: bool = False) -> List[str]:
+    """Command that decompresses stdin to stdout; plain zstd also reads the seekable format.
+
+    xz already writes holes when stdout is a regular file; ``sparse`` asks zstd to do the same.
+    """
+    if codec == "xz":
+        return ["xz", "-dc", "-T0"]
+    if codec in ("zstd", "zstd-seekable"):
+        return ["zstd", "-dc", "-q"] + (["--sparse"] if sparse else [])
+    raise BuildError(f"No decompressor for codec: {codec}")
+
+
+class _SeekableZstdWriter:
+    """Writes the zstd seekable format: independent frames followed by a seek table.
+
+    Each frame is compressed by its own zstd process, several at a time, and
+    the frames are written in order. The seek table is a skippable frame, so
+    the output still decompresses with plain ``zstd -d``.
+    """
+
+    def __init__(self, output_path: Path, level: Optional[int] = None) -> None:
+        self.output = open(output_path, "wb")
+        self.cmd = compressor_command("zstd-seekable", level, threads=False)
+        self.workers = os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending: List[tuple[int, object]] = []
+        self.buffer = bytearray()
+        self.frames: List[tuple[int, int]] = []
+
+    def _compress(self, frame: bytes) -> bytes:
+        return subprocess.run(self.cmd, input=frame, capture_output=True, check=True).stdout
+
+    def _submit(self, frame: bytes) -> None:
+        self.pending.append((len(frame), self.pool.submit(self._compress, frame)))
+        while len(self.pending) > self.workers * 2:
+            self._write_next()
+
+    def _write_next(self) -> None:
+        size, future = self.pending.pop(0)
+        try:
+            data = future.result()
+        except subprocess.CalledProcessError as e:
+            raise BuildError(f"zstd failed: {e.stderr.decode().strip()}") from None
+        self.output.write(data)
+        self.frames.append((len(data), size))
+
+    def write(self, data) -> None:
+        self.buffer += data
+        while len(self.buffer) >= ZSTD_SEEKABLE_FRAME_SIZE:
+            frame = bytes(self.buffer[:ZSTD_SEEKABLE_FRAME_SIZE])
+            del self.buffer[:ZSTD_SEEKABLE_FRAME_SIZE]
+            self._submit(frame)
+
+    def close(self, abort: bool = False) -> None:
+        try:
+            if abort:
+                self.pool.shutdown(cancel_futures=True)
+                return
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._write_next()
+            # Seek table without per-frame checksums (descriptor flag 0)
+            entries = b"".join(struct.pack("<II", compressed, size) for compressed, size in self.frames)
+            footer = struct.pack("<IBI", len(self.frames), 0, ZSTD_SEEKABLE_MAGIC)
+            self.output.write(struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(entries) + len(footer)))
+            self.output.write(entries + footer)
+            self.pool.shutdown()
+        finally:
+            self.output.close()
+
+
+def open_compressor(codec: str, level: Optional[int], output_path: Path):
+    """Start compressing to ``output_path``; the result has write(data) and close(abort)."""
+    if codec == "zstd-seekable":
+        return _SeekableZstdWriter(output_path, level)
+    return _CompressorPipe(compressor_command(codec, level), output_path)
+
+
+def stream_image(image_path: Path, compressed_path: Optional[Path] = None, sparsify: bool = True,
+                 codec: str = "xz", level: Optional[int] = None) -> PostProcessResult:
+    """Post-process an image in one pass over its data extents.
+
+    Holes are skipped using SEEK_DATA/SEEK_HOLE and fed to the compressor as
+    zeros without being read. With ``sparsify``, all-zero blocks inside data
+    extents are punched out of the image and the remaining blocks are
+    collected into bmap ranges with their SHA-256, while the same data is
+    streamed to the compressor.
+    """
+    began = time.monotonic()
+    ranges: List[tuple[int, int, str]] = []
+    bytes_read = 0
+    punched = 0
+    pipe = open_compressor(codec, level, compressed_path) if compressed_path else None
+    block_size = POSTPROCESS_BLOCK_SIZE
+    try:
+        with open(image_path, "r+b" if sparsify else "rb") as f:
+            fd = f.fileno()
+            size = os.fstat(fd).st_size
+            position = 0
+            sparsify_holes = sparsify
+
+            def punch(start: int, end: int) -> int:
+                nonlocal sparsify_holes
+                if sparsify_holes:
+                    try:
+                        punch_hole(fd, start, end - start)
+                        return end - start
+                    except OSError as e:
+                        print(f"Warning: Could not punch holes in {image_path}: {e}")
+                        sparsify_holes = False
+                return 0
+
+            def emit_zeros(length: int) -> None:
+                while length > 0:
+                    piece = min(length, POSTPROCESS_CHUNK_SIZE)
+                    pipe.write(_ZERO_CHUNK if piece == POSTPROCESS_CHUNK_SIZE else _ZERO_CHUNK[:piece])
+                    length -= piece
+
+            for start, end in data_extents(fd, size):
+                if pipe:
+                    emit_zeros(start - position)
+                run_start: Optional[int] = None
+                run_hash = None
+                zero_start: Optional[int] = None
+                offset = start
+                while offset < end:
+                    chunk = os.pread(fd, min(POSTPROCESS_CHUNK_SIZE, end - offset), offset)
+                    if not chunk:
+                        raise BuildError(f"Unexpected end of file while reading {image_path}")
+                    bytes_read += len(chunk)
+                    if pipe:
+                        pipe.write(chunk)
+                    if sparsify:
+                        view = memoryview(chunk)
+                        for is_zero, first, last in zero_block_runs(chunk, block_size):
+                            if is_zero:
+                                if run_start is not None:
+                                    ranges.append((run_start, (offset + first) // block_size - 1, run_hash.hexdigest()))
+                                    run_start = None
+                                if zero_start is None:
+                                    zero_start = offset + first
+                            else:
+                                if zero_start is not None:
+                                    punched += punch(zero_start, offset + first)
+                                    zero_start = None
+                                if run_start is None:
+                                    run_start = (offset + first) // block_size
+                                    run_hash = hashlib.sha256()
+                                run_hash.update(view[first:last])
+                    offset += len(chunk)
+                if run_start is not None:
+                    ranges.append((run_start, (end - 1) // block_size, run_hash.hexdigest()))
+                if zero_start is not None:
+                    punched += punch(zero_start, end)
+                position = end
+            if pipe:
+                emit_zeros(size - position)
+    except BaseException:
+        if pipe:
+            pipe.close(abort=True)
+            compressed_path.unlink(missing_ok=True)
+        raise
+    if pipe:
+        pipe.close()
+
+    mapped = sum((last - first + 1) * block_size for first, last, _ in ranges)
+    return PostProcessResult(
+        image_size=size,
+        bytes_read=bytes_read,
+        mapped_bytes=min(mapped, size),
+        punched_bytes=punched,
+        seconds=time.monotonic() - began,
+        ranges=ranges,
+    )
+
+
+def write_bmap(bmap_path: Path, image_size: int, ranges: List[tuple[int, int, str]],
+               block_size: int = POSTPROCESS_BLOCK_SIZE) -> None:
+    """Write a bmaptool 2.0 block map for an image with the given mapped (first, last, sha256) ranges."""
+    blocks_count = (image_size + block_size - 1) // block_size
+    mapped_count = sum(last - first + 1 for first, last, _ in ranges)
+    percent = mapped_count * 100 / blocks_count if blocks_count else 0
+    zero_checksum = "0" * 64
+    lines = [
+        '<?xml version="1.0" ?>',
+        "<!-- Block map of the useful (mapped) blocks of an image file. Only these",
+        "     blocks have to be copied to the target device. -->",
+        "",
+        '<bmap version="2.0">',
+        f"    <!-- Image size in bytes: {format_bytes(image_size)} -->",
+        f"    <ImageSize> {image_size} </ImageSize>",
+        "",
+        "    <!-- Size of a block in bytes -->",
+        f"    <BlockSize> {block_size} </BlockSize>",
+        "",
+        "    <!-- Count of blocks in the image file -->",
+        f"    <BlocksCount> {blocks_count} </BlocksCount>",
+        "",
+        f"    <!-- Count of mapped blocks: {format_bytes(mapped_count * block_size)} or {percent:.1f}% -->",
+        f"    <MappedBlocksCount> {mapped_count} </MappedBlocksCount>",
+        "",
+        "    <!-- Type of checksum used in this file -->",
+        "    <ChecksumType> sha256 </ChecksumType>",
+        "",
+        "    <!-- The checksum of this bmap file. When it is calculated, the value of",
+        '         the checksum has be zero (all ASCII "0" symbols). -->',
+        f"    <BmapFileChecksum> {zero_checksum} </BmapFileChecksum>",
+        "",
+        "    <!-- The block map which consists of elements which may either be a",
+        "         range of blocks or a single block. The 'chksum' attribute",
+        "         is the checksum of this blocks range. -->",
+        "    <BlockMap>",
+    ]
+    for first, last, digest in ranges:
+        blocks = f"{first}-{last}" if last != first else f"{first}"
+        lines.append(f'        <Range chksum="{digest}"> {blocks} </Range>')
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    text = "\n".join(lines)
+    checksum = hashlib.sha256(text.encode()).hexdigest()
+    bmap_path.write_text(text.replace(zero_checksum, checksum, 1))
+
+
+BMAP_MAX_RANGE_SIZE = 64 * 1024 * 1024
+
+
+def bmap_block_ranges(fd: int, size: int, block_size: int = POSTPROCESS_BLOCK_SIZE,
+                      max_range_size: int = BMAP_MAX_RANGE_SIZE) -> List[tuple[int, int]]:
+    """Return the (first, last) mapped block ranges of a file from its data extents.
+
+    Long extents are split so their hashes can be computed in parallel.
+    """
+    max_blocks = max(1, max_range_size // block_size)
+    ranges: List[tuple[int, int]] = []
+    for start, end in data_extents(fd, size):
+        first, last = start // block_size, (end - 1) // block_size
+        if ranges and first <= ranges[-1][1]:
+            first = ranges[-1][1] + 1
+        while first <= last:
+            ranges.append((first, min(last, first + max_blocks - 1)))
+            first += max_blocks
+    return ranges
+
+
+def _hash_block_range(fd: int, first: int, last: int, size: int,
+                      block_size: int = POSTPROCESS_BLOCK_SIZE) -> str:
+    sha256 = hashlib.sha256()
+    offset = first * block_size
+    end = min((last + 1) * block_size, size)
+    while offset < end:
+        data = os.pread(fd, min(HASH_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            raise BuildError("Unexpected end of file while hashing bmap range")
+        sha256.update(data)
+        offset += len(data)
+    return sha256.hexdigest()
+
+
+def generate_bmap(image_path: Path, bmap_path: Path, workers: Optional[int] = None) -> tuple[int, int]:
+    """Write a bmap for an existing image, mapping its data extents with SEEK_DATA/SEEK_HOLE.
+
+    Ranges are hashed in a thread pool (hashlib releases the GIL on large
+    buffers). Returns the image size and the mapped size in bytes.
+    """
+    with open(image_path, "rb") as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        block_ranges = bmap_block_ranges(fd, size)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            digests = list(pool.map(lambda r: _hash_block_range(fd, r[0], r[1], size), block_ranges))
+    ranges = [(first, last, digest) for (first, last), digest in zip(block_ranges, digests)]
+    write_bmap(bmap_path, size, ranges)
+    mapped = sum(min((last + 1) * POSTPROCESS_BLOCK_SIZE, size) - first * POSTPROCESS_BLOCK_SIZE
+                 for first, last, _ in ranges)
+    return size, mapped
+
+
+def take_ownership(path: Path) -> None:
+    """Make a file written by the root-owned builder container belong to the current user."""
+    if os.stat(path).st_uid != os.getuid():
+        run_process(["sudo", "chown", f"{os.getuid()}:{os.getgid()}", str(path)])
+
+
+def compressed_image_path(cfg: BuildConfig) -> Optional[Path]:
+    """Path of the compressed output image, or None when compression is off."""
+    if cfg.compression == "none":
+        return None
+    image_path = get_image_path(cfg)
+    return image_path.with_name(image_path.name + COMPRESSION_CODECS[cfg.compression])
+
+
+# MBR partition types of FAT filesystems and of Linux (ext) filesystems
+FAT_PARTITION_TYPES = {0x01, 0x04, 0x06, 0x0B, 0x0C, 0x0E}
+MBR_PARTITION_TYPES_EXT = {0x83}
+
+
+def image_data_bytes(image_path: Path) -> int:
+    """Bytes of an image file that are stored as data rather than holes."""
+    with open(image_path, "rb") as f:
+        return sum(end - start for start, end in data_extents(f.fileno(), os.fstat(f.fileno()).st_size))
+
+
+def free_fat_ranges(image_path: Path, partition: "Partition") -> List[tuple[int, int]]:
+    """Return the (offset, length) byte ranges of the free clusters of a FAT filesystem in an image."""
+    with open(image_path, "rb") as f:
+        f.seek(partition.offset)
+        boot = f.read(512)
+        if len(boot) < 512 or boot[510:512] != b"\x55\xaa":
+            raise BuildError(f"No FAT boot sector in partition {partition.index} of {image_path}")
+        sector_size, cluster_sectors, reserved, fat_count, root_entries, total16 = \
+            struct.unpack_from("<HBHBHH", boot, 11)
+        fat16_size, = struct.unpack_from("<H", boot, 22)
+        total32, fat32_size = struct.unpack_from("<II", boot, 32)
+        if sector_size not in (512, 1024, 2048, 4096) or not cluster_sectors or fat_count == 0:
+            raise BuildError(f"Unsupported FAT boot sector in partition {partition.index} of {image_path}")
+        fat_size = fat16_size or fat32_size
+        total_sectors = total16 or total32
+        data_start = reserved + fat_count * fat_size + (root_entries * 32 + sector_size - 1) // sector_size
+        cluster_count = (total_sectors - data_start) // cluster_sectors
+
+        f.seek(partition.offset + reserved * sector_size)
+        fat = f.read(fat_size * sector_size)
+
+    if cluster_count < 4085:
+        def entry(n: int) -> int:
+            value, = struct.unpack_from("<H", fat, n + n // 2)
+            return value >> 4 if n & 1 else value & 0xFFF
+    elif cluster_count < 65525:
+        entries16 = memoryview(fat).cast("H")
+        entry = entries16.__getitem__
+    else:
+        entries32 = memoryview(fat)[:len(fat) // 4 * 4].cast("I")
+        def entry(n: int) -> int:
+            return entries32[n] & 0x0FFFFFFF
+
+    cluster_bytes = cluster_sectors * sector_size
+    data_offset = partition.offset + data_start * sector_size
+    ranges: List[tuple[int, int]] = []
+    for cluster in range(2, cluster_count + 2):
+        if entry(cluster) != 0:
+            continue
+        offset = data_offset + (cluster - 2) * cluster_bytes
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + cluster_bytes)
+        else:
+            ranges.append((offset, cluster_bytes))
+    return ranges
+
+
+def discard_ext4_free_blocks(image_path: Path, partition: "Partition") -> None:
+    """Punch holes over the free blocks of an ext4 filesystem in an image with ``e2fsck -E discard``.
+
+    e2fsprogs turns discards on a regular file into hole punches, so no loop
+    device or root access is needed.
+    """
+    result = subprocess.run(["e2fsck", "-f", "-y", "-E", "discard", _ext4_spec(image_path, partition)],
+                            capture_output=True, text=True)
+    # Exit codes 1 and 2 mean errors were corrected
+    if result.returncode >= 4:
+        raise BuildError(f"e2fsck failed on partition {partition.index} of {image_path}: "
+                         f"{(result.stdout + result.stderr).strip()}")
+
+
+def slim_image(image_path: Path, metrics: Optional[BuildMetrics] = None) -> None:
+    """Deallocate the free space of the image's FAT and ext4 partitions.
+
+    The build-only files are removed inside the chroot by 90_slim_image.sh;
+    this drops the blocks they (and earlier deletions) left behind, so the
+    sparsify, compress and flash steps skip them.
+    """
+    if metrics:
+        metrics.begin_stage("slim", "post-processor", "discard")
+    began = time.monotonic()
+    try:
+        before = image_data_bytes(image_path)
+        for partition in read_partition_table(image_path):
+            if partition.type in FAT_PARTITION_TYPES:
+                ranges = free_fat_ranges(image_path, partition)
+                with open(image_path, "r+b") as f:
+                    for offset, length in ranges:
+                        punch_hole(f.fileno(), offset, length)
+            elif partition.type in MBR_PARTITION_TYPES_EXT:
+                discard_ext4_free_blocks(image_path, partition)
+        after = image_data_bytes(image_path)
+    finally:
+        if metrics:
+            metrics.end_stage()
+    seconds = time.monotonic() - began
+    print(f"Slimmed image: {before // POSTPROCESS_BLOCK_SIZE} -> {after // POSTPROCESS_BLOCK_SIZE} data blocks "
+          f"({format_bytes(before)} -> {format_bytes(after)}) in {seconds:.1f}s")
+    if metrics:
+        metrics.slim = {"data_bytes_before": before, "data_bytes_after": after, "seconds": round(seconds, 3)}
+
+
+def post_process_image(cfg: BuildConfig, metrics: Optional[BuildMetrics] = None) -> Optional[PostProcessResult]:
+    """Sparsify, map and compress the built image in a single pass.
+
+    Produces the compressed image and its bmap, e.g. ``.img.xz`` and
+    ``.img.xz.bmap`` (or the sparse ``.img`` and ``.img.bmap`` without
+    compression). Templates that still compress in a Packer post-processor
+    are left alone.
+    """
+    image_path = get_image_path(cfg)
+    if not image_path.exists():
+        if any(image_path.with_name(image_path.name + ext).exists() for ext in COMPRESSION_CODECS.values() if ext):
+            print("Image already post-processed by the Packer template")
+            return None
+        raise BuildError(f"Built image not found: {image_path}")
+
+    take_ownership(image_path)
+    if cfg.slim_image:
+        slim_image(image_path, metrics=metrics)
+    sparsify = not cfg.skip_sparse
+    compressed_path = compressed_image_path(cfg)
+    tmp_path = compressed_path.with_name(compressed_path.name + ".tmp") if compressed_path else None
+    print("Post-processing image: " + ", ".join(
+        step for step, enabled in [("sparsify", sparsify), ("bmap", sparsify), (cfg.compression, compressed_path)]
+        if enabled
+    ))
+    if metrics:
+        metrics.begin_stage("post-process", "post-processor", "single-pass")
+    try:
+        result = stream_image(image_path, tmp_path, sparsify=sparsify, codec=cfg.compression,
+                              level=cfg.compression_level)
+        if compressed_path:
+            os.replace(tmp_path, compressed_path)
+            result.outputs.append(str(compressed_path))
+        if sparsify:
+            bmap_path = (compressed_path or image_path).with_name((compressed_path or image_path).name + ".bmap")
+            write_bmap(bmap_path, result.image_size, result.ranges)
+            result.outputs.append(str(bmap_path))
+        if compressed_path:
+            image_path.unlink()
+        else:
+            result.outputs.insert(0, str(image_path))
+    finally:
+        if metrics:
+            metrics.end_stage()
+
+    print(f"Post-processing: read {format_bytes(result.bytes_read)} of a {format_bytes(result.image_size)} image, "
+          f"{format_bytes(result.mapped_bytes)} mapped, {format_bytes(result.punched_bytes)} zeros punched "
+          f"in {result.seconds:.1f}s")
+    if metrics:
+        metrics.post_process = {
+            "image_size": result.image_size,
+            "bytes_read": result.bytes_read,
+            "mapped_bytes": result.mapped_bytes,
+            "punched_bytes": result.punched_bytes,
+            "seconds": round(result.seconds, 3),
+            "outputs": result.outputs,
+        }
+    return result
+
+
+def print_build_metrics(metrics: BuildMetrics) -> None:
+    """Print the per-phase timing table of a build."""
+    if not metrics.phases:
+        return
+    width = max(len(f"{p.stage}/{p.name}") for p in metrics.phases)
+    print("\nBuild phases:")
+    print("-------------")
+    print(f"{'phase':<{width}}  {'seconds':>9}  {'memory':>8}  {'disk':>8}  {'build dir':>9}")
+    for phase in metrics.phases:
+        print(f"{phase.stage + '/' + phase.name:<{width}}  {phase.seconds:9.1f}  "
+              f"{format_bytes(phase.peak_memory_bytes):>8}  {format_bytes(phase.peak_disk_used_bytes):>8}  "
+              f"{format_bytes(phase.peak_build_dir_bytes):>9}")
+    total = sum(p.seconds for p in metrics.phases)
+    print(f"{'total':<{width}}  {total:9.1f}")
+    if metrics.build_jobs:
+        print(f"Compile jobs: {metrics.build_jobs}")
+
+
+# Where the builder mounts the image; fixed so host caches can be bind-mounted into the chroot
+CHROOT_MOUNT_PATH = "/tmp/tb3-chroot"
+
+
+def chroot_cache_mounts(cfg: BuildConfig) -> List[tuple[str, str]]:
+    """Host cache directories (relative to the repo) and where they appear in the chroot."""
+    mounts = []
+    if cfg.apt_cache:
+        mounts.append((APT_ARCHIVE_DIR, "/var/cache/apt/archives"))
+    if cfg.git_cache:
+        mounts.append((GIT_CACHE_DIR, "/var/cache/tb3-git"))
+    if cfg.artifact_cache:
+        mounts.append((ARTIFACT_CACHE_DIR, ARTIFACT_CHROOT_DIR))
+        mounts.append((CCACHE_CACHE_DIR, CCACHE_CHROOT_DIR))
+    for host_dir, _ in mounts:
+        Path(host_dir).mkdir(parents=True, exist_ok=True)
+    return mounts
+
+
+def add_chroot_mounts(template: dict, mounts: List[tuple[str, str]]) -> dict:
+    """Bind-mount host cache directories into the chroot around the provisioner scripts.
+
+    The mounts are added before the first script provisioner and removed after
+    the last one, and also by the error cleanup provisioner so a failed build
+    does not leave them behind.
+    """
+    if not mounts:
+        return template
+    rendered = copy.deepcopy(template)
+    rendered["builders"][0]["image_mount_path"] = CHROOT_MOUNT_PATH
+
+    mount_commands = []
+    for host_dir, chroot_dir in mounts:
+        mount_commands += [
+            f"mkdir -p {CHROOT_MOUNT_PATH}{chroot_dir}",
+            f"mount --bind /build/{host_dir} {CHROOT_MOUNT_PATH}{chroot_dir}",
+        ]
+    umount_commands = [f"umount {CHROOT_MOUNT_PATH}{chroot_dir}" for _, chroot_dir in reversed(mounts)]
+
+    provisioners = rendered["provisioners"]
+    script_indices = [i for i, p in enumerate(provisioners) if "scripts" in p]
+    first, last = script_indices[0], script_indices[-1]
+    rendered["provisioners"] = [
+        *provisioners[:first],
+        {"type": "shell-local", "inline": mount_commands},
+        *provisioners[first:last + 1],
+        {"type": "shell-local", "inline": umount_commands},
+        *provisioners[last + 1:],
+    ]
+    rendered["error-cleanup-provisioner"] = {
+        "type": "shell-local",
+        "inline": [f"umount -l {CHROOT_MOUNT_PATH}{chroot_dir} || true" for _, chroot_dir in reversed(mounts)],
+    }
+    return rendered
+
+
+# Config-specific provisioner scripts, run on top of the cached base image
+OVERLAY_SCRIPTS = ["scripts/45_dds_setup.sh", "scripts/80_add_connection.sh", "scripts/85_apply_overlay.sh",
+                   "scripts/90_slim_image.sh"]
+
+# Fixed values for the variables the overlay stage re-applies, so the base image
+# depends only on the inputs in its cache key
+BASE_IMAGE_VARIABLES = {
+    "ADD_CONNECTION": "false",
+    "NETWORKS": "[]",
+    "USER_PASSWORD": BuildConfig.user_password,
+    "LIDAR": BuildConfig.lidar,
+    "ROS_DOMAIN_ID": str(BuildConfig.ros_domain_id),
+}
+
+# Serialises base image builds of the same key within one process
+_base_image_locks: dict[str, threading.Lock] = {}
+_base_image_locks_guard = threading.Lock()
+
+
+def load_packer_template(packer_file: str) -> dict:
+    """Read a Packer JSON template."""
+    with open(packer_file) as f:
+        return json.load(f)
+
+
+def write_packer_template(template: dict, path: Path) -> None:
+    """Write a derived Packer JSON template."""
+    with open(path, "w") as f:
+        json.dump(template, f, indent=2)
+        f.write("\n")
+
+
+def hash_paths(paths: List[Path]) -> dict[str, str]:
+    """Return the SHA-256 of every file under the given files and directories."""
+    digests: dict[str, str] = {}
+    for path in paths:
+        files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        for file_path in files:
+            digests[file_path.as_posix()] = file_sha256(file_path)
+    return digests
+
+
+def _script_provisioners(template: dict) -> List[dict]:
+    return [p for p in template.get("provisioners", []) if "scripts" in p]
+
+
+def base_image_key(cfg: BuildConfig, template: dict, source_digest: str) -> tuple[str, dict]:
+    """Return the cache key of the base image for a build and the inputs it covers."""
+    base_scripts = [
+        script
+        for provisioner in _script_provisioners(template)
+        for script in provisioner["scripts"]
+        if script not in OVERLAY_SCRIPTS
+    ]
+    inputs = {
+        "source_digest": source_digest,
+        "ros_distro": cfg.ros_distro,
+        "model_type": cfg.model_type,
+        "username": cfg.username,
+        "image_size": cfg.image_size,
+        "boot_size": cfg.boot_size,
+        "builder": template["builders"],
+        "files": hash_paths([Path(script) for script in base_scripts] + [Path("files")]),
+    }
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:24]
+    return key, inputs
+
+
+def derive_base_template(template: dict, image_path: str) -> dict:
+    """Template that runs every provisioner except the overlay scripts and skips post-processing."""
+    base = copy.deepcopy(template)
+    base["builders"][0]["image_path"] = image_path
+    for provisioner in _script_provisioners(base):
+        provisioner["scripts"] = [s for s in provisioner["scripts"] if s not in OVERLAY_SCRIPTS]
+    base["provisioners"] = [p for p in base["provisioners"] if p.get("scripts", True)]
+    base.pop("post-processors", None)
+    return base
+
+
+def derive_raw_source_template(template: dict) -> dict:
+    """Template whose builder takes an already decompressed ``.img`` source."""
+    raw = copy.deepcopy(template)
+    builder = raw["builders"][0]
+    builder["file_target_extension"] = "img"
+    builder.pop("file_unarchive_cmd", None)
+    return raw
+
+
+def derive_overlay_template(template: dict) -> dict:
+    """Template that starts from a raw base image and runs only the overlay scripts."""
+    overlay = derive_raw_source_template(template)
+    overlay["builders"][0]["image_build_method"] = "reuse"
+
+    provisioners = overlay["provisioners"]
+    last_script_index = max(i for i, p in enumerate(provisioners) if "scripts" in p)
+    environment = provisioners[last_script_index].get("environment_vars", [])
+    overlay["provisioners"] = [
+        {"type": "shell", "environment_vars": environment, "scripts": list(OVERLAY_SCRIPTS)},
+        *provisioners[last_script_index + 1:],
+    ]
+    return overlay
+
+
+def ensure_base_image(cfg: BuildConfig, template: dict, variables: dict[str, str],
+                      source_image_path: Path, source_digest: str,
+                      mounts: Optional[List[tuple[str, str]]] = None,
+                      log_path: Optional[Path] = None,
+                      metrics: Optional[BuildMetrics] = None) -> tuple[Path, str]:
+    """Return the cached base image for a build, building it first if needed.
+
+    Base images are stored in ``.cache/base/<key>.img`` with a ``<key>.json``
+    record of the inputs and the image digest. The record is only written
+    once the base build has succeeded.
+    """
+    key, inputs = base_image_key(cfg, template, source_digest)
+    base_dir = get_cache_dir() / "base"
+    base_dir.mkdir(exist_ok=True)
+    image_path = base_dir / f"{key}.img"
+    record_path = base_dir / f"{key}.json"
+
+    with _base_image_locks_guard:
+        lock = _base_image_locks.setdefault(key, threading.Lock())
+    with lock, CacheLock(f"base-{key}"):
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+            if image_path.exists():
+                print(f"Using cached base image: {image_path}")
+                return image_path, record["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        print(f"Building base image: {image_path}")
+        build_subdir = get_build_subdirectory(cfg)
+        base_template_path = build_subdir / "packer_base.json"
+        base_template = add_chroot_mounts(derive_base_template(template, image_path.as_posix()), mounts or [])
+        write_packer_template(base_template, base_template_path)
+        base_variables = {**variables, **BASE_IMAGE_VARIABLES}
+        base_log = log_path.with_name("packer_base.log") if log_path else None
+        run_packer(cfg, str(base_template_path), base_variables, log_path=base_log,
+                   metrics=metrics, stage="base")
+
+        digest = file_sha256(image_path)
+        with open(record_path, "w") as f:
+            json.dump({"key": key, "sha256": digest, "created": time.time(), "inputs": inputs}, f, indent=2)
+        return image_path, digest
+
+
+def run_layered_build(cfg: BuildConfig, template: dict, variables: dict[str, str],
+                      source_image_path: Path, source_digest: str,
+                      mounts: Optional[List[tuple[str, str]]] = None,
+                      log_path: Optional[Path] = None,
+                      metrics: Optional[BuildMetrics] = None) -> None:
+    """Build from a cached base image, running only the config-specific overlay steps."""
+    if not source_digest:
+        source_digest = read_verified_digest(source_image_path) or file_sha256(source_image_path)
+    base_image_path, base_digest = ensure_base_image(
+        cfg, template, variables, source_image_path, source_digest, mounts=mounts, log_path=log_path,
+        metrics=metrics
+    )
+
+    build_subdir = get_build_subdirectory(cfg)
+    overlay_template_path = build_subdir / "packer_overlay.json"
+    write_packer_template(add_chroot_mounts(derive_overlay_template(template), mounts or []), overlay_template_path)
+    overlay_variables = {
+        **variables,
+        "SOURCE_IMAGE_PATH": base_image_path.as_posix(),
+        "IMAGE_CHECKSUM": base_digest,
+    }
+    print("Running overlay build on base image")
+    run_packer(cfg, str(overlay_template_path), overlay_variables, log_path=log_path,
+               metrics=metrics, stage="overlay")
+
+
+# Variables that name build-specific paths or only affect post-processing, left out of checkpoint keys
+CHECKPOINT_IGNORED_VARIABLES = {"SOURCE_IMAGE_PATH", "IMAGE_CHECKSUM", "BUILD_SUBDIR", "NAME", "VERSION",
+                                "SKIP_COMPRESSION", "SKIP_SPARSE", "BUILD_JOBS"}
+
+
+def checkpoint_steps(template: dict) -> List[List[dict]]:
+    """Split the template's provisioners into stages that each end with one provisioner script.
+
+    Inline and file provisioners run in the stage of the next script;
+    provisioners after the last script join the last stage.
+    """
+    steps: List[List[dict]] = []
+    pending: List[dict] = []
+    for provisioner in template.get("provisioners", []):
+        if "scripts" in provisioner:
+            for script in provisioner["scripts"]:
+                steps.append(pending + [{**provisioner, "scripts": [script]}])
+                pending = []
+        else:
+            pending.append(provisioner)
+    if pending:
+        if steps:
+            steps[-1].extend(pending)
+        else:
+            steps.append(pending)
+    return steps
+
+
+def checkpoint_step_name(step: List[dict]) -> str:
+    scripts = [script for p in step for script in p.get("scripts", [])]
+    return Path(scripts[-1]).name if scripts else "provisioners"
+
+
+def checkpoint_keys(cfg: BuildConfig, template: dict, variables: dict[str, str], source_digest: str,
+                    steps: List[List[dict]]) -> List[str]:
+    """Return the key of the checkpoint after each stage.
+
+    Each key chains the previous one with the stage's provisioners and the
+    files they use, so a checkpoint is only reused when everything before it
+    is identical.
+    """
+    builder = copy.deepcopy(template["builders"][0])
+    for key in ("image_path", "file_target_extension", "file_unarchive_cmd"):
+        builder.pop(key, None)
+    previous = hashlib.sha256(json.dumps({
+        "source_url": cfg.source_url,
+        "source_digest": source_digest,
+        "builder": builder,
+        "builder_image": cfg.packer_builder_digest or cfg.packer_builder_image,
+        "variables": {k: v for k, v in variables.items() if k not in CHECKPOINT_IGNORED_VARIABLES},
+    }, sort_keys=True).encode()).hexdigest()
+    keys = []
+    for step in steps:
+        paths = [Path(script) for p in step for script in p.get("scripts", [])]
+        paths += [Path(p["source"]) for p in step if p.get("type") == "file"]
+        previous = hashlib.sha256(json.dumps({
+            "previous": previous,
+            "provisioners": step,
+            "files": hash_paths(paths),
+        }, sort_keys=True).encode()).hexdigest()
+        keys.append(previous[:24])
+    return keys
+
+
+def derive_checkpoint_template(template: dict, step: List[dict], image_path: str, from_checkpoint: bool) -> dict:
+    """Template that runs one stage, starting from the source image or the previous checkpoint."""
+    staged = derive_raw_source_template(template) if from_checkpoint else copy.deepcopy(template)
+    builder = staged["builders"][0]
+    builder["image_path"] = image_path
+    if from_checkpoint:
+        # Checkpoints are local files written by this build; they are not re-hashed
+        builder["image_build_method"] = "reuse"
+        builder["file_checksum_type"] = "none"
+        builder.pop("file_checksum", None)
+    staged["provisioners"] = copy.deepcopy(step)
+    staged.pop("post-processors", None)
+    return staged
+
+
+def save_checkpoint(image_path: Path, checkpoint_dir: Path, key: str, index: int, name: str) -> Path:
+    """Copy the working image to a checkpoint (a reflink where supported)."""
+    checkpoint = checkpoint_dir / f"{key}.img"
+    tmp_path = checkpoint.with_name(checkpoint.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    method = clone_file(image_path, tmp_path)
+    os.replace(tmp_path, checkpoint)
+    with open(checkpoint.with_suffix(".json"), "w") as f:
+        json.dump({"key": key, "stage": index, "after": name, "created": time.time()}, f, indent=2)
+    print(f"Checkpoint after {name}: {checkpoint} ({method})")
+    return checkpoint
+
+
+def evict_checkpoints(checkpoint_dir: Path, budget: int, keep: set[str]) -> None:
+    """Delete the oldest checkpoints until their allocated size fits in the budget."""
+    checkpoints = sorted(checkpoint_dir.glob("*.img"), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_blocks * 512 for p in checkpoints)
+    for checkpoint in checkpoints:
+        if total <= budget:
+            break
+        if checkpoint.stem in keep:
+            continue
+        total -= checkpoint.stat().st_blocks * 512
+        checkpoint.unlink()
+        checkpoint.with_suffix(".json").unlink(missing_ok=True)
+        print(f"Evicted checkpoint {checkpoint.name} (checkpoint budget)")
+
+
+def run_checkpointed_build(cfg: BuildConfig, template: dict, variables: dict[str, str], source_digest: str,
+                           mounts: Optional[List[tuple[str, str]]] = None,
+                           log_path: Optional[Path] = None,
+                           metrics: Optional[BuildMetrics] = None,
+                           resume: bool = False) -> None:
+    """Run the provisioners one script per Packer run, checkpointing the image after each.
+
+    With ``resume`` the build restarts after the newest checkpoint whose key
+    matches the current inputs. Checkpoints live in ``.cache/checkpoints``
+    and the oldest are evicted beyond ``checkpoint_budget``.
+    """
+    steps = checkpoint_steps(template)
+    keys = checkpoint_keys(cfg, template, variables, source_digest, steps)
+    checkpoint_dir = get_cache_dir() / "checkpoints"
+    checkpoint_dir.mkdir(exist_ok=True)
+    budget = parse_size(cfg.checkpoint_budget)
+    build_subdir = get_build_subdirectory(cfg)
+    image_path = get_image_path(cfg)
+
+    def checkpoint_path(index: int) -> Path:
+        return checkpoint_dir / f"{keys[index]}.img"
+
+    start = 0
+    if resume:
+        start = next((i + 1 for i in reversed(range(len(steps)))
+                      if checkpoint_path(i).exists() and checkpoint_path(i).with_suffix(".json").exists()), 0)
+        if start:
+            print(f"Resuming after {checkpoint_step_name(steps[start - 1])} "
+                  f"(stage {start}/{len(steps)}) from {checkpoint_path(start - 1)}")
+        else:
+            print("No checkpoint matches these inputs; starting from the source image")
+
+    if start == len(steps):
+        image_path.unlink(missing_ok=True)
+        clone_file(checkpoint_path(start - 1), image_path)
+        return
+
+    for index in range(start, len(steps)):
+        name = checkpoint_step_name(steps[index])
+        stage_variables = dict(variables)
+        if index > 0:
+            stage_variables["SOURCE_IMAGE_PATH"] = checkpoint_path(index - 1).as_posix()
+            stage_variables["IMAGE_CHECKSUM"] = ""
+        staged = derive_checkpoint_template(template, steps[index], image_path.as_posix(), index > 0)
+        template_path = build_subdir / f"packer_stage{index:02d}.json"
+        write_packer_template(add_chroot_mounts(staged, mounts or []), template_path)
+
+        print(f"\nStage {index + 1}/{len(steps)}: {name}")
+        image_path.unlink(missing_ok=True)
+        stage_log = log_path.with_name(f"packer_stage{index:02d}.log") if log_path else None
+        run_packer(cfg, str(template_path), stage_variables, log_path=stage_log, metrics=metrics, stage=name)
+        take_ownership(image_path)
+        save_checkpoint(image_path, checkpoint_dir, keys[index], index, name)
+        evict_checkpoints(checkpoint_dir, budget, keep={keys[index]})
+
+
+APT_CACHE_DIR = ".cache/apt"
+APT_ARCHIVE_DIR = f"{APT_CACHE_DIR}/archives"
+APT_INDEX_TTL_SECONDS = 6 * 60 * 60
+APT_DOWNLOAD_WORKERS = 8
+
+UBUNTU_CODENAMES: dict[str, str] = {
+    "22.04": "jammy",
+    "24.04": "noble",
+}
+
+# Already present in the Ubuntu preinstalled server image, so never prefetched
+APT_SKIP_PRIORITIES = {"required", "important"}
+
+APT_PACKAGE_LIST = re.compile(r'^\s*(_[A-Z0-9_]+_PKGS)="([^"]*)"', re.MULTILINE)
+
+
+@dataclass
+class AptPackage:
+    """A binary package entry from a repository's Packages index."""
+    name: str
+    version: str
+    architecture: str
+    filename: str
+    size: int
+    sha256: str
+    priority: str = ""
+    depends: str = ""
+    provides: List[str] = field(default_factory=list)
+    repository: str = ""
+
+    @property
+    def archive_name(self) -> str:
+        """File name apt uses for this package in /var/cache/apt/archives."""
+        return f"{self.name}_{self.version.replace(':', '%3a')}_{self.architecture}.deb"
+
+
+def default_apt_repositories(cfg: BuildConfig) -> List[str]:
+    """Repositories the provisioner scripts install from, in sources.list one-line form."""
+    codename = UBUNTU_CODENAMES.get(cfg.ubuntu_version, "jammy")
+    ports = "http://ports.ubuntu.com/ubuntu-ports"
+    return [
+        f"{ports} {codename} main universe",
+        f"{ports} {codename}-security main universe",
+        f"{ports} {codename}-updates main universe",
+        f"http://packages.ros.org/ros2/ubuntu {codename} main",
+    ]
+
+
+def collect_script_packages(cfg: BuildConfig, template: dict) -> List[str]:
+    """Return the packages declared in the _*_PKGS lists of the template's provisioner scripts."""
+    packages: List[str] = []
+    for provisioner in _script_provisioners(template):
+        for script in provisioner["scripts"]:
+            text = Path(script).read_text()
+            for _, names in APT_PACKAGE_LIST.findall(text):
+                names = names.replace("${ROS_DISTRO}", cfg.ros_distro).replace("$ROS_DISTRO", cfg.ros_distro)
+                packages.extend(name for name in names.split() if name not in packages)
+    return packages
+
+
+def _fetch_cached(url: str, cache_path: Path, ttl: int, offline: bool = False) -> Optional[bytes]:
+    """Fetch a URL through a file cache, returning None if it does not exist."""
+    if cache_path.exists() and (offline or time.time() - cache_path.stat().st_mtime < ttl):
+        return cache_path.read_bytes()
+    if offline:
+        return None
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            data = response.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+    except urllib.error.URLError as e:
+        if isinstance(e.reason, FileNotFoundError):
+            return None  # Missing file in a file:// repository
+        raise
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, cache_path)
+    return data
+
+
+def load_packages_index(repository: str, arch: str = "arm64", offline: bool = False) -> List[AptPackage]:
+    """Download (through the cache) and parse the Packages index of every component of a repository."""
+    base_url, suite, *components = repository.split()
+    base_url = base_url.rstrip("/")
+    packages = []
+    for component in components:
+        index_url = f"{base_url}/dists/{suite}/{component}/binary-{arch}/Packages"
+        cache_key = hashlib.sha256(index_url.encode()).hexdigest()[:16]
+        text = None
+        for suffix, decompress in ((".xz", lzma.decompress), (".gz", gzip.decompress), ("", bytes)):
+            data = _fetch_cached(index_url + suffix, Path(APT_CACHE_DIR) / "lists" / f"{cache_key}{suffix}",
+                                 APT_INDEX_TTL_SECONDS, offline=offline)
+            if data is not None:
+                text = decompress(data).decode("utf-8", errors="replace")
+                break
+        if text is None:
+            print(f"Warning: No Packages index for {suite}/{component} in {base_url}")
+            continue
+        for stanza in text.split("\n\n"):
+            fields = dict(
+                line.split(": ", 1) for line in stanza.splitlines()
+                if ": " in line and not line.startswith(" ")
+            )
+            if "Package" not in fields or "Filename" not in fields:
+                continue
+            packages.append(AptPackage(
+                name=fields["Package"],
+                version=fields.get("Version", ""),
+                architecture=fields.get("Architecture", arch),
+                filename=fields["Filename"],
+                size=int(fields.get("Size", 0)),
+                sha256=fields.get("SHA256", ""),
+                priority=fields.get("Priority", ""),
+                depends=", ".join(filter(None, (fields.get("Pre-Depends"), fields.get("Depends")))),
+                provides=[p.split("(")[0].strip() for p in fields.get("Provides", "").split(",") if p.strip()],
+                repository=base_url,
+            ))
+    return packages
+
+
+def resolve_apt_packages(requested: List[str], index: List[AptPackage]) -> List[AptPackage]:
+    """Return the requested packages and their dependency closure.
+
+    Later repositories in the index win, so -updates and -security override
+    the release pocket. Virtual packages resolve to their first provider, and
+    of each set of alternatives the first available one is taken. This only
+    needs to match apt's choices closely enough to warm the cache; anything
+    it misses is downloaded by apt inside the build and cached from then on.
+    """
+    by_name: dict[str, AptPackage] = {}
+    providers: dict[str, AptPackage] = {}
+    for package in index:
+        by_name[package.name] = package
+        for provided in package.provides:
+            providers.setdefault(provided, package)
+
+    def lookup(name: str) -> Optional[AptPackage]:
+        name = name.split(":")[0]  # Drop :any / :native qualifiers
+        return by_name.get(name) or providers.get(name)
+
+    resolved: dict[str, AptPackage] = {}
+    pending = list(requested)
+    while pending:
+        name = pending.pop()
+        package = lookup(name)
+        if package is None:
+            if name in requested:
+                print(f"Warning: {name} not found in the configured repositories")
+            continue
+        if package.name in resolved:
+            continue
+        resolved[package.name] = package
+        for dependency in package.depends.split(","):
+            alternatives = [alt.split("(")[0].strip() for alt in dependency.split("|")]
+            alternatives = [alt for alt in alternatives if alt]
+            if not alternatives:
+                continue
+            choice = next((alt for alt in alternatives if lookup(alt)), None)
+            if choice is not None:
+                pending.append(choice)
+    return [p for p in resolved.values() if p.priority not in APT_SKIP_PRIORITIES or p.name in requested]
+
+
+def _download_deb(package: AptPackage, archive_dir: Path) -> bool:
+    """Download one package into the archive cache, returning False if it was already cached."""
+    dest = archive_dir / package.archive_name
+    if dest.exists() and dest.stat().st_size == package.size:
+        return False
+    tmp_path = archive_dir / "partial" / package.archive_name
+    sha256 = hashlib.sha256()
+    with urllib.request.urlopen(f"{package.repository}/{package.filename}", timeout=300) as response, \
+            open(tmp_path, "wb") as f:
+        for block in iter(lambda: response.read(DOWNLOAD_READ_SIZE), b""):
+            f.write(block)
+            sha256.update(block)
+    if package.sha256 and sha256.hexdigest() != package.sha256:
+        tmp_path.unlink()
+        raise BuildError(f"Checksum mismatch for {package.filename}")
+    os.replace(tmp_path, dest)
+    return True
+
+
+def prefetch_apt_packages(cfg: BuildConfig, packer_file: str, offline: bool = False) -> None:
+    """Fill the host-side arm64 .deb cache with the packages the provisioner scripts install.
+
+    Runs natively on the host with concurrent downloads; the cache is then
+    bind-mounted over /var/cache/apt/archives in the chroot.
+    """
+    requested = collect_script_packages(cfg, load_packer_template(packer_file))
+    repositories = cfg.apt_repositories or default_apt_repositories(cfg)
+    print(f"Resolving {len(requested)} packages from {len(repositories)} repositories...")
+    index: List[AptPackage] = []
+    for repository in repositories:
+        index.extend(load_packages_index(repository, offline=offline))
+    packages = resolve_apt_packages(requested, index)
+
+    archive_dir = Path(APT_ARCHIVE_DIR)
+    (archive_dir / "partial").mkdir(parents=True, exist_ok=True)
+    if offline:
+        missing = [p for p in packages if not (archive_dir / p.archive_name).exists()]
+        print(f"Offline mode - {len(packages) - len(missing)}/{len(packages)} packages cached")
+        return
+
+    began = time.monotonic()
+    downloaded = failed = 0
+    with ThreadPoolExecutor(max_workers=APT_DOWNLOAD_WORKERS) as pool:
+        futures = {pool.submit(_download_deb, package, archive_dir): package for package in packages}
+        for future in as_completed(futures):
+            try:
+                downloaded += future.result()
+            except (OSError, BuildError) as e:
+                failed += 1
+                print(f"Warning: Could not prefetch {futures[future].name}: {e}")
+    print(f"APT cache: {len(packages)} packages, {downloaded} downloaded, "
+          f"{len(packages) - downloaded - failed} already cached ({time.monotonic() - began:.1f}s)")
+
+
+GIT_CACHE_DIR = ".cache/git"
+GIT_MIRROR_WORKERS = 4
+
+GIT_CLONE_LINE = re.compile(r"^\s*tb3_clone\s+(\S+)\s+(\S+)", re.MULTILINE)
+
+
+@dataclass
+class GitSource:
+    """A repository cloned by a provisioner script, and the ref it checks out."""
+    url: str
+    ref: str
+
+    @property
+    def mirror_name(self) -> str:
+        """Mirror directory name; tb3_clone in the scripts derives the same name from the URL."""
+        url_path = Path(self.url.rstrip("/"))
+        return f"{url_path.parent.name}_{url_path.name.removesuffix('.git')}.git"
+
+    @property
+    def mirror_path(self) -> Path:
+        return Path(GIT_CACHE_DIR) / self.mirror_name
+
+
+def script_git_sources(cfg: BuildConfig, script: str) -> List[GitSource]:
+    """Return the repositories a provisioner script clones with tb3_clone."""
+    sources: List[GitSource] = []
+    for ref, url in GIT_CLONE_LINE.findall(Path(script).read_text()):
+        ref = ref.replace("${ROS_DISTRO}", cfg.ros_distro).replace("$ROS_DISTRO", cfg.ros_distro)
+        sources.append(GitSource(url=url, ref=ref))
+    return sources
+
+
+def collect_git_sources(cfg: BuildConfig, template: dict) -> List[GitSource]:
+    """Return the repositories cloned with tb3_clone by the template's provisioner scripts."""
+    sources: List[GitSource] = []
+    for provisioner in _script_provisioners(template):
+        for script in provisioner["scripts"]:
+            for source in script_git_sources(cfg, script):
+                if source not in sources:
+                    sources.append(source)
+    return sources
+
+
+def update_git_mirror(source: GitSource) -> str:
+    """Create or incrementally refresh the bare mirror of a repository.
+
+    Returns the commit the source's ref points to in the mirror.
+    """
+    mirror = source.mirror_path
+    if mirror.exists():
+        subprocess.run(["git", "-C", str(mirror), "fetch", "--prune", "--quiet", "origin"],
+                       check=True, capture_output=True)
+    else:
+        tmp_path = mirror.with_name(mirror.name + ".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        subprocess.run(["git", "clone", "--mirror", "--quiet", source.url, str(tmp_path)],
+                       check=True, capture_output=True)
+        os.replace(tmp_path, mirror)
+    return git_mirror_commit(source)
+
+
+def git_mirror_commit(source: GitSource) -> str:
+    """Return the commit a source's ref resolves to in its mirror."""
+    result = subprocess.run(
+        ["git", "-C", str(source.mirror_path), "rev-parse", "--verify", "--quiet", f"{source.ref}^{{commit}}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise BuildError(f"{source.ref} not found in mirror of {source.url}")
+    return result.stdout.strip()
+
+
+def update_git_mirrors(cfg: BuildConfig, packer_file: str, offline: bool = False) -> None:
+    """Refresh the host-side mirrors of every repository the provisioner scripts clone."""
+    sources = collect_git_sources(cfg, load_packer_template(packer_file))
+    Path(GIT_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    if offline:
+        for source in sources:
+            state = "cached" if source.mirror_path.exists() else "missing (will clone over the network)"
+            print(f"Offline mode - git mirror of {source.url}: {state}")
+        return
+
+    print(f"Updating {len(sources)} git mirrors...")
+    with ThreadPoolExecutor(max_workers=GIT_MIRROR_WORKERS) as pool:
+        futures = {pool.submit(update_git_mirror, source): source for source in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                print(f"  {source.url} {source.ref}: {future.result()[:12]}")
+            except (subprocess.CalledProcessError, BuildError) as e:
+                stderr = getattr(e, "stderr", b"") or b""
+                print(f"Warning: Could not update mirror of {source.url}: {e} {stderr.decode().strip()}")
+
+
+BUILD_MANIFEST_FILE = "build_manifest.json"
+
+# Config fields that do not change the image
+MANIFEST_IGNORED_FIELDS = {"verbose", "_source_explicit", "packer_builder_digest", "build_jobs", "compile_jobs"}
+
+
+def builder_image_digest(image: str) -> Optional[str]:
+    """Return the ID of the locally stored builder image, or None if it is not available."""
+    result = subprocess.run(["sudo", "podman", "image", "inspect", "--format", "{{.Id}}", image],
+                            capture_output=True, text=True)
+    return result.stdout.strip() or None if result.returncode == 0 else None
+
+
+def _secret_digest(value: Optional[str]) -> Optional[str]:
+    return "sha256:" + hashlib.sha256(value.encode()).hexdigest() if value else value
+
+
+def manifest_config(cfg: BuildConfig) -> dict:
+    """The resolved configuration as recorded in the build manifest, with secrets hashed."""
+    config = {k: v for k, v in asdict(cfg).items() if k not in MANIFEST_IGNORED_FIELDS}
+    config["user_password"] = _secret_digest(cfg.user_password)
+    config["networks"] = [{"ssid": net.ssid, "password": _secret_digest(net.password)} for net in cfg.networks]
+    return config
+
+
+def build_inputs(cfg: BuildConfig, packer_file: str, source_image_path: Path,
+                 builder_digest: Optional[str]) -> dict:
+    """Everything that determines the image a build produces."""
+    return {
+        "config": manifest_config(cfg),
+        "packer_template": file_sha256(Path(packer_file)),
+        "build_tool": file_sha256(Path(__file__)),
+        "files": hash_paths([Path("scripts"), Path("files")]),
+        "source_image": read_verified_digest(source_image_path) or file_sha256(source_image_path),
+        "builder_image": builder_digest,
+    }
+
+
+def build_outputs(cfg: BuildConfig) -> List[Path]:
+    """The files a successful build leaves in its build subdirectory."""
+    image = compressed_image_path(cfg) or get_image_path(cfg)
+    outputs = [image]
+    if not cfg.skip_sparse:
+        outputs.append(image.with_name(image.name + ".bmap"))
+    return outputs
+
+
+def _flatten(data, prefix: str = "") -> dict:
+    if isinstance(data, dict) and data:
+        flat = {}
+        for key, value in data.items():
+            flat.update(_flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    return {prefix: data}
+
+
+def diff_build_inputs(old: dict, new: dict) -> List[str]:
+    """Describe every input that differs between two manifests."""
+    old_flat, new_flat = _flatten(old), _flatten(new)
+    changes = []
+    for key in sorted(old_flat.keys() | new_flat.keys()):
+        if key not in old_flat:
+            changes.append(f"added: {key}")
+        elif key not in new_flat:
+            changes.append(f"removed: {key}")
+        elif old_flat[key] != new_flat[key]:
+            before, after = old_flat[key], new_flat[key]
+            if any(isinstance(v, str) and (len(v) == 64 or v.startswith("sha256:")) for v in (before, after)):
+                changes.append(f"changed: {key}")
+            else:
+                changes.append(f"changed: {key} ({before!r} -> {after!r})")
+    return changes
+
+
+def check_build_manifest(cfg: BuildConfig, inputs: dict) -> bool:
+    """Return True if the build subdirectory already holds this build's outputs for identical inputs.
+
+    Otherwise print which inputs differ from the recorded manifest.
+    """
+    manifest_path = get_build_subdirectory(cfg) / BUILD_MANIFEST_FILE
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    changes = diff_build_inputs(manifest.get("inputs", {}), inputs)
+    if inputs.get("builder_image") is None:
+        changes.append("unknown: builder_image (not available locally)")
+    recorded = manifest.get("outputs", {})
+    for output in build_outputs(cfg):
+        if not output.exists() or recorded.get(output.name) != output.stat().st_size:
+            changes.append(f"missing or modified output: {output.name}")
+    if not changes:
+        print(f"Build is up to date: {get_build_subdirectory(cfg)} (inputs unchanged, reusing outputs)")
+        return True
+    print(f"Rebuilding {get_build_subdirectory(cfg)}; inputs differ from {manifest_path}:")
+    for change in changes:
+        print(f"  {change}")
+    return False
+
+
+def write_build_manifest(cfg: BuildConfig, inputs: dict) -> None:
+    """Record the inputs and outputs of a successful build."""
+    manifest = {
+        "created": time.time(),
+        "inputs": inputs,
+        "outputs": {output.name: output.stat().st_size for output in build_outputs(cfg) if output.exists()},
+    }
+    with open(get_build_subdirectory(cfg) / BUILD_MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+
+
+ARTIFACT_CACHE_DIR = ".cache/artifacts"
+ARTIFACT_CHROOT_DIR = "/var/cache/tb3-artifacts"
+CCACHE_CACHE_DIR = ".cache/ccache"
+CCACHE_CHROOT_DIR = "/var/cache/ccache"
+
+# Compiled components: the script that builds each one and the variable naming its tarball
+ARTIFACT_COMPONENTS = {
+    "colcon": ("scripts/50_turtlebot3_setup.sh", "COLCON_ARTIFACT"),
+    "libcamera": ("scripts/70_setup_camera.sh", "LIBCAMERA_ARTIFACT"),
+}
+
+
+@dataclass
+class ArtifactPlan:
+    """A compiled component, the key of its cached tarball and whether the cache holds it."""
+    component: str
+    key: str
+    env_var: str
+    hit: bool
+    inputs: dict = field(default_factory=dict)
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.component}-{self.key}.tar"
+
+    @property
+    def path(self) -> Path:
+        return Path(ARTIFACT_CACHE_DIR) / self.file_name
+
+
+def resolve_source_commit(source: GitSource, offline: bool = False) -> Optional[str]:
+    """Return the commit a source's ref points to, from its mirror or the remote."""
+    if source.mirror_path.exists():
+        try:
+            return git_mirror_commit(source)
+        except BuildError:
+            pass
+    if offline:
+        return None
+    result = subprocess.run(["git", "ls-remote", source.url, source.ref, f"{source.ref}^{{}}"],
+                            capture_output=True, text=True)
+    refs = dict(reversed(line.split("\t")) for line in result.stdout.splitlines() if "\t" in line)
+    # Prefer the peeled commit of an annotated tag over the tag object
+    for name in (f"refs/tags/{source.ref}^{{}}", f"refs/tags/{source.ref}", f"refs/heads/{source.ref}"):
+        if name in refs:
+            return refs[name]
+    return None
+
+
+def plan_artifacts(cfg: BuildConfig, template: dict, offline: bool = False) -> List[ArtifactPlan]:
+    """Work out the cache key of each compiled component the template builds.
+
+    Keys cover the source commits, ROS distro, Ubuntu version, workspace user
+    and the building script itself (and so its compiler flags). Components
+    whose commits cannot be resolved are built without the cache.
+    """
+    scripts = {script for p in _script_provisioners(template) for script in p["scripts"]}
+    plans: List[ArtifactPlan] = []
+    for component, (script, env_var) in ARTIFACT_COMPONENTS.items():
+        if script not in scripts:
+            continue
+        commits = {}
+        for source in script_git_sources(cfg, script):
+            commits[source.url] = resolve_source_commit(source, offline=offline)
+        if not commits or None in commits.values():
+            print(f"Artifact cache: {component} source commits unknown, building without cache")
+            continue
+        inputs = {
+            "commits": commits,
+            "ros_distro": cfg.ros_distro,
+            "ubuntu_version": cfg.ubuntu_version,
+            "username": cfg.username,
+            "script": file_sha256(Path(script)),
+        }
+        key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:24]
+        plan = ArtifactPlan(component=component, key=key, env_var=env_var, hit=False, inputs=inputs)
+        plan.hit = plan.path.exists()
+        print(f"Artifact cache: {component} {key} {'hit' if plan.hit else 'miss'}")
+        plans.append(plan)
+    if plans:
+        record_artifacts(cfg, plans)
+    return plans
+
+
+def artifact_variables(plans: List[ArtifactPlan]) -> dict[str, str]:
+    """Packer variables pointing the build scripts at the artifact tarballs and ccache."""
+    variables = {plan.env_var: f"{ARTIFACT_CHROOT_DIR}/{plan.file_name}" for plan in plans}
+    variables["CCACHE_DIR"] = CCACHE_CHROOT_DIR
+    return variables
+
+
+def record_artifacts(cfg: BuildConfig, plans: List[ArtifactPlan], stored: bool = False) -> None:
+    """Write the per-component hit/miss record to ``artifact_cache.json`` in the build subdirectory."""
+    record = {
+        plan.component: {
+            "key": plan.key,
+            "hit": plan.hit,
+            "stored": stored and not plan.hit and plan.path.exists(),
+            "inputs": plan.inputs,
+        }
+        for plan in plans
+    }
+    with open(get_build_subdirectory(cfg) / "artifact_cache.json", "w") as f:
+        json.dump(record, f, indent=2)
+
+
+BUILD_MEMORY_PER_JOB = 4 * 1024 ** 3
+BUILD_CORES_PER_JOB = 4
+# Peak memory of one emulated C++ compiler process (ROS and libcamera sources)
+COMPILE_MEMORY_PER_JOB = 1536 * 1024 ** 2
+
+
+@dataclass
+class BuildJob:
+    """A single image build and its outcome, used when building several configs at once."""
+    cfg: BuildConfig
+    config_path: Path
+    status: str = "pending"
+    seconds: float = 0.0
+    error: str = ""
+    inputs: dict = field(default_factory=dict)
+
+
+def parse_size(size: str) -> int:
+    """Convert a size such as "10G" or "256M" to bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = str(size).strip().upper().removesuffix("B").removesuffix("I")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise BuildError(f"Invalid size: {size}") from None
+
+
+def available_memory() -> int:
+    """Return the memory available for new work, in bytes."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def max_parallel_builds(cfgs: List[BuildConfig]) -> int:
+    """Number of Packer builds the host can run at once, limited by cores, RAM and free disk."""
+    by_cpu = max(1, (os.cpu_count() or 1) // BUILD_CORES_PER_JOB)
+    by_memory = max(1, available_memory() // BUILD_MEMORY_PER_JOB)
+    # Each build holds the working image plus its sparse copy and compressed output
+    per_build_disk = max(parse_size(cfg.image_size) for cfg in cfgs) * 2
+    by_disk = max(1, shutil.disk_usage(Path.cwd()).free // per_build_disk)
+    return int(min(by_cpu, by_memory, by_disk, len(cfgs)))
+
+
+def compile_parallelism(cfg: BuildConfig, concurrent_builds: int = 1,
+                        cpus: Optional[int] = None, memory: Optional[int] = None) -> int:
+    """Compile jobs for colcon and ninja in the chroot, from ``build_jobs`` or the host.
+
+    Without ``build_jobs``, the host cores and available memory (or the
+    given ``cpus`` and ``memory``) are split between the builds running at
+    once, with COMPILE_MEMORY_PER_JOB per job.
+    """
+    if cfg.build_jobs:
+        return cfg.build_jobs
+    concurrent_builds = max(1, concurrent_builds)
+    by_cpu = (cpus or os.cpu_count() or 1) // concurrent_builds
+    by_memory = (memory or available_memory()) // concurrent_builds // COMPILE_MEMORY_PER_JOB
+    return int(max(1, min(by_cpu, by_memory)))
+
+
+def _set_dotted(data: dict, key: str, value) -> None:
+    *parents, leaf = key.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    data[leaf] = value
+
+
+def expand_matrix(matrix_path: Path) -> List[dict]:
+    """Expand a build matrix file into the raw config data of every variant.
+
+    The matrix file names a base config and a set of axes::
+
+        [matrix]
+        base = "example.toml"
+
+        [matrix.axes]
+        "model.type" = ["burger", "waffle"]
+        "ros.distro" = ["humble", "jazzy"]
+
+    Values of axes other than ``model.type`` are appended to ``image.name``
+    so every variant gets its own build subdirectory.
+    """
+    data = read_config_data(matrix_path)
+    matrix = data.get("matrix")
+    if not isinstance(matrix, dict):
+        raise BuildError(f"No [matrix] section in {matrix_path}")
+
+    base = read_config_data(matrix_path.parent / matrix["base"]) if "base" in matrix else {}
+    axes = matrix.get("axes", {})
+    for key, values in axes.items():
+        if not isinstance(values, list) or not values:
+            raise BuildError(f"Matrix axis {key} must be a non-empty list")
+
+    variants = []
+    for combination in itertools.product(*axes.values()):
+        variant = copy.deepcopy(base)
+        suffix = []
+        for key, value in zip(axes, combination):
+            _set_dotted(variant, key, value)
+            if key != "model.type":
+                suffix.append(str(value))
+        if suffix:
+            image = variant.setdefault("image", {})
+            image["name"] = "-".join([image.get("name", BuildConfig.name), *suffix])
+        variants.append(variant)
+    return variants
+
+
+def prepare_build_directory(job: BuildJob, auto_yes: bool = False) -> Path:
+    """Create the build subdirectory and record the configuration used."""
+    cfg = job.cfg
+
+    # Create build subdirectory
+    build_subdir = get_build_subdirectory(cfg)
+    build_subdir.mkdir(parents=True, exist_ok=True)
+    print(f"Build directory: {build_subdir}")
+
+    # Save configuration to build directory (with all defaults)
+    save_config_to_build_dir(cfg, build_subdir)
+    print(f"Configuration saved to: {build_subdir}/build_config.toml")
+
+    # Copy original config file to build directory
+    original_config_dest = build_subdir / job.config_path.name
+    shutil.copy2(job.config_path, original_config_dest)
+    print(f"Original config copied to: {original_config_dest}")
+
+    # Check output file doesn't exist
+    check_output_file(cfg, auto_yes=auto_yes)
+    return build_subdir
+
+
+def collect_build_inputs(jobs: List[BuildJob], packer_file: str, source_paths: dict[str, Path]) -> None:
+    """Compute the manifest inputs of every job, inspecting each builder image once."""
+    builder_digests: dict[str, Optional[str]] = {}
+    for job in jobs:
+        image = job.cfg.packer_builder_image
+        if image not in builder_digests:
+            builder_digests[image] = job.cfg.packer_builder_digest or builder_image_digest(image)
+        job.inputs = build_inputs(job.cfg, packer_file, source_paths[job.cfg.source_url], builder_digests[image])
+
+
+def cached_build_inputs(cfg: BuildConfig, packer_file: str) -> Optional[dict]:
+    """The manifest inputs of a build from local state alone, or None if they need a download or pull."""
+    source_path = cached_source_image(cfg)
+    builder_digest = builder_image_digest(cfg.packer_builder_image) if source_path else None
+    if builder_digest is None:
+        return None
+    return build_inputs(cfg, packer_file, source_path, builder_digest)
+
+
+def _prefetch_checksum_manifest(checksum_url: str, offline: bool) -> None:
+    """Load a checksum manifest ahead of the download that needs it.
+
+    Failures are left to download_source_image, which reports them in context.
+    """
+    try:
+        load_checksum_manifest(checksum_url, offline=offline)
+    except BuildError:
+        pass
+
+
+def fetch_shared_inputs(source_cfgs: dict[str, BuildConfig], builder_cfgs: dict[str, BuildConfig],
+                        reverify: bool = False, offline: bool = False,
+                        refresh_builder: bool = False) -> tuple[dict[str, Path], dict[str, str]]:
+    """Fetch the checksum manifests, source images and builder images concurrently.
+
+    Every download, checksum fetch and pull runs in its own thread and
+    reports on one shared status line. The first failure, or an interrupt,
+    stops the remaining downloads and pulls and is re-raised. Returns the
+    local source image path for every source URL and the image ID of every
+    builder image.
+    """
+    def label(kind: str, index: int, count: int) -> str:
+        return kind if count == 1 else f"{kind} {index + 1}"
+
+    checksum_urls = list(dict.fromkeys(cfg.checksum_url for cfg in source_cfgs.values() if cfg.checksum_url))
+    task_count = len(checksum_urls) + len(source_cfgs) + len(builder_cfgs)
+    source_paths: dict[str, Path] = {}
+    builder_digests: dict[str, str] = {}
+    with ProgressDisplay() as display, ThreadPoolExecutor(max_workers=max(1, task_count)) as pool:
+        futures = {}
+        for i, checksum_url in enumerate(checksum_urls):
+            future = pool.submit(display.run, label("checksum", i, len(checksum_urls)),
+                                 _prefetch_checksum_manifest, checksum_url, offline)
+            futures[future] = (None, checksum_url)
+        for i, (url, cfg) in enumerate(source_cfgs.items()):
+            future = pool.submit(display.run, label("source", i, len(source_cfgs)),
+                                 download_source_image, cfg, reverify=reverify, offline=offline)
+            futures[future] = (source_paths, url)
+        for i, (image, cfg) in enumerate(builder_cfgs.items()):
+            safe_name = re.sub(r"[^\w.-]+", "_", image)
+            log_path = get_cache_dir() / f"podman-pull-{safe_name}.log"
+            future = pool.submit(display.run, label("builder", i, len(builder_cfgs)),
+                                 ensure_builder_image, cfg, refresh=refresh_builder, offline=offline,
+                                 log_path=log_path)
+            futures[future] = (builder_digests, image)
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                results, key = futures[future]
+                if results is not None:
+                    results[key] = result
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            terminate_active_processes()
+            raise
+    return source_paths, builder_digests
+
+
+def prepare_shared_inputs(cfgs: List[BuildConfig], packer_file: str, reverify: bool = False,
+                          offline: bool = False, refresh_builder: bool = False) -> dict[str, Path]:
+    """Download each distinct source image and provide each distinct builder image once.
+
+    Also prefetches the APT packages and refreshes the git mirrors of each
+    distinct distro for builds using those caches. Returns the local source
+    image path for every source URL and records the builder image ID on
+    every config.
+    """
+    source_cfgs: dict[str, BuildConfig] = {}
+    builder_cfgs: dict[str, BuildConfig] = {}
+    for cfg in cfgs:
+        source_cfgs.setdefault(cfg.source_url, cfg)
+        builder_cfgs.setdefault(cfg.packer_builder_image, cfg)
+    source_paths, builder_digests = fetch_shared_inputs(source_cfgs, builder_cfgs, reverify=reverify,
+                                                        offline=offline, refresh_builder=refresh_builder)
+    for cfg in cfgs:
+        cfg.packer_builder_digest = builder_digests[cfg.packer_builder_image]
+
+    prefetched: set[tuple] = set()
+    for cfg in cfgs:
+        apt_key = (cfg.ros_distro, cfg.ubuntu_version, tuple(cfg.apt_repositories))
+        if cfg.apt_cache and apt_key not in prefetched:
+            prefetched.add(apt_key)
+            with CacheLock("apt"):
+                prefetch_apt_packages(cfg, packer_file, offline=offline)
+
+    mirrored: set[str] = set()
+    for cfg in cfgs:
+        if cfg.git_cache and cfg.ros_distro not in mirrored:
+            mirrored.add(cfg.ros_distro)
+            with CacheLock("git"):
+                update_git_mirrors(cfg, packer_file, offline=offline)
+    return source_paths
+
+
+def _run_matrix_job(job: BuildJob, packer_file: str, source_image_path: Path, offline: bool,
+                    resume: bool = False) -> None:
+    build_subdir = get_build_subdirectory(job.cfg)
+    log_path = build_subdir / "packer.log"
+    print(f"Starting build: {build_subdir} (log: {log_path})")
+    job.status = "running"
+    began = time.monotonic()
+    try:
+        run_packer_build(job.cfg, packer_file, source_image_path, offline=offline, log_path=log_path,
+                         resume=resume)
+        if job.inputs:
+            write_build_manifest(job.cfg, job.inputs)
+        job.status = "success"
+    except (BuildError, subprocess.CalledProcessError) as e:
+        job.status = "failed"
+        job.error = str(e)
+    finally:
+        job.seconds = time.monotonic() - began
+    print(f"Finished build: {build_subdir} ({job.status}, {job.seconds / 60:.1f} min)")
+
+
+def run_build_matrix(jobs: List[BuildJob], packer_file: str, source_paths: dict[str, Path],
+                     max_workers: int, offline: bool = False, resume: bool = False) -> None:
+    """Run the Packer builds of several jobs with at most ``max_workers`` at a time."""
+    print(f"\nRunning {len(jobs)} builds, {max_workers} at a time")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_run_matrix_job, job, packer_file, source_paths[job.cfg.source_url], offline, resume)
+            for job in jobs
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            terminate_active_processes()
+            raise
+
+
+def print_matrix_report(jobs: List[BuildJob], wall_seconds: float) -> None:
+    """Print the aggregate outcome of a multi-config build."""
+    width = max(len(str(get_build_subdirectory(job.cfg))) for job in jobs)
+    print("\nBuild summary:")
+    print("--------------")
+    for job in jobs:
+        line = f"{str(get_build_subdirectory(job.cfg)):<{width}}  {job.status:<8} {job.seconds / 60:6.1f} min"
+        if job.error:
+            line += f"  {job.error}"
+        print(line)
+    succeeded = sum(job.status == "success" for job in jobs)
+    busy = sum(job.seconds for job in jobs)
+    print(f"\n{succeeded}/{len(jobs)} builds succeeded in {wall_seconds / 60:.1f} min wall-clock "
+          f"({busy / 60:.1f} min of build time)")
+
+
+# First-boot marker files that re-arm the setup services on a personalized image
+SETUP_MARKERS = [".setup_hostname", ".setup_firewall", ".setup_opencr", ".setup_camera"]
+ROS_PROFILE_PATH = "/etc/profile.d/90-turtlebot-ros-profile.sh"
+# The sourcing chain and the environment precomputed from it (75_ros_environment.sh)
+ROS_SETUP_PATH = "/etc/turtlebot3/ros-setup.bash"
+ROS_ENV_PATH = "/etc/turtlebot3/ros.env"
+
+# ioctl request to share all extents of one file with another (Linux FICLONE)
+FICLONE = 0x40049409
+
+
+@dataclass
+class Partition:
+    """A primary partition from an image's MBR partition table."""
+    index: int
+    type: int
+    offset: int
+    size: int
+
+
+@dataclass
+class RobotOverride:
+    """Per-robot settings written into a copy of a finished image."""
+    name: str
+    networks: Optional[List[NetworkConfig]] = None
+    ros_domain_id: Optional[int] = None
+    password: Optional[str] = None
+    hostname_prefix: Optional[str] = None
+    username: Optional[str] = None
+
+
+def load_robot_overrides(robots_path: Path) -> List[RobotOverride]:
+    """Load the [[robot]] entries of a personalization file."""
+    data = read_config_data(robots_path)
+    robots = []
+    for entry in data.get("robot", []):
+        if not entry.get("name"):
+            raise BuildError(f"Every [[robot]] in {robots_path} needs a name")
+        robots.append(RobotOverride(
+            name=entry["name"],
+            networks=parse_networks(entry["network"]) if "network" in entry else None,
+            ros_domain_id=entry.get("ros_domain_id"),
+            password=entry.get("password"),
+            hostname_prefix=entry.get("hostname_prefix"),
+            username=entry.get("username"),
+        ))
+    names = [robot.name for robot in robots]
+    if len(set(names)) != len(names):
+        raise BuildError(f"Robot names in {robots_path} must be unique")
+    if not robots:
+        raise BuildError(f"No [[robot]] entries in {robots_path}")
+    return robots
+
+
+def read_partition_table(image_path: Path) -> List[Partition]:
+    """Read the primary partitions from an image's MBR."""
+    with open(image_path, "rb") as f:
+        mbr = f.read(512)
+    if len(mbr) < 512 or mbr[510:512] != b"\x55\xaa":
+        raise BuildError(f"No MBR partition table in {image_path}")
+    partitions = []
+    for index in range(4):
+        entry = mbr[446 + index * 16:446 + (index + 1) * 16]
+        part_type = entry[4]
+        start, count = struct.unpack_from("<II", entry, 8)
+        if part_type and count:
+            partitions.append(Partition(index + 1, part_type, start * 512, count * 512))
+    return partitions
+
+
+def clone_file(src: Path, dest: Path) -> str:
+    """Copy a file as a reflink where the filesystem supports it, else as a sparse copy.
+
+    Returns the method used.
+    """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            pass
+
+        size = os.fstat(fsrc.fileno()).st_size
+        os.ftruncate(fdest.fileno(), size)
+        for start, end in data_extents(fsrc.fileno(), size):
+            offset = start
+            while offset < end:
+                copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), end - offset, offset, offset)
+                if copied == 0:
+                    raise BuildError(f"Unexpected end of file while copying {src}")
+                offset += copied
+    return "sparse copy"
+
+
+def data_extents(fd: int, size: int) -> List[tuple[int, int]]:
+    """Return the (start, end) byte ranges of a file that contain data, skipping holes."""
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError:
+            break  # No data after offset
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        extents.append((start, min(end, size)))
+        offset = end
+    return extents
+
+
+def _ext4_spec(image_path: Path, partition: Partition) -> str:
+    """e2fsprogs device name addressing a partition inside an image file."""
+    return f"{image_path}?offset={partition.offset}"
+
+
+def debugfs_read(spec: str, path: str) -> Optional[bytes]:
+    """Read a file from an ext4 filesystem without mounting it (None if missing)."""
+    result = subprocess.run(["debugfs", "-R", f"cat {path}", spec], capture_output=True)
+    if result.returncode != 0 or b"not found" in result.stderr or b"Ext2 inode is not a directory" in result.stderr:
+        return None
+    return result.stdout
+
+
+def debugfs_exists(spec: str, path: str) -> bool:
+    """Check whether a path exists in an ext4 filesystem without mounting it."""
+    result = subprocess.run(["debugfs", "-R", f"stat {path}", spec], capture_output=True)
+    return result.returncode == 0 and b"not found" not in result.stderr
+
+
+def debugfs_write(spec: str, commands: List[str]) -> None:
+    """Run debugfs commands against an ext4 filesystem opened read-write."""
+    result = subprocess.run(
+        ["debugfs", "-w", "-f", "-", spec],
+        input="\n".join(commands) + "\n",
+        capture_output=True,
+        text=True
+    )
+    # debugfs keeps going after a failed command, so errors are only visible in its output
+    errors = [
+        line for line in result.stderr.splitlines()
+        if line.strip() and not line.startswith("debugfs") and "File not found by ext2_lookup" not in line
+    ]
+    if result.returncode != 0 or errors:
+        raise BuildError(f"debugfs failed on {spec}: {'; '.join(errors) or result.returncode}")
+
+
+def _lookup_user(passwd: bytes, username: str) -> tuple[int, int]:
+    for line in passwd.decode().splitlines():
+        fields = line.split(":")
+        if len(fields) >= 4 and fields[0] == username:
+            return int(fields[2]), int(fields[3])
+    raise BuildError(f"User {username} not found in image")
+
+
+def _lookup_group(group: bytes, name: str) -> int:
+    for line in group.decode().splitlines():
+        fields = line.split(":")
+        if len(fields) >= 3 and fields[0] == name:
+            return int(fields[2])
+    return 0
+
+
+def _hash_password(password: str) -> str:
+    result = subprocess.run(
+        ["openssl", "passwd", "-6", "-stdin"],
+        input=password, capture_output=True, text=True, check=True
+    )
+    return result.stdout.strip()
+
+
+def _replace_shadow_hash(shadow: bytes, username: str, password_hash: str) -> bytes:
+    lines = shadow.decode().splitlines()
+    for i, line in enumerate(lines):
+        fields = line.split(":")
+        if fields[0] == username:
+            fields[1] = password_hash
+            lines[i] = ":".join(fields)
+            return ("\n".join(lines) + "\n").encode()
+    raise BuildError(f"User {username} not found in /etc/shadow")
+
+
+def personalize_image(cfg: BuildConfig, image_path: Path, output_path: Path, robot: RobotOverride) -> str:
+    """Write one robot's settings into a copy of a finished image.
+
+    The root filesystem is edited in place with debugfs, without mounting,
+    booting or chrooting. Returns the copy method used.
+    """
+    if robot.username and robot.username != cfg.username:
+        raise BuildError(f"{robot.name}: changing the username from {cfg.username} requires a rebuild")
+
+    method = clone_file(image_path, output_path)
+    root = next((p for p in read_partition_table(output_path) if p.type in MBR_PARTITION_TYPES_EXT), None)
+    if root is None:
+        raise BuildError(f"No Linux root partition in {output_path}")
+    spec = _ext4_spec(output_path, root)
+    home = f"/home/{cfg.username}"
+
+    passwd = debugfs_read(spec, "/etc/passwd")
+    if passwd is None:
+        raise BuildError(f"No /etc/passwd in {output_path}")
+    uid, gid = _lookup_user(passwd, cfg.username)
+
+    with tempfile.TemporaryDirectory(prefix="tb3-personalize-") as tmp:
+        tmp_dir = Path(tmp)
+        commands: List[str] = []
+
+        def put(path: str, content: bytes, mode: int, owner: tuple[int, int] = (0, 0)) -> None:
+            local = tmp_dir / f"{len(commands)}"
+            local.write_bytes(content)
+            commands.extend([
+                f"rm {path}",
+                f"write {local} {path}",
+                f"sif {path} mode 0{0o100000 | mode:o}",
+                f"sif {path} uid {owner[0]}",
+                f"sif {path} gid {owner[1]}",
+            ])
+
+        if robot.ros_domain_id is not None:
+            # The chain, the systemd environment file and the login profile must agree;
+            # images built before the environment was precomputed only have the profile
+            for path, line, mode, required in [
+                (ROS_PROFILE_PATH, f"export ROS_DOMAIN_ID={robot.ros_domain_id}", 0o755, True),
+                (ROS_SETUP_PATH, f"export ROS_DOMAIN_ID={robot.ros_domain_id}", 0o644, False),
+                (ROS_ENV_PATH, f'ROS_DOMAIN_ID="{robot.ros_domain_id}"', 0o644, False),
+            ]:
+                content = debugfs_read(spec, path)
+                if content is None:
+                    if required:
+                        raise BuildError(f"No {path} in {output_path}")
+                    continue
+                content = re.sub(rb"(?m)^(export )?ROS_DOMAIN_ID=.*$", line.encode(), content)
+                put(path, content, mode)
+
+        if robot.password is not None:
+            shadow = debugfs_read(spec, "/etc/shadow")
+            if shadow is None:
+                raise BuildError(f"No /etc/shadow in {output_path}")
+            shadow_gid = _lookup_group(debugfs_read(spec, "/etc/group") or b"", "shadow")
+            put("/etc/shadow", _replace_shadow_hash(shadow, cfg.username, _hash_password(robot.password)),
+                0o640, (0, shadow_gid))
+
+        if robot.hostname_prefix is not None:
+            script_path = f"{home}/setup_scripts/get_hostname.py"
+            script = debugfs_read(spec, script_path)
+            if script is None:
+                raise BuildError(f"No {script_path} in {output_path}")
+            script = re.sub(rb'ROS_NAMESPACE_PREFIX: str = "[^"]*"',
+                            f'ROS_NAMESPACE_PREFIX: str = "{robot.hostname_prefix}"'.encode(), script)
+            put(script_path, script, 0o644, (uid, gid))
+
+        if robot.networks is not None:
+            networks = json.dumps([{"ssid": net.ssid, "password": net.password} for net in robot.networks])
+            if not debugfs_exists(spec, f"{home}/.config"):
+                commands.extend([
+                    f"mkdir {home}/.config",
+                    f"sif {home}/.config uid {uid}",
+                    f"sif {home}/.config gid {gid}",
+                ])
+            put(f"{home}/.config/networks.json", networks.encode() + b"\n", 0o644, (uid, gid))
+            if robot.networks:
+                # firstboot-network.service runs the network task while this marker exists
+                put(f"{home}/.setup_network", b"", 0o644, (uid, gid))
+
+        # Re-arm the first-boot setup services and keep passwordless sudo for the user
+        for marker in SETUP_MARKERS:
+            put(f"{home}/{marker}", b"", 0o644, (uid, gid))
+        put(f"/etc/sudoers.d/{cfg.username}", f"{cfg.username} ALL=(ALL) NOPASSWD:ALL\n".encode(), 0o440)
+
+        debugfs_write(spec, commands)
+    return method
+
+
+def ensure_raw_image(cfg: BuildConfig) -> Path:
+    """Return the raw image of a finished build, decompressing the compressed output once if needed."""
+    image_path = get_image_path(cfg)
+    if image_path.exists():
+        return image_path
+    for codec, ext in COMPRESSION_CODECS.items():
+        compressed = image_path.with_name(image_path.name + ext)
+        if ext and compressed.exists():
+            break
+    else:
+        raise BuildError(f"No built image found in {image_path.parent}")
+    print(f"Decompressing {compressed}...")
+    tmp_path = image_path.with_name(image_path.name + ".tmp")
+    with open(compressed, "rb") as src, open(tmp_path, "wb") as dest:
+        subprocess.run(decompressor_command(codec, sparse=True), stdin=src, stdout=dest, check=True)
+    os.replace(tmp_path, image_path)
+    return image_path
+
+
+def personalize_main(argv: List[str]) -> None:
+    """Entry point of the ``personalize`` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog="build.py personalize",
+        description="Write per-robot settings into copies of a finished image without rebuilding it.",
+    )
+    parser.add_argument("--config", "-c", type=Path, required=True,
+                        help="TOML configuration the image was built from")
+    parser.add_argument("--robots", "-r", type=Path, required=True,
+                        help="TOML file with one [[robot]] entry per image")
+    parser.add_argument("--image", type=Path,
+                        help="Raw image to personalize (default: the image in the build subdirectory)")
+    parser.add_argument("--output", "-o", type=Path,
+                        help="Output directory (default: <build subdirectory>/personalized)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="Images to personalize in parallel")
+    args = parser.parse_args(argv)
+
+    cfg = load_config(args.config)
+    compute_derived_values(cfg)
+    robots = load_robot_overrides(args.robots)
+    for robot in robots:
+        check = copy.deepcopy(cfg)
+        if robot.ros_domain_id is not None:
+            check.ros_domain_id = robot.ros_domain_id
+        validate_config(check)
+
+    image_path = args.image or ensure_raw_image(cfg)
+    output_dir = args.output or get_build_subdirectory(cfg) / "personalized"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    began = time.monotonic()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {
+            pool.submit(personalize_image, cfg, image_path, output_dir / f"{robot.name}.img", robot): robot
+            for robot in robots
+        }
+        for future in as_completed(futures):
+            robot = futures[future]
+            try:
+                method = future.result()
+                print(f"{robot.name}: {output_dir / (robot.name + '.img')} ({method})")
+            except (BuildError, OSError, subprocess.CalledProcessError) as e:
+                failed += 1
+                print(f"{robot.name}: failed: {e}", file=sys.stderr)
+    print(f"\nPersonalized {len(robots) - failed}/{len(robots)} images in {time.monotonic() - began:.1f}s")
+    if failed:
+        sys.exit(1)
+
+
+def bmap_main(argv: List[str]) -> None:
+    """Entry point of the ``bmap`` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog="build.py bmap",
+        description="Write a bmaptool-compatible block map for a raw (sparse) image.",
+    )
+    parser.add_argument("image", type=Path, help="Raw image file")
+    parser.add_argument("--output", "-o", type=Path,
+                        help="Bmap file to write (default: <image>.bmap)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="Ranges to hash in parallel")
+    args = parser.parse_args(argv)
+
+    if not args.image.is_file():
+        raise BuildError(f"Image not found: {args.image}")
+    bmap_path = args.output or args.image.with_name(args.image.name + ".bmap")
+    began = time.monotonic()
+    size, mapped = generate_bmap(args.image, bmap_path, workers=max(1, args.jobs))
+    print(f"{bmap_path}: {format_bytes(mapped)} of {format_bytes(size)} mapped "
+          f"({time.monotonic() - began:.1f}s)")
+
+
+FLASH_CHUNK_SIZE = 4 * 1024 * 1024
+FLASH_QUEUE_CHUNKS = 16
+
+
+class BmapError(BuildError):
+    """A block map is unreadable or does not match the image data."""
+
+
+@dataclass
+class Bmap:
+    """Parsed block map: image size, block size and (first, last, digest) ranges."""
+    image_size: int
+    block_size: int
+    checksum_type: str
+    ranges: List[tuple[int, int, Optional[str]]]
+
+
+@dataclass
+class FlashTarget:
+    """A device or file being flashed, fed by its own writer thread."""
+    path: Path
+    fd: int = -1
+    device: bool = False
+    created: bool = False
+    written: int = 0
+    seconds: float = 0.0
+    error: str = ""
+    chunks: queue.Queue = field(default_factory=lambda: queue.Queue(maxsize=FLASH_QUEUE_CHUNKS))
+
+
+def parse_bmap(bmap_path: Path) -> Bmap:
+    """Read a bmaptool block map, checking its own checksum."""
+    text = bmap_path.read_text()
+    try:
+        root = ElementTree.fromstring(text)
+        checksum_type = (root.findtext("ChecksumType") or "sha1").strip()
+        file_checksum = (root.findtext("BmapFileChecksum") or "").strip()
+        bmap = Bmap(
+            image_size=int(root.findtext("ImageSize")),
+            block_size=int(root.findtext("BlockSize")),
+            checksum_type=checksum_type,
+            ranges=[],
+        )
+        for element in root.iter("Range"):
+            first, _, last = element.text.strip().partition("-")
+            bmap.ranges.append((int(first), int(last or first), element.get("chksum")))
+    except (ElementTree.ParseError, TypeError, ValueError) as e:
+        raise BmapError(f"Invalid bmap file {bmap_path}: {e}") from None
+    if file_checksum:
+        zeroed = text.replace(file_checksum, "0" * len(file_checksum), 1)
+        if hashlib.new(checksum_type, zeroed.encode()).hexdigest() != file_checksum:
+            raise BmapError(f"Bmap file {bmap_path} is corrupted (checksum mismatch)")
+    return bmap
+
+
+def find_flash_source(cfg: BuildConfig) -> tuple[Path, Optional[str], Optional[Path]]:
+    """Return the built image to flash, its codec (None if raw) and its bmap if there is one."""
+    image_path = get_image_path(cfg)
+    codecs = [cfg.compression] + [c for c in COMPRESSION_CODECS if c != cfg.compression]
+    candidates = [(image_path.with_name(image_path.name + COMPRESSION_CODECS[c]), c) for c in codecs
+                  if COMPRESSION_CODECS[c]]
+    for path, codec in candidates + [(image_path, None)]:
+        if path.exists():
+            bmap_path = next((b for b in (path.with_name(path.name + ".bmap"),
+                                          image_path.with_name(image_path.name + ".bmap")) if b.exists()), None)
+            return path, codec, bmap_path
+    raise BuildError(f"No built image found in {image_path.parent}")
+
+
+def _mounted_sources() -> List[str]:
+    try:
+        with open("/proc/mounts") as f:
+            return [line.split()[0] for line in f]
+    except OSError:
+        return []
+
+
+def _device_and_partitions(device: str) -> set[str]:
+    """Return a block device's node and the nodes of its partitions."""
+    name = os.path.basename(device)
+    partitions = Path("/sys/class/block", name).glob("*/partition")
+    return {device} | {os.path.join(os.path.dirname(device), p.parent.name) for p in partitions}
+
+
+def open_flash_target(path: Path, image_size: int) -> FlashTarget:
+    """Open a block device or file for flashing, refusing mounted or too small devices.
+
+    Regular files are not truncated here, so a later target failing to open
+    leaves them untouched; see prepare_flash_targets.
+    """
+    target = FlashTarget(path=path)
+    if path.exists() and stat.S_ISBLK(os.stat(path).st_mode):
+        nodes = _device_and_partitions(os.path.realpath(path))
+        if any(os.path.realpath(source) in nodes for source in _mounted_sources() if source.startswith("/")):
+            raise BuildError(f"{path} or one of its partitions is mounted")
+        target.device = True
+        target.fd = os.open(path, os.O_WRONLY)
+        try:
+            device_size = os.lseek(target.fd, 0, os.SEEK_END)
+        except OSError:
+            os.close(target.fd)
+            raise
+        if device_size < image_size:
+            os.close(target.fd)
+            raise BuildError(f"{path} is smaller than the image ({format_bytes(device_size)} < {format_bytes(image_size)})")
+    else:
+        target.created = not path.exists()
+        target.fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    return target
+
+
+def prepare_flash_targets(paths: List[Path], image_size: int) -> List[FlashTarget]:
+    """Open every target, closing the ones already opened if any fails, then size the files."""
+    targets: List[FlashTarget] = []
+    try:
+        for path in paths:
+            targets.append(open_flash_target(path, image_size))
+    except BaseException:
+        for target in targets:
+            os.close(target.fd)
+            if target.created:
+                target.path.unlink(missing_ok=True)
+        raise
+    for target in targets:
+        if not target.device:
+            os.ftruncate(target.fd, 0)
+            os.ftruncate(target.fd, image_size)
+    return targets
+
+
+def _flash_writer(target: FlashTarget, began: float) -> None:
+    while True:
+        item = target.chunks.get()
+        if item is None:
+            break
+        if target.error:
+            continue  # Keep draining so the other targets are not held up
+        offset, data = item
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(target.fd, view, offset)
+                view = view[written:]
+                offset += written
+            target.written += len(data)
+        except OSError as e:
+            target.error = str(e)
+    if not target.error:
+        try:
+            os.fsync(target.fd)
+        except OSError as e:
+            target.error = str(e)
+    target.seconds = time.monotonic() - began
+
+
+def _stream_mapped(stream, bmap: Bmap):
+    """Yield (range index, offset, data) for the mapped parts of a sequential image stream."""
+    ranges = [(first * bmap.block_size, min((last + 1) * bmap.block_size, bmap.image_size))
+              for first, last, _ in bmap.ranges]
+    index = 0
+    position = 0
+    while index < len(ranges):
+        chunk = stream.read(FLASH_CHUNK_SIZE)
+        if not chunk:
+            raise BmapError("Image ended before the last mapped range")
+        chunk_end = position + len(chunk)
+        while index < len(ranges) and ranges[index][0] < chunk_end:
+            start, end = max(ranges[index][0], position), min(ranges[index][1], chunk_end)
+            yield index, start, chunk[start - position:end - position]
+            if ranges[index][1] > chunk_end:
+                break
+            index += 1
+        position = chunk_end
+
+
+def _read_mapped(fd: int, bmap: Bmap):
+    """Yield (range index, offset, data) for the mapped ranges of a raw image, reading only those."""
+    for index, (first, last, _) in enumerate(bmap.ranges):
+        offset = first * bmap.block_size
+        end = min((last + 1) * bmap.block_size, bmap.image_size)
+        while offset < end:
+            data = os.pread(fd, min(FLASH_CHUNK_SIZE, end - offset), offset)
+            if not data:
+                raise BmapError("Image ended before the last mapped range")
+            yield index, offset, data
+            offset += len(data)
+
+
+def flash_image(source: Path, codec: Optional[str], bmap: Bmap, targets: List[FlashTarget]) -> tuple[int, float]:
+    """Decompress an image once and write its mapped ranges to every target concurrently.
+
+    Each range is hashed as it streams past and checked against the bmap
+    before flashing finishes. Returns the bytes sent to each target and the
+    elapsed time.
+    """
+    began = time.monotonic()
+    writers = [threading.Thread(target=_flash_writer, args=(t, began), daemon=True) for t in targets]
+    for writer in writers:
+        writer.start()
+
+    process = None
+    source_file = open(source, "rb")
+    try:
+        if codec:
+            process = subprocess.Popen(decompressor_command(codec), stdin=source_file, stdout=subprocess.PIPE,
+                                       preexec_fn=os.setpgrp)
+            with _active_processes_lock:
+                _active_processes.add(process)
+            chunks = _stream_mapped(process.stdout, bmap)
+        else:
+            chunks = _read_mapped(source_file.fileno(), bmap)
+
+        total = 0
+        current = -1
+        digest = None
+        for index, offset, data in chunks:
+            if index != current:
+                _check_range_digest(bmap, current, digest)
+                current = index
+                digest = hashlib.new(bmap.checksum_type) if bmap.ranges[index][2] else None
+            if digest:
+                digest.update(data)
+            for target in targets:
+                target.chunks.put((offset, data))
+            total += len(data)
+        _check_range_digest(bmap, current, digest)
+    finally:
+        for target in targets:
+            target.chunks.put(None)
+        for writer in writers:
+            writer.join()
+        if process:
+            process.stdout.close()
+            process.terminate()
+            process.wait()
+            with _active_processes_lock:
+                _active_processes.discard(process)
+        source_file.close()
+        for target in targets:
+            os.close(target.fd)
+    return total, time.monotonic() - began
+
+
+def _check_range_digest(bmap: Bmap, index: int, digest) -> None:
+    if index >= 0 and digest is not None and digest.hexdigest() != bmap.ranges[index][2]:
+        first, last, _ = bmap.ranges[index]
+        raise BmapError(f"Checksum mismatch in blocks {first}-{last}: the image does not match its bmap")
+
+
+def flash_main(argv: List[str]) -> None:
+    """Entry point of the ``flash`` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog="build.py flash",
+        description="Flash a built image to several devices or files at once, decompressing it only once.",
+    )
+    parser.add_argument("targets", type=Path, nargs="+", help="Block devices or files to write")
+    parser.add_argument("--config", "-c", type=Path,
+                        help="TOML configuration the image was built from (selects the image in its build subdirectory)")
+    parser.add_argument("--image", type=Path, help="Image to flash instead (.img, .img.xz or .img.zst)")
+    parser.add_argument("--bmap", type=Path, help="Block map (default: next to the image)")
+    parser.add_argument("--yes", "-y", action="store_true", help="Do not ask before overwriting block devices")
+    args = parser.parse_args(argv)
+
+    if args.image:
+        source = args.image
+        codec = next((c for c, ext in COMPRESSION_CODECS.items() if ext and source.name.endswith(ext)), None)
+        bmap_path = args.bmap or next((b for b in (source.with_name(source.name + ".bmap"),
+                                                   source.with_suffix(".bmap")) if b.exists()), None)
+        if not source.is_file():
+            raise BuildError(f"Image not found: {source}")
+    elif args.config:
+        cfg = load_config(args.config)
+        compute_derived_values(cfg)
+        source, codec, bmap_path = find_flash_source(cfg)
+        bmap_path = args.bmap or bmap_path
+    else:
+        parser.error("one of --config or --image is required")
+
+    if bmap_path:
+        bmap = parse_bmap(bmap_path)
+    elif codec is None:
+        print("No bmap found; writing the data extents of the raw image without verification")
+        with open(source, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            bmap = Bmap(size, POSTPROCESS_BLOCK_SIZE, "sha256",
+                        [(first, last, None) for first, last in bmap_block_ranges(f.fileno(), size)])
+    else:
+        raise BuildError(f"No bmap found for {source}; the size of the compressed image is unknown")
+
+    devices = [t for t in args.targets if t.exists() and stat.S_ISBLK(os.stat(t).st_mode)]
+    if devices and not args.yes:
+        response = input(f"This will overwrite {', '.join(map(str, devices))}. Continue? (y/n): ").strip().lower()
+        if not response.startswith("y"):
+            print("Aborting operation.")
+            return
+
+    targets = prepare_flash_targets(args.targets, bmap.image_size)
+    mapped = sum(min((last + 1) * bmap.block_size, bmap.image_size) - first * bmap.block_size
+                 for first, last, _ in bmap.ranges)
+    print(f"Flashing {source} ({format_bytes(mapped)} mapped of {format_bytes(bmap.image_size)}) "
+          f"to {len(targets)} targets")
+    total, seconds = flash_image(source, codec, bmap, targets)
+
+    width = max(len(str(t.path)) for t in targets)
+    print("\nFlash summary:")
+    print("--------------")
+    for target in targets:
+        rate = target.written / target.seconds / 1024 / 1024 if target.seconds else 0.0
+        status = f"failed: {target.error}" if target.error else "ok"
+        print(f"{str(target.path):<{width}}  {format_bytes(target.written):>8}  {target.seconds:7.1f}s  "
+              f"{rate:7.1f} MB/s  {status}")
+    failed = sum(bool(t.error) for t in targets)
+    print(f"\n{len(targets) - failed}/{len(targets)} targets flashed and verified in {seconds:.1f}s "
+          f"({format_bytes(total)} decompressed once and written to each)")
+    if failed:
+        sys.exit(1)
+
+
+SERVE_DEFAULT_PORT = 8765
+SERVE_SPOOL_DIR = "serve"
+# Jobs in these states answer a new submission of the same resolved config
+SERVE_ACTIVE_STATES = {"queued", "preparing", "running"}
+SERVE_REUSED_STATES = SERVE_ACTIVE_STATES | {"success", "up-to-date"}
+SERVE_RESOURCES = ("cpus", "memory", "disk")
+
+
+class ServeConflict(BuildError):
+    """A submission clashes with a queued or running build."""
+    pass
+
+
+@dataclass
+class ServerJob:
+    """A build submitted to ``build.py serve`` and the resources it reserves while it runs."""
+    id: str
+    key: str
+    build: BuildJob
+    cpus: int
+    memory: int
+    disk: int
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+
+class BuildServer:
+    """Queue of submitted builds, run in order under a CPU, memory and disk budget.
+
+    Submissions whose resolved configuration (as recorded in the build
+    manifest) matches a queued, running or finished job return that job
+    instead of building again. A queued job starts once its reservation fits
+    in what the running builds leave of the budget; one build always runs.
+    """
+
+    def __init__(self, packer_file: str, cpus: int, memory: int, disk: int,
+                 offline: bool = False, force: bool = False) -> None:
+        self.packer_file = packer_file
+        self.offline = offline
+        self.force = force
+        self.budget = {"cpus": cpus, "memory": memory, "disk": disk}
+        self.reserved = {resource: 0 for resource in SERVE_RESOURCES}
+        self.max_builds = max(1, min(cpus // BUILD_CORES_PER_JOB, memory // BUILD_MEMORY_PER_JOB))
+        self.jobs: dict[str, ServerJob] = {}
+        self.queue: List[ServerJob] = []
+        self.condition = threading.Condition()
+        # progress_reporter finds the preparation display through a module global,
+        # so builds prepare one at a time
+        self.prepare_lock = threading.Lock()
+        # Each build's output goes to its own log in the spool directory
+        self.output = sys.stdout if isinstance(sys.stdout, ThreadOutput) else None
+        self.spool_dir = get_cache_dir() / SERVE_SPOOL_DIR
+        self.spool_dir.mkdir(exist_ok=True)
+        self._ids = itertools.count(1)
+
+    def submit(self, text: str) -> tuple[ServerJob, bool]:
+        """Queue a TOML config; returns the job and whether it is an earlier identical one."""
+        try:
+            data = tomllib.loads(text)
+        except tomllib.TOMLDecodeError as e:
+            raise BuildError(f"Invalid TOML: {e}") from None
+        try:
+            cfg = parse_config(data)
+            compute_derived_values(cfg)
+            validate_config(cfg)
+            key = hashlib.sha256(json.dumps(manifest_config(cfg), sort_keys=True).encode()).hexdigest()[:24]
+            build_subdir = get_build_subdirectory(cfg)
+            disk = parse_size(cfg.image_size) * 2
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # A field of the wrong type, e.g. image = 3 or ros.domain_id = "x"
+            raise BuildError(f"Invalid config: {type(e).__name__}: {e}") from None
+        if disk > self.budget["disk"]:
+            raise BuildError(f"Build needs {format_bytes(disk)} of disk, the budget is "
+                             f"{format_bytes(self.budget['disk'])}")
+
+        with self.condition:
+            for existing in self.jobs.values():
+                if existing.key == key and existing.build.status in SERVE_REUSED_STATES:
+                    return existing, True
+            for existing in self.jobs.values():
+                if (existing.build.status in SERVE_ACTIVE_STATES
+                        and get_build_subdirectory(existing.build.cfg) == build_subdir):
+                    raise ServeConflict(f"Build {existing.id} is already building into {build_subdir}")
+            job_id = f"{next(self._ids)}-{key[:8]}"
+            config_path = self.spool_dir / f"{job_id}.toml"
+            config_path.write_text(text)
+            job = ServerJob(
+                id=job_id, key=key, build=BuildJob(cfg=cfg, config_path=config_path, status="queued"),
+                cpus=min(BUILD_CORES_PER_JOB, self.budget["cpus"]),
+                memory=min(BUILD_MEMORY_PER_JOB, self.budget["memory"]),
+                disk=disk,
+            )
+            self.jobs[job_id] = job
+            self.queue.append(job)
+            self.condition.notify_all()
+        print(f"Queued build {job_id}: {build_subdir}")
+        return job, False
+
+    def cancel(self, job: ServerJob) -> None:
+        with self.condition:
+            if job not in self.queue:
+                raise ServeConflict(f"Build {job.id} is {job.build.status}; only queued builds can be cancelled")
+            self.queue.remove(job)
+            job.build.status = "cancelled"
+            job.finished = time.time()
+        print(f"Cancelled build {job.id}")
+
+    def _fits(self, job: ServerJob) -> bool:
+        if not any(self.reserved.values()):
+            return True
+        if shutil.disk_usage(Path.cwd()).free < job.disk:
+            return False
+        return all(self.reserved[r] + getattr(job, r) <= self.budget[r] for r in SERVE_RESOURCES)
+
+    def schedule(self) -> None:
+        """Start queued builds in order as the budget allows; runs until the process exits."""
+        while True:
+            with self.condition:
+                while not (self.queue and self._fits(self.queue[0])):
+                    self.condition.wait()
+                job = self.queue.pop(0)
+                for resource in SERVE_RESOURCES:
+                    self.reserved[resource] += getattr(job, resource)
+                job.build.status = "preparing"
+                job.started = time.time()
+            threading.Thread(target=self._run, args=(job,), name=f"build-{job.id}", daemon=True).start()
+
+    def output_path(self, job: ServerJob) -> Path:
+        return self.spool_dir / f"{job.id}.log"
+
+    def _run(self, job: ServerJob) -> None:
+        print(f"Starting build {job.id} (output: {self.output_path(job)})")
+        with open(self.output_path(job), "w", buffering=1) as output:
+            if self.output:
+                with self.output.use(output):
+                    self._build(job)
+            else:
+                self._build(job)
+        print(f"Finished build {job.id}: {job.build.status}"
+              + (f" ({job.build.error})" if job.build.error else ""))
+
+    def _build(self, job: ServerJob) -> None:
+        build = job.build
+        cfg = build.cfg
+        try:
+            # An unchanged build needs no download, pull or cache refresh
+            inputs = None if self.force else cached_build_inputs(cfg, self.packer_file)
+            if inputs is not None and check_build_manifest(cfg, inputs):
+                build.status = "up-to-date"
+                return
+            with self.prepare_lock:
+                source_paths = prepare_shared_inputs([cfg], self.packer_file, offline=self.offline)
+                cfg.compile_jobs = compile_parallelism(cfg, self.max_builds, cpus=self.budget["cpus"],
+                                                       memory=self.budget["memory"])
+                collect_build_inputs([build], self.packer_file, source_paths)
+                up_to_date = not self.force and check_build_manifest(cfg, build.inputs)
+                if not up_to_date:
+                    prepare_build_directory(build, auto_yes=True)
+            if up_to_date:
+                build.status = "up-to-date"
+            else:
+                _run_matrix_job(build, self.packer_file, source_paths[cfg.source_url], self.offline)
+        except Exception as e:
+            # Anything escaping here would leave the job running forever in the API
+            build.status = "failed"
+            build.error = str(e) or type(e).__name__
+            print(f"Build {job.id} failed: {build.error}")
+        finally:
+            job.finished = time.time()
+            with self.condition:
+                for resource in SERVE_RESOURCES:
+                    self.reserved[resource] -= getattr(job, resource)
+                self.condition.notify_all()
+
+    def record(self, job: ServerJob) -> dict:
+        """JSON description of a job for the API."""
+        cfg = job.build.cfg
+        build_subdir = get_build_subdirectory(cfg)
+        with self.condition:
+            position = self.queue.index(job) + 1 if job in self.queue else None
+        finished = job.build.status in ("success", "up-to-date")
+        return {
+            "id": job.id,
+            "status": job.build.status,
+            "error": job.build.error or None,
+            "queue_position": position,
+            "name": cfg.name,
+            "model": cfg.turtlebot3_model,
+            "version": cfg.computed_version,
+            "build_directory": str(build_subdir),
+            "log": str(build_subdir / "packer.log"),
+            "output": str(self.output_path(job)),
+            "artifacts": [str(path) for path in build_outputs(cfg) if path.exists()] if finished else [],
+            "submitted": job.submitted,
+            "started": job.started,
+            "finished": job.finished,
+            "seconds": round(job.build.seconds, 1),
+            "reservation": {"cpus": job.cpus, "memory": job.memory, "disk": job.disk},
+        }
+
+    def status(self) -> dict:
+        with self.condition:
+            jobs = list(self.jobs.values())
+            return {
+                "budget": dict(self.budget),
+                "reserved": dict(self.reserved),
+                "queued": len(self.queue),
+                "jobs": {state: sum(job.build.status == state for job in jobs)
+                         for state in sorted({job.build.status for job in jobs})},
+            }
+
+
+class _ServeHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP API of ``build.py serve`` (JSON, plus plain-text logs)."""
+    server_version = "tb3-build-server"
+
+    def address_string(self) -> str:
+        # Unix-socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format: str, *args) -> None:
+        print(f"serve: {self.address_string()} {format % args}")
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json",
+              headers: Optional[dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data) -> None:
+        self._send(status, (json.dumps(data, indent=2) + "\n").encode())
+
+    def _route(self) -> tuple[List[str], dict[str, List[str]], Optional[ServerJob]]:
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        job = self.server.build_server.jobs.get(parts[1]) if len(parts) > 1 and parts[0] == "builds" else None
+        return parts, urllib.parse.parse_qs(url.query), job
+
+    def do_GET(self) -> None:
+        server = self.server.build_server
+        parts, query, job = self._route()
+        if parts == ["status"]:
+            self._send_json(200, server.status())
+        elif parts == ["builds"]:
+            self._send_json(200, [server.record(job) for job in list(server.jobs.values())])
+        elif job and len(parts) == 2:
+            self._send_json(200, server.record(job))
+        elif job and parts[2:] in (["log"], ["output"]):
+            if parts[2] == "log":
+                log_path = get_build_subdirectory(job.build.cfg) / "packer.log"
+            else:
+                log_path = server.output_path(job)
+            try:
+                offset = int(query.get("offset", ["0"])[0] or 0)
+                if offset < 0:
+                    raise ValueError(offset)
+            except ValueError:
+                self._send_json(400, {"error": f"Invalid offset: {query['offset'][0]}"})
+                return
+            try:
+                with open(log_path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    f.seek(min(offset, size))
+                    body = f.read()
+            except FileNotFoundError:
+                size, body = 0, b""
+            self._send(200, body, "text/plain; charset=utf-8", {"X-Log-Size": str(size)})
+        else:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self) -> None:
+        parts, _, _ = self._route()
+        if parts != ["builds"]:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            text = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid request body: {e}"})
+            return
+        try:
+            job, duplicate = self.server.build_server.submit(text)
+        except ServeConflict as e:
+            self._send_json(409, {"error": str(e)})
+        except BuildError as e:
+            self._send_json(400, {"error": str(e)})
+        else:
+            self._send_json(200 if duplicate else 202,
+                            {**self.server.build_server.record(job), "duplicate": duplicate})
+
+    def do_DELETE(self) -> None:
+        parts, _, job = self._route()
+        if not job or len(parts) != 2:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            self.server.build_server.cancel(job)
+        except ServeConflict as e:
+            self._send_json(409, {"error": str(e)})
+        else:
+            self._send_json(200, self.server.build_server.record(job))
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_main(argv: List[str]) -> None:
+    """Entry point of the ``serve`` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog="build.py serve",
+        description="Queue and run builds submitted over a local HTTP API, sharing one cache and budget.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=SERVE_DEFAULT_PORT,
+                        help=f"TCP port to listen on (default: {SERVE_DEFAULT_PORT})")
+    parser.add_argument("--socket", type=Path, help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--packer-file", "-p", default="packer_ubuntu_server.json",
+                        help="Path to Packer configuration file (default: packer_ubuntu_server.json)")
+    parser.add_argument("--cpus", type=int, default=os.cpu_count() or 1,
+                        help="CPU cores builds may use (default: all)")
+    parser.add_argument("--memory", help="Memory builds may use, e.g. 32G (default: available memory)")
+    parser.add_argument("--disk", help="Disk space builds may use, e.g. 200G (default: free space)")
+    parser.add_argument("--offline", action="store_true",
+                        help="Build only from cached source and builder images")
+    parser.add_argument("--force", "-f", action="store_true",
+                        help="Rebuild even if the build manifest shows the inputs are unchanged")
+    args = parser.parse_args(argv)
+
+    if not check_sudo() and not prompt_sudo():
+        raise BuildError("sudo permissions are required")
+    # Installed once, before any build thread starts; each build then prints to its own log
+    sys.stdout = ThreadOutput(sys.stdout)
+    memory = parse_size(args.memory) if args.memory else available_memory()
+    disk = parse_size(args.disk) if args.disk else shutil.disk_usage(Path.cwd()).free
+    build_server = BuildServer(args.packer_file, max(1, args.cpus), memory, disk,
+                               offline=args.offline, force=args.force)
+    threading.Thread(target=build_server.schedule, name="scheduler", daemon=True).start()
+
+    if args.socket:
+        args.socket.unlink(missing_ok=True)
+        httpd = _UnixHTTPServer(str(args.socket), _ServeHandler)
+        address = f"unix:{args.socket}"
+    else:
+        httpd = http.server.ThreadingHTTPServer((args.host, args.port), _ServeHandler)
+        address = f"http://{args.host}:{httpd.server_address[1]}"
+    httpd.build_server = build_server
+    print(f"Serving builds on {address} (budget: {args.cpus} CPUs, {format_bytes(memory)} memory, "
+          f"{format_bytes(disk)} disk; up to {build_server.max_builds} builds at once)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping; terminating running builds...")
+        terminate_active_processes()
+    finally:
+        httpd.server_close()
+        if args.socket:
+            args.socket.unlink(missing_ok=True)
+
+
+SUBCOMMANDS = {
+    "personalize": personalize_main,
+    "bmap": bmap_main,
+    "flash": flash_main,
+    "serve": serve_main,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build TurtleBot3 custom Ubuntu images using TOML configuration files.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Build with a config file
+  python build.py --config configs/production.toml
+
+  # Dry run to validate config
+  python build.py --config configs/production.toml --dry-run
+
+  # Build without confirmation prompt
+  python build.py --config configs/production.toml -y
+
+  # Verbose output
+  python build.py --config configs/production.toml --verbose
+
+  # Re-hash the cached source image even if it is unchanged
+  python build.py --config configs/production.toml --reverify
+
+  # Build without network access from the cached image and manifest
+  python build.py --config configs/production.toml --offline
+
+  # Rebuild even though the inputs are unchanged
+  python build.py --config configs/production.toml --force
+
+  # Continue a failed build from the last completed provisioner script
+  python build.py --config configs/production.toml --resume
+
+  # Build several configs, sharing downloads and running Packer in parallel
+  python build.py --config configs/burger.toml configs/waffle.toml -y
+
+  # Build every variant of a matrix file, at most two at a time
+  python build.py --matrix configs/matrix.toml --jobs 2 -y
+
+  # Write per-robot settings into copies of a finished image
+  python build.py personalize --config configs/production.toml --robots configs/robots.toml
+
+  # Write a bmap for a raw image without bmaptool
+  python build.py bmap build/<subdir>/<image>.img
+
+  # Flash the built image to several SD cards at once
+  python build.py flash --config configs/production.toml /dev/sdb /dev/sdc /dev/sdd
+
+  # Queue builds from several users through one local build server
+  python build.py serve --memory 32G --disk 200G
+
+Config File Structure:
+  The [network] section is optional. If included with an SSID, network
+  connection will be added automatically. Remove or comment out the entire
+  [network] section to skip network setup.
+
+  See configs/example.toml for a complete example.
+        """
+    )
+    
+    parser.add_argument(
+        "--config", "-c",
+        type=Path,
+        nargs="+",
+        default=[],
+        help="Path to TOML configuration file (several may be given)"
+    )
+    
+    parser.add_argument(
+        "--matrix", "-m",
+        type=Path,
+        help="Path to TOML build matrix file"
+    )
+    
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=0,
+        help="Maximum parallel builds when building several configs (default: based on cores, RAM and disk)"
+    )
+    
+    parser.add_argument(
+        "--packer-file", "-p",
+        default="packer_ubuntu_server.json",
+        help="Path to Packer configuration file (default: packer_ubuntu_server.json)"
+    )
+    
+    parser.add_argument(
+        "--dry-run", "-d",
+        action="store_true",
+        help="Show configuration without running build"
     )
     
     parser.add_argument(
@@ -682,23 +5153,72 @@ Config File Structure:
         help="Skip confirmation prompt"
     )
     
+    parser.add_argument(
+        "--reverify",
+        action="store_true",
+        help="Fully re-hash the cached source image instead of trusting its verification record"
+    )
+    
+    parser.add_argument(
+        "--refresh-builder",
+        action="store_true",
+        help="Pull the Packer builder image even if it is already present locally"
+    )
+    
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Build only from the cached source image and checksum manifest (no network access)"
+    )
+    
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Restart a failed build from its newest checkpoint (implies advanced.checkpoints)"
+    )
+    
+    parser.add_argument(
+        "--force", "-f",
+        action="store_true",
+        help="Rebuild even if the build manifest shows the inputs are unchanged"
+    )
+    
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        try:
+            SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        except BuildError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    
     args = parser.parse_args()
+    if not args.config and not args.matrix:
+        parser.error("one of --config or --matrix is required")
     
     try:
         # Load and validate configuration
-        cfg = load_config(args.config)
-        
-        if args.verbose:
-            cfg.verbose = True
-        
-        compute_derived_values(cfg)
-        validate_config(cfg)
+        jobs = [BuildJob(cfg=load_config(path), config_path=path) for path in args.config]
+        if args.matrix:
+            jobs += [BuildJob(cfg=parse_config(data), config_path=args.matrix) for data in expand_matrix(args.matrix)]
         
-        # Handle network configuration (prompt for missing values if network section exists)
-        prompt_missing_network_config(cfg)
+        for job in jobs:
+            cfg = job.cfg
+            if args.verbose:
+                cfg.verbose = True
+            
+            compute_derived_values(cfg)
+            validate_config(cfg)
+            
+            # Handle network configuration (prompt for missing values if network section exists)
+            prompt_missing_network_config(cfg)
+            
+            # Display configuration
+            display_config(cfg)
         
-        # Display configuration
-        display_config(cfg)
+        build_subdirs = [get_build_subdirectory(job.cfg) for job in jobs]
+        duplicates = sorted({str(d) for d in build_subdirs if build_subdirs.count(d) > 1})
+        if duplicates:
+            raise BuildError(f"Several configs build into the same directory: {', '.join(duplicates)}")
         
         # Check for dry run
         if args.dry_run:
@@ -712,39 +5232,68 @@ Config File Structure:
         
         print("\nProceeding with the build process...")
         
-        # Create build subdirectory
-        build_subdir = get_build_subdirectory(cfg)
-        build_subdir.mkdir(parents=True, exist_ok=True)
-        print(f"Build directory: {build_subdir}")
-        
-        # Save configuration to build directory (with all defaults)
-        save_config_to_build_dir(cfg, build_subdir)
-        print(f"Configuration saved to: {build_subdir}/build_config.toml")
-        
-        # Copy original config file to build directory
-        original_config_dest = build_subdir / args.config.name
-        shutil.copy2(args.config, original_config_dest)
-        print(f"Original config copied to: {original_config_dest}")
-        
-        # Check output file doesn't exist
-        check_output_file(cfg, auto_yes=args.yes)
-        
         # Check sudo permissions
         if not check_sudo():
             if not prompt_sudo():
                 raise BuildError("sudo permissions are required")
         
-        # Download source image
-        source_image_path = download_source_image(cfg)
+        # Skip builds whose recorded inputs are unchanged, judged from the cached source image and
+        # the local builder image, before any checksum fetch, pull or APT and git cache refresh
+        checked: dict[int, dict] = {}
+        if not (args.force or args.reverify or args.refresh_builder):
+            for job in jobs:
+                inputs = cached_build_inputs(job.cfg, args.packer_file)
+                if inputs is None:
+                    continue
+                if check_build_manifest(job.cfg, inputs):
+                    job.status = "up-to-date"
+                else:
+                    checked[id(job)] = inputs
+        candidates = [job for job in jobs if job.status != "up-to-date"]
         
-        # Pull Packer image
-        pull_packer_image(cfg)
+        pending = []
+        if candidates:
+            # Download source images and pull Packer images once for the builds that remain
+            cfgs = [job.cfg for job in candidates]
+            source_paths = prepare_shared_inputs(cfgs, args.packer_file, reverify=args.reverify,
+                                                 offline=args.offline, refresh_builder=args.refresh_builder)
+            
+            # Split the host between the compile steps of the builds that run at once
+            concurrent_builds = 1 if len(cfgs) == 1 else min(len(cfgs), args.jobs or max_parallel_builds(cfgs))
+            for cfg in cfgs:
+                cfg.compile_jobs = compile_parallelism(cfg, concurrent_builds)
+            print(f"Compile jobs per build: {', '.join(sorted({str(cfg.compile_jobs) for cfg in cfgs}))}")
+            
+            # A build checked above is only checked again if preparing it changed its inputs
+            collect_build_inputs(candidates, args.packer_file, source_paths)
+            for job in candidates:
+                if (not args.force and checked.get(id(job)) != job.inputs
+                        and check_build_manifest(job.cfg, job.inputs)):
+                    job.status = "up-to-date"
+                    continue
+                prepare_build_directory(job, auto_yes=args.yes)
+                pending.append(job)
         
-        # Run build
-        run_packer_build(cfg, args.packer_file, source_image_path)
-        
-        print("\nBuild completed successfully!")
-        print(f"Output files in: {build_subdir}")
+        if not pending:
+            print("\nNothing to build.")
+        elif len(jobs) == 1:
+            # Run build
+            cfg = jobs[0].cfg
+            metrics = run_packer_build(cfg, args.packer_file, source_paths[cfg.source_url], offline=args.offline,
+                                       resume=args.resume)
+            write_build_manifest(cfg, jobs[0].inputs)
+            print_build_metrics(metrics)
+            
+            print("\nBuild completed successfully!")
+            print(f"Output files in: {get_build_subdirectory(cfg)}")
+        else:
+            began = time.monotonic()
+            max_workers = args.jobs or max_parallel_builds([job.cfg for job in pending])
+            run_build_matrix(pending, args.packer_file, source_paths, max_workers, offline=args.offline,
+                             resume=args.resume)
+            print_matrix_report(jobs, time.monotonic() - began)
+            if any(job.status not in ("success", "up-to-date") for job in jobs):
+                sys.exit(1)
         
     except BuildError as e:
         print(f"Error: {e}", file=sys.stderr)
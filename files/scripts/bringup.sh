@@ -1,8 +1,5 @@
 #!/bin/bash
 set -eux -o pipefail
 
-set +u
-source /etc/profile.d/90-turtlebot-ros-profile.sh
-set -u
-
+# The ROS environment comes from /etc/turtlebot3/ros.env (EnvironmentFile= in bringup.service)
 ros2 launch turtlebot3_bringup robot.launch.py
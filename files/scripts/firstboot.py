@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+First-boot setup orchestrator.
+
+Runs the setup_*.sh tasks from a declared dependency graph, starting each
+task as soon as the tasks it depends on have finished. A task only runs
+while its marker file exists; the scripts remove their marker when done,
+so later boots skip them. Per-task durations and results are written to
+a JSON log for collection across robots.
+
+The tasks are split into stages that systemd orders around network.target:
+the network stage (firstboot-network.service) runs before it and the
+system stage (firstboot.service) after it. Without --stage every task runs.
+
+Usage:
+    python3 firstboot.py --stage network      # run on the robot (firstboot-network.service)
+    python3 firstboot.py --stage system       # run on the robot (firstboot.service)
+    python3 firstboot.py --stub --log-dir /tmp/firstboot
+    python3 firstboot.py --stub --fail network --log-dir /tmp/firstboot
+
+--stub replaces every task with a sleep of a typical duration and ignores
+the markers, so the graph can be exercised on any Linux host.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+DEFAULT_LOG_DIR = Path("/var/log/turtlebot3")
+
+
+@dataclass
+class Task:
+    """One setup step: its script, the marker that arms it and the tasks it waits for."""
+    name: str
+    script: str
+    marker: str
+    stage: str
+    after: List[str] = field(default_factory=list)
+    # Typical duration on a Raspberry Pi, used by --stub
+    stub_seconds: float = 0.5
+
+
+# Stages in the order systemd runs them
+STAGES = ["network", "system"]
+
+# The hostname must be set before the network comes up with it; every other
+# task is independent, so the OpenCR flash no longer holds the rest back.
+TASKS = [
+    Task("hostname", "setup_hostname.sh", ".setup_hostname", "network", stub_seconds=0.3),
+    Task("network", "setup_network.sh", ".setup_network", "network", after=["hostname"], stub_seconds=1.0),
+    Task("firewall", "setup_firewall.sh", ".setup_firewall", "system", stub_seconds=0.8),
+    Task("opencr", "setup_opencr.sh", ".setup_opencr", "system", stub_seconds=3.0),
+    Task("camera", "setup_camera.sh", ".setup_camera", "system", stub_seconds=0.2),
+    Task("ros", "setup_ros.sh", ".setup_ros", "system", stub_seconds=2.0),
+]
+
+
+@dataclass
+class TaskResult:
+    name: str
+    status: str = "pending"
+    started: Optional[float] = None
+    seconds: float = 0.0
+    returncode: Optional[int] = None
+    log: Optional[str] = None
+
+
+def sd_notify(message: str) -> None:
+    """Send a state change to systemd when running as a Type=notify service."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(message.encode(), address)
+        except OSError:
+            pass
+
+
+def validate_graph(tasks: List[Task]) -> None:
+    """Reject unknown stages, unknown or later-stage dependencies and cycles."""
+    stages = {task.name: task.stage for task in tasks}
+    for task in tasks:
+        if task.stage not in STAGES:
+            raise SystemExit(f"Task {task.name} has unknown stage {task.stage}")
+        for dependency in task.after:
+            if dependency not in stages:
+                raise SystemExit(f"Task {task.name} depends on unknown task {dependency}")
+            if STAGES.index(stages[dependency]) > STAGES.index(task.stage):
+                raise SystemExit(f"Task {task.name} depends on {dependency} from the later "
+                                 f"{stages[dependency]} stage")
+    remaining = {task.name: set(task.after) for task in tasks}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise SystemExit(f"Dependency cycle between tasks: {', '.join(sorted(remaining))}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+class Orchestrator:
+    """Runs the task graph with at most ``jobs`` tasks at a time."""
+
+    def __init__(self, tasks: List[Task], home: Path, log_dir: Path, jobs: int,
+                 stub: bool = False, fail: Optional[List[str]] = None) -> None:
+        self.tasks = {task.name: task for task in tasks}
+        self.home = home
+        self.log_dir = log_dir
+        self.stub = stub
+        self.fail = set(fail or [])
+        self.results: Dict[str, TaskResult] = {task.name: TaskResult(task.name) for task in tasks}
+        self.slots = threading.Semaphore(max(1, jobs))
+        # Re-entrant, so the scheduler can record skipped and blocked tasks while holding it
+        self.condition = threading.Condition(threading.RLock())
+        self.started = time.time()
+
+    def command(self, task: Task) -> List[str]:
+        if self.stub:
+            code = 1 if task.name in self.fail else 0
+            return ["sh", "-c", f"echo 'stub {task.name}'; sleep {task.stub_seconds}; exit {code}"]
+        return ["/bin/bash", str(SCRIPTS_DIR / task.script)]
+
+    def armed(self, task: Task) -> bool:
+        return self.stub or (self.home / task.marker).exists()
+
+    def run_task(self, task: Task) -> None:
+        result = self.results[task.name]
+        with self.slots:
+            result.started = time.time()
+            log_path = self.log_dir / f"firstboot-{task.name}.log"
+            result.log = str(log_path)
+            print(f"[{result.started - self.started:7.2f}s] start {task.name}", flush=True)
+            with open(log_path, "w") as log_file:
+                process = subprocess.run(self.command(task), stdout=log_file, stderr=subprocess.STDOUT)
+            result.seconds = time.time() - result.started
+            result.returncode = process.returncode
+        self.finish(task.name, "success" if process.returncode == 0 else "failed")
+
+    def finish(self, name: str, status: str) -> None:
+        result = self.results[name]
+        with self.condition:
+            result.status = status
+            done = sum(r.status not in ("pending", "running") for r in self.results.values())
+            print(f"[{time.time() - self.started:7.2f}s] {status} {name}"
+                  + (f" ({result.seconds:.1f}s)" if result.started else ""), flush=True)
+            sd_notify(f"STATUS={done}/{len(self.results)} setup tasks finished")
+            self.condition.notify_all()
+
+    def run(self) -> bool:
+        """Run every task once its dependencies finished; returns whether none failed."""
+        threads = []
+        with self.condition:
+            while True:
+                changed = False
+                for name, task in self.tasks.items():
+                    if self.results[name].status != "pending":
+                        continue
+                    # Dependencies from an earlier stage finished before this stage's unit started
+                    deps = [self.results[dep].status for dep in task.after if dep in self.results]
+                    if any(status in ("failed", "blocked") for status in deps):
+                        self.finish(name, "blocked")
+                        changed = True
+                    elif all(status in ("success", "skipped") for status in deps):
+                        changed = True
+                        if not self.armed(task):
+                            self.finish(name, "skipped")
+                            continue
+                        self.results[name].status = "running"
+                        thread = threading.Thread(target=self.run_task, args=(task,), name=name)
+                        thread.start()
+                        threads.append(thread)
+                if all(r.status not in ("pending", "running") for r in self.results.values()):
+                    break
+                # A skipped or blocked task may have released tasks earlier in the list
+                if not changed:
+                    self.condition.wait()
+        for thread in threads:
+            thread.join()
+        return not any(r.status in ("failed", "blocked") for r in self.results.values())
+
+    def anything_ran(self) -> bool:
+        return any(r.status != "skipped" for r in self.results.values())
+
+    def write_log(self, ok: bool, path: Path) -> Path:
+        record = {
+            "hostname": socket.gethostname(),
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 3),
+            "status": "success" if ok else "failed",
+            "stub": self.stub,
+            "tasks": [
+                {**result.__dict__,
+                 "after": self.tasks[name].after,
+                 "started": round(result.started - self.started, 3) if result.started else None,
+                 "seconds": round(result.seconds, 3)}
+                for name, result in self.results.items()
+            ],
+        }
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(record, f, indent=2)
+            f.write("\n")
+        os.replace(tmp_path, path)
+        return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the TurtleBot3 first-boot setup tasks.")
+    parser.add_argument("--stage", choices=STAGES,
+                        help="Run only the tasks of one stage (default: every task)")
+    parser.add_argument("--jobs", "-j", type=int, default=len(TASKS),
+                        help="Tasks to run at once (default: all that are ready)")
+    parser.add_argument("--log-dir", type=Path, default=DEFAULT_LOG_DIR,
+                        help=f"Directory for firstboot.json and the task logs (default: {DEFAULT_LOG_DIR})")
+    parser.add_argument("--stub", action="store_true",
+                        help="Replace every task with a sleep, for testing the graph on any host")
+    parser.add_argument("--fail", action="append", default=[], metavar="TASK",
+                        help="With --stub, make TASK fail (repeatable)")
+    args = parser.parse_args()
+
+    validate_graph(TASKS)
+    unknown = set(args.fail) - {task.name for task in TASKS}
+    if unknown:
+        parser.error(f"Unknown task: {', '.join(sorted(unknown))}")
+
+    home = Path("/home") / os.environ.get("USERNAME", "robot")
+    args.log_dir.mkdir(parents=True, exist_ok=True)
+    tasks = [task for task in TASKS if args.stage in (None, task.stage)]
+    orchestrator = Orchestrator(tasks, home, args.log_dir, args.jobs, stub=args.stub, fail=args.fail)
+    sd_notify("STATUS=Running first-boot setup")
+    ok = orchestrator.run()
+    log_path = args.log_dir / (f"firstboot-{args.stage}.json" if args.stage else "firstboot.json")
+    if orchestrator.anything_ran():
+        orchestrator.write_log(ok, log_path)
+        print(f"First-boot setup {'finished' if ok else 'failed'} in "
+              f"{time.time() - orchestrator.started:.1f}s (log: {log_path})")
+    else:
+        # Every later boot lands here; keep the record of the boot that did the setup
+        print(f"No first-boot setup tasks armed, leaving {log_path} as it is")
+    sd_notify("READY=1")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
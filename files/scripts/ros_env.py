@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Precompute the ROS environment so services and logins do not source setup.bash.
+
+/etc/turtlebot3/ros-setup.bash holds the sourcing chain (ROS, the TurtleBot3
+workspace and the robot settings). ``generate`` resolves it once in a clean
+shell and writes:
+
+- /etc/turtlebot3/ros.env: KEY="value" lines for systemd EnvironmentFile=
+- /etc/profile.d/90-turtlebot-ros-profile.sh: the same variables as plain
+  exports, with PATH-like variables prepended to the login value
+
+``check`` re-sources the chain and fails if either file no longer produces
+the same environment.
+
+Usage:
+    python3 ros_env.py generate
+    python3 ros_env.py check
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, Tuple
+
+ROS_SETUP_PATH = Path("/etc/turtlebot3/ros-setup.bash")
+ROS_ENV_PATH = Path("/etc/turtlebot3/ros.env")
+ROS_PROFILE_PATH = Path("/etc/profile.d/90-turtlebot-ros-profile.sh")
+ROS_ALIASES_PATH = Path("/etc/turtlebot3/ros-aliases.sh")
+
+# The PATH systemd gives services, so the clean shell does not fall back to bash's built-in one
+DEFAULT_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+# Variables every bash sets for itself
+SHELL_VARIABLES = {"SHLVL", "_", "PWD", "OLDPWD"}
+# Characters that would need different escaping in systemd and in the shell
+UNSAFE_CHARACTERS = set('"\\$`\n')
+
+
+def shell_environment(script: str = "") -> Dict[str, str]:
+    """Environment of a clean, non-login bash after running ``script``."""
+    output = subprocess.run(
+        ["env", "-i", "HOME=/root", f"PATH={DEFAULT_PATH}",
+         "bash", "--noprofile", "--norc", "-c", f"set +u\n{script}\nenv -0"],
+        check=True, capture_output=True,
+    ).stdout.decode()
+    environment = {}
+    for entry in output.split("\0"):
+        if "=" in entry:
+            key, value = entry.split("=", 1)
+            if key not in SHELL_VARIABLES:
+                environment[key] = value
+    return environment
+
+
+def resolve() -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Return the clean baseline environment and the variables the chain sets or changes."""
+    baseline = shell_environment()
+    resolved = shell_environment(f"source {ROS_SETUP_PATH}")
+    changed = {key: value for key, value in resolved.items() if baseline.get(key) != value}
+    for key, value in changed.items():
+        if UNSAFE_CHARACTERS & set(value):
+            raise SystemExit(f"{key} contains characters that cannot be written to {ROS_ENV_PATH}: {value!r}")
+    return baseline, changed
+
+
+def env_file(changed: Dict[str, str]) -> str:
+    lines = [f"# Generated by ros_env.py from {ROS_SETUP_PATH}; do not edit"]
+    lines += [f'{key}="{value}"' for key, value in sorted(changed.items())]
+    return "\n".join(lines) + "\n"
+
+
+def profile(baseline: Dict[str, str], changed: Dict[str, str]) -> str:
+    lines = [f"# Generated by ros_env.py from {ROS_SETUP_PATH}; edit that file and run"
+             f" 'python3 ros_env.py generate'"]
+    for key, value in sorted(changed.items()):
+        base = baseline.get(key)
+        if base and value.endswith(":" + base):
+            # Keep what the login shell already added, e.g. /snap/bin on PATH
+            lines.append(f'export {key}="{value[:-len(base)]}${key}"')
+        else:
+            lines.append(f'export {key}="{value}"')
+    if ROS_ALIASES_PATH.exists():
+        lines.append(f". {ROS_ALIASES_PATH}")
+    return "\n".join(lines) + "\n"
+
+
+def parse_env_file(text: str) -> Dict[str, str]:
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            key, value = line.split("=", 1)
+            values[key] = value[1:-1] if value.startswith('"') and value.endswith('"') else value
+    return values
+
+
+def generate() -> None:
+    baseline, changed = resolve()
+    ROS_ENV_PATH.parent.mkdir(parents=True, exist_ok=True)
+    ROS_ENV_PATH.write_text(env_file(changed))
+    ROS_PROFILE_PATH.write_text(profile(baseline, changed))
+    ROS_PROFILE_PATH.chmod(0o755)
+    print(f"Wrote {len(changed)} variables to {ROS_ENV_PATH} and {ROS_PROFILE_PATH}")
+
+
+def check() -> None:
+    baseline, changed = resolve()
+    problems = []
+    from_env_file = parse_env_file(ROS_ENV_PATH.read_text())
+    for key in sorted(set(changed) | set(from_env_file)):
+        if from_env_file.get(key) != changed.get(key):
+            problems.append(f"{ROS_ENV_PATH}: {key}={from_env_file.get(key)!r}, sourcing gives {changed.get(key)!r}")
+    from_profile = shell_environment(f". {ROS_PROFILE_PATH}")
+    expected = {**baseline, **changed}
+    for key in sorted(set(expected) | set(from_profile)):
+        if from_profile.get(key) != expected.get(key):
+            problems.append(f"{ROS_PROFILE_PATH}: {key}={from_profile.get(key)!r}, "
+                            f"sourcing gives {expected.get(key)!r}")
+    if problems:
+        print("Precomputed ROS environment differs from sourcing the setup chain:", file=sys.stderr)
+        for problem in problems:
+            print(f"  {problem}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Precomputed ROS environment matches {ROS_SETUP_PATH} ({len(changed)} variables)")
+
+
+if __name__ == "__main__":
+    commands = {"generate": generate, "check": check}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        raise SystemExit(f"Usage: {sys.argv[0]} generate|check")
+    commands[sys.argv[1]]()
@@ -4,7 +4,12 @@ set -eux -o pipefail
 echo -e "\e[1;32mUpdating Packages\e[0m"
 apt-get -y update
 apt-get -y auto-remove
-apt-get -y install git curl ssh nano ffmpeg openssh-server locales pip software-properties-common
 
-apt-get -y install meson ninja-build
+_BASE_PKGS="git curl ssh nano ffmpeg openssh-server locales pip software-properties-common"
+apt-get -y install ${_BASE_PKGS}
+unset _BASE_PKGS
+
+_BUILD_PKGS="meson ninja-build"
+apt-get -y install ${_BUILD_PKGS}
+unset _BUILD_PKGS
 
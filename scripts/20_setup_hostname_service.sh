@@ -1,7 +1,7 @@
 #!/bin/bash
 set -eux -o pipefail
 
-echo -e "\e[1;32mInstalling hostname service\e[0m"
+echo -e "\e[1;32mInstalling first-boot setup service\e[0m"
 
 USERNAME="${USERNAME:-robot}"
 
@@ -9,4 +9,6 @@ touch /home/$USERNAME/.setup_hostname
 
 chmod +x /home/$USERNAME/setup_scripts/setup_hostname.sh
 
-systemctl enable hostname_setup.service
+# firstboot.py runs every armed setup_*.sh task, in two stages around network.target;
+# later scripts only add their markers
+systemctl enable firstboot-network.service firstboot.service
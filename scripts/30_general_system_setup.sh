@@ -16,6 +16,5 @@ echo "    PasswordAuthentication yes" | tee -a /etc/ssh/sshd_config.d/10-passwor
 
 touch /home/$USERNAME/.setup_firewall
 chmod +x /home/$USERNAME/setup_scripts/setup_firewall.sh
-systemctl enable firewall_setup.service
 
 sed -i 's/^XKBLAYOUT=".*"/XKBLAYOUT="gb"/' /etc/default/keyboard
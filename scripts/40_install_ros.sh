@@ -21,7 +21,7 @@ apt-get -y install --allow-downgrades \
   libdrm2=2.4.120-2build1 \
   libunwind8=1.6.2-3build1
 
-_ROS_PKGS="ros-${ROS_DISTRO}-ros-base ros-dev-tools ros-${ROS_DISTRO}-xacro ros-${ROS_DISTRO}-image-transport-plugins"
+_ROS_PKGS="ros-${ROS_DISTRO}-ros-base ros-dev-tools ros-${ROS_DISTRO}-xacro ros-${ROS_DISTRO}-image-transport-plugins ros-${ROS_DISTRO}-rmw-cyclonedds-cpp"
 apt-get --simulate install ${_ROS_PKGS} > /dev/null 2>&1
 apt-get -y install ${_ROS_PKGS}
 unset _ROS_PKGS
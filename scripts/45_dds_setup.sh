@@ -0,0 +1,55 @@
+#!/bin/bash
+set -eux -o pipefail
+
+# Installs the DDS middleware profile generated by build.py from the [dds]
+# section and exports the variables that select it. The exports go into the
+# ROS sourcing chain between markers, so the precomputed ROS environment
+# (75_ros_environment.sh, or 85_apply_overlay.sh on a base image) picks them up.
+
+USERNAME="${USERNAME:-robot}"
+# Before 75_ros_environment.sh the chain is still the profile.d script itself
+if [[ -f /etc/turtlebot3/ros-setup.bash ]]; then
+  ROS_SETUP=/etc/turtlebot3/ros-setup.bash
+else
+  ROS_SETUP=/etc/profile.d/90-turtlebot-ros-profile.sh
+fi
+SYSCTL=/etc/sysctl.d/60-turtlebot3-dds.conf
+
+touch "$ROS_SETUP"
+sed -i '/^# BEGIN dds$/,/^# END dds$/d' "$ROS_SETUP"
+rm -rf /etc/turtlebot3/dds "$SYSCTL"
+
+if [[ "${DDS_CONFIG:-}" == "" ]] || [[ "$DDS_CONFIG" == "{}" ]]; then
+  echo -e "\e[1;32mUsing the default DDS middleware settings\e[0m"
+  exit 0
+fi
+
+echo -e "\e[1;32mInstalling the DDS middleware profile\e[0m"
+
+python3 - "$ROS_SETUP" "$SYSCTL" << 'PYTHON_SCRIPT'
+import json
+import os
+import sys
+from pathlib import Path
+
+ros_setup, sysctl = sys.argv[1:]
+config = json.loads(os.environ["DDS_CONFIG"])
+
+profile = Path(config["path"])
+profile.parent.mkdir(parents=True, exist_ok=True)
+profile.write_text(config["profile"])
+profile.chmod(0o644)
+
+with open(ros_setup, "a") as f:
+    f.write("# BEGIN dds\n")
+    for key, value in config["environment"].items():
+        f.write(f"export {key}={value}\n")
+    f.write("# END dds\n")
+
+# The kernel caps the socket buffers a participant can request
+if config["socket_buffer_size"]:
+    size = config["socket_buffer_size"]
+    Path(sysctl).write_text(f"net.core.rmem_max = {size}\nnet.core.wmem_max = {size}\n")
+PYTHON_SCRIPT
+
+cat "$ROS_SETUP"
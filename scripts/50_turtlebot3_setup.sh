@@ -8,14 +8,28 @@ ROS_DISTRO="${ROS_DISTRO:-humble}"
 
 echo -e "\e[1;32mTurtleBot3 setup\e[0m"
 
+# Clone from the host-side mirror in /var/cache/tb3-git when the build provides one
+tb3_clone() {
+  local ref="$1" url="$2"
+  local name mirror
+  name="$(basename "$url" .git)"
+  mirror="/var/cache/tb3-git/$(basename "$(dirname "$url")")_${name}.git"
+  if [[ -d "$mirror" ]]; then
+    git -c safe.directory="*" clone --depth 1 -b "$ref" "file://$mirror" "$name"
+    git -C "$name" remote set-url origin "$url"
+  else
+    git clone -b "$ref" "$url" "$name"
+  fi
+}
+
 _TB3_PKGS="python3-argcomplete python3-colcon-common-extensions libboost-system-dev build-essential ros-${ROS_DISTRO}-hls-lfcd-lds-driver ros-${ROS_DISTRO}-turtlebot3-msgs ros-${ROS_DISTRO}-dynamixel-sdk libudev-dev"
 apt-get --simulate install ${_TB3_PKGS} > /dev/null 2>&1
 apt-get -y install ${_TB3_PKGS}
 unset _TB3_PKGS
 mkdir -p "/home/$USERNAME/turtlebot3_ws/src" && cd "/home/$USERNAME/turtlebot3_ws/src"
-git clone -b ${ROS_DISTRO} https://github.com/ROBOTIS-GIT/turtlebot3.git
-git clone -b ${ROS_DISTRO} https://github.com/ROBOTIS-GIT/ld08_driver.git
-git clone -b ${ROS_DISTRO} https://github.com/ROBOTIS-GIT/coin_d4_driver
+tb3_clone ${ROS_DISTRO} https://github.com/ROBOTIS-GIT/turtlebot3.git
+tb3_clone ${ROS_DISTRO} https://github.com/ROBOTIS-GIT/ld08_driver.git
+tb3_clone ${ROS_DISTRO} https://github.com/ROBOTIS-GIT/coin_d4_driver
 cd "/home/$USERNAME/turtlebot3_ws/src/turtlebot3"
 rm -r turtlebot3_cartographer turtlebot3_navigation2
 cd "/home/$USERNAME/turtlebot3_ws/"
@@ -23,7 +37,26 @@ echo "source /opt/ros/${ROS_DISTRO}/setup.bash" | tee -a /etc/profile.d/90-turtl
 set +u
 source /etc/profile.d/90-turtlebot-ros-profile.sh
 set -u
-colcon build --symlink-install --parallel-workers 1
+if [[ -n "${COLCON_ARTIFACT:-}" ]] && [[ -f "$COLCON_ARTIFACT" ]]; then
+  echo "Using prebuilt workspace from $COLCON_ARTIFACT"
+  tar -xf "$COLCON_ARTIFACT" -C "/home/$USERNAME/turtlebot3_ws"
+else
+  _COLCON_ARGS=""
+  if [[ -n "${CCACHE_DIR:-}" ]]; then
+    _CCACHE_PKGS="ccache"
+    apt-get -y install ${_CCACHE_PKGS}
+    unset _CCACHE_PKGS
+    _COLCON_ARGS="--cmake-args -DCMAKE_C_COMPILER_LAUNCHER=ccache -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
+  fi
+  # One compiler process per package, so BUILD_JOBS bounds the total
+  MAKEFLAGS="-j1" colcon build --symlink-install --parallel-workers "${BUILD_JOBS:-1}" ${_COLCON_ARGS}
+  unset _COLCON_ARGS
+  if [[ -n "${COLCON_ARTIFACT:-}" ]]; then
+    # --symlink-install links install/ into build/ and src/, so both trees are kept
+    tar -cf "$COLCON_ARTIFACT.tmp" -C "/home/$USERNAME/turtlebot3_ws" build install
+    mv "$COLCON_ARTIFACT.tmp" "$COLCON_ARTIFACT"
+  fi
+fi
 echo "source /home/$USERNAME/turtlebot3_ws/install/setup.bash" | tee -a /etc/profile.d/90-turtlebot-ros-profile.sh > /dev/null
 set +u
 source /etc/profile.d/90-turtlebot-ros-profile.sh
@@ -19,5 +19,3 @@ tar -xvf ./opencr_update.tar.bz2
 touch /home/$USERNAME/.setup_opencr
 
 chmod +x /home/$USERNAME/setup_scripts/setup_opencr.sh
-
-systemctl enable opencr_setup.service
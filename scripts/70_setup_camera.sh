@@ -3,6 +3,20 @@ set -eux -o pipefail
 
 echo -e "\e[1;32mCamera setup\e[0m"
 
+# Clone from the host-side mirror in /var/cache/tb3-git when the build provides one
+tb3_clone() {
+  local ref="$1" url="$2"
+  local name mirror
+  name="$(basename "$url" .git)"
+  mirror="/var/cache/tb3-git/$(basename "$(dirname "$url")")_${name}.git"
+  if [[ -d "$mirror" ]]; then
+    git -c safe.directory="*" clone --depth 1 -b "$ref" "file://$mirror" "$name"
+    git -C "$name" remote set-url origin "$url"
+  else
+    git clone -b "$ref" "$url" "$name"
+  fi
+}
+
 USERNAME="${USERNAME:-robot}"
 ROS_DISTRO="${ROS_DISTRO:-humble}"
 
@@ -16,17 +30,34 @@ apt-get --simulate install ${_CAM_PKGS} > /dev/null 2>&1
 apt-get install -y ${_CAM_PKGS}
 unset _CAM_PKGS
 
-apt-get --simulate install ros-${ROS_DISTRO}-camera-ros > /dev/null 2>&1
-apt-get install -y ros-${ROS_DISTRO}-camera-ros
+_CAM_ROS_PKGS="ros-${ROS_DISTRO}-camera-ros"
+apt-get --simulate install ${_CAM_ROS_PKGS} > /dev/null 2>&1
+apt-get install -y ${_CAM_ROS_PKGS}
+unset _CAM_ROS_PKGS
 
 mkdir -p /home/$USERNAME/turtlebot3_ws/src && cd /home/$USERNAME/turtlebot3_ws/src
-git clone -b v0.5.2 https://github.com/raspberrypi/libcamera.git
+tb3_clone v0.5.2 https://github.com/raspberrypi/libcamera.git
 cd libcamera
-meson setup build --buildtype=release -Dpipelines=rpi/vc4,rpi/pisp -Dipas=rpi/vc4,rpi/pisp -Dv4l2=true -Dgstreamer=enabled -Dtest=false -Dlc-compliance=disabled -Dcam=disabled -Dqcam=disabled -Ddocumentation=disabled -Dpycamera=enabled
-# ninja -C build -j 1
-# ninja -C build install -j 1
-ninja -C build
-ninja -C build install
+if [[ -n "${LIBCAMERA_ARTIFACT:-}" ]] && [[ -f "$LIBCAMERA_ARTIFACT" ]]; then
+  echo "Using prebuilt libcamera from $LIBCAMERA_ARTIFACT"
+  tar -xf "$LIBCAMERA_ARTIFACT" -C /
+else
+  if [[ -n "${CCACHE_DIR:-}" ]]; then
+    # meson picks up ccache automatically once it is installed
+    _CCACHE_PKGS="ccache"
+    apt-get install -y ${_CCACHE_PKGS}
+    unset _CCACHE_PKGS
+  fi
+  meson setup build --buildtype=release -Dpipelines=rpi/vc4,rpi/pisp -Dipas=rpi/vc4,rpi/pisp -Dv4l2=true -Dgstreamer=enabled -Dtest=false -Dlc-compliance=disabled -Dcam=disabled -Dqcam=disabled -Ddocumentation=disabled -Dpycamera=enabled
+  ninja -C build -j "${BUILD_JOBS:-1}"
+  if [[ -n "${LIBCAMERA_ARTIFACT:-}" ]]; then
+    DESTDIR=/tmp/libcamera-stage ninja -C build install -j "${BUILD_JOBS:-1}"
+    tar -cf "$LIBCAMERA_ARTIFACT.tmp" -C /tmp/libcamera-stage .
+    mv "$LIBCAMERA_ARTIFACT.tmp" "$LIBCAMERA_ARTIFACT"
+    rm -rf /tmp/libcamera-stage
+  fi
+  ninja -C build install -j "${BUILD_JOBS:-1}"
+fi
 ldconfig
 
 echo 'export LD_LIBRARY_PATH=/usr/local/lib/aarch64-linux-gnu:$LD_LIBRARY_PATH' | tee -a /etc/profile.d/92-libcamera.sh
@@ -35,8 +66,6 @@ touch /home/$USERNAME/.setup_camera
 
 chmod +x /home/$USERNAME/setup_scripts/setup_camera.sh
 
-systemctl enable camera_setup.service
-
 
 
 
@@ -0,0 +1,20 @@
+#!/bin/bash
+set -eux -o pipefail
+
+# Resolves the ROS sourcing chain once, so bringup.service and login shells
+# read a flat environment instead of sourcing every setup.bash on each start.
+
+echo -e "\e[1;32mPrecomputing the ROS environment\e[0m"
+
+USERNAME="${USERNAME:-robot}"
+PROFILE=/etc/profile.d/90-turtlebot-ros-profile.sh
+
+# 40 and 50 build the chain up in the profile; keep each line once and move the aliases aside
+mkdir -p /etc/turtlebot3
+grep -v '^alias ' "$PROFILE" | awk '!seen[$0]++' > /etc/turtlebot3/ros-setup.bash
+grep '^alias ' "$PROFILE" > /etc/turtlebot3/ros-aliases.sh || true
+chmod 644 /etc/turtlebot3/ros-setup.bash /etc/turtlebot3/ros-aliases.sh
+
+python3 "/home/$USERNAME/setup_scripts/ros_env.py" generate
+# Fails the build if the precomputed files drift from sourcing the chain
+python3 "/home/$USERNAME/setup_scripts/ros_env.py" check
@@ -0,0 +1,25 @@
+#!/bin/bash
+set -eux -o pipefail
+
+# Applies the robot-specific settings on top of a cached base image.
+# The base image is built with default values for these settings.
+
+USERNAME="${USERNAME:-robot}"
+ROS_SETUP=/etc/turtlebot3/ros-setup.bash
+
+echo -e "\e[1;32mApplying robot configuration\e[0m"
+
+echo "${USERNAME}:${USER_PASSWORD}" | chpasswd
+
+sed -i "s|^export ROS_DOMAIN_ID=.*|export ROS_DOMAIN_ID=${ROS_DOMAIN_ID:-0}|" "$ROS_SETUP"
+sed -i "s|^export LDS_MODEL=.*|export LDS_MODEL=${LIDAR:-LDS-02}|" "$ROS_SETUP"
+python3 "/home/$USERNAME/setup_scripts/ros_env.py" generate
+python3 "/home/$USERNAME/setup_scripts/ros_env.py" check
+
+# Write network configuration if networks are provided
+if [[ "$ADD_CONNECTION" == "true" ]] && [[ -n "${NETWORKS:-}" ]]; then
+    echo "Writing network configuration..."
+    mkdir -p /home/$USERNAME/.config
+    echo "$NETWORKS" > /home/$USERNAME/.config/networks.json
+    chown -R $USERNAME:$USERNAME /home/$USERNAME/.config
+fi
@@ -0,0 +1,57 @@
+#!/bin/bash
+set -eux -o pipefail
+
+# Removes build-only files from the root filesystem. The blocks they free are
+# deallocated from the image on the host afterwards (slim_image in build.py).
+
+if [[ "${SLIM_IMAGE:-false}" != "true" ]]; then
+  echo "Image slimming disabled"
+  exit 0
+fi
+
+echo -e "\e[1;32mRemoving build-only files\e[0m"
+
+USERNAME="${USERNAME:-robot}"
+WS="/home/$USERNAME/turtlebot3_ws"
+
+# --symlink-install links install/ into build/, so copy those files in before build/ is removed.
+# Only the link's own target matters: a hop into build/ breaks even if the chain ends in src/.
+KEEP_WS_BUILD=false
+if [[ -d "$WS/install" ]] && [[ -d "$WS/build" ]]; then
+  find "$WS/install" -type l -print0 | while IFS= read -r -d '' link; do
+    target="$(readlink "$link")"
+    if [[ "$target" != /* ]]; then
+      target="$(realpath -s -m "$(dirname "$link")/$target")"
+    fi
+    if [[ "$target" == "$WS/build/"* ]] && [[ -e "$target" ]]; then
+      rm "$link"
+      cp -a "$target" "$link"
+    fi
+  done
+  # ament_python packages are installed as .egg-link and easy-install.pth files naming build/,
+  # which cannot be copied in, so build/ stays when any exist
+  if grep -rlsF "$WS/build/" --include='*.egg-link' --include='*.pth' "$WS/install" > /dev/null; then
+    KEEP_WS_BUILD=true
+  fi
+fi
+
+for pattern in ${SLIM_PATHS:-}; do
+  pattern="${pattern/#\~//home/$USERNAME}"
+  # Unquoted so globs such as /var/lib/apt/lists/* expand
+  for path in $pattern; do
+    if [[ "$path" != /* ]] || [[ "$path" == "/" ]]; then
+      echo "Skipping unsafe slim path: $path"
+      continue
+    fi
+    if [[ "$KEEP_WS_BUILD" == "true" ]] && [[ "$path/" == "$WS/build/"* ]]; then
+      echo "Keeping $path: Python packages in $WS/install are linked into it"
+      continue
+    fi
+    rm -rf --one-file-system -- "$path"
+  done
+done
+
+# The archive directory is a host bind mount when the APT cache is enabled
+if ! mountpoint -q /var/cache/apt/archives; then
+  apt-get clean
+fi
@@ -0,0 +1,132 @@
+"""
+Tests for build.prefetch_apt_packages against a file:// repository.
+
+The repository holds a Packages index and dummy .deb files. The packages
+requested by a provisioner script's _*_PKGS list pull in a dependency
+chain with a version constraint, alternatives, a virtual package and a
+required-priority package that the Ubuntu image already has.
+
+Usage:
+    python -m pytest tests/test_apt_cache.py
+"""
+
+import gzip
+import hashlib
+import json
+import sys
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+# name: (version, priority, depends, provides)
+PACKAGES = {
+    "app": ("1.0-1", "optional", "libfoo (>= 2.0), libc6", ""),
+    "libfoo": ("2.1-1", "optional", "libbar | libalt, python3-any", ""),
+    "libbar": ("0.5-2", "optional", "", ""),
+    "libalt": ("1.0-1", "optional", "", ""),
+    "python3-minimal": ("3.10.6-1", "optional", "", "python3-any"),
+    "ros-humble-tool": ("0.3.0-1jammy", "optional", "libbar", ""),
+    "libc6": ("2.35-0ubuntu3", "required", "", ""),
+    "unrelated": ("9.9-1", "optional", "", ""),
+}
+EXPECTED = {"app", "libfoo", "libbar", "python3-minimal", "ros-humble-tool"}
+
+
+def make_repository(root: Path) -> str:
+    """Write the packages and a gzipped Packages index; returns the sources.list line."""
+    stanzas = []
+    for name, (version, priority, depends, provides) in PACKAGES.items():
+        filename = f"pool/main/{name[0]}/{name}/{name}_{version}_arm64.deb"
+        deb = root / filename
+        deb.parent.mkdir(parents=True, exist_ok=True)
+        deb.write_bytes(f"dummy package {name} {version}\n".encode() * 10)
+        data = deb.read_bytes()
+        lines = [f"Package: {name}", f"Version: {version}", "Architecture: arm64", f"Priority: {priority}"]
+        if depends:
+            lines.append(f"Depends: {depends}")
+        if provides:
+            lines.append(f"Provides: {provides}")
+        lines += [f"Filename: {filename}", f"Size: {len(data)}", f"SHA256: {hashlib.sha256(data).hexdigest()}"]
+        stanzas.append("\n".join(lines))
+    index = root / "dists" / "jammy" / "main" / "binary-arm64" / "Packages.gz"
+    index.parent.mkdir(parents=True)
+    index.write_bytes(gzip.compress(("\n\n".join(stanzas) + "\n").encode()))
+    return f"{root.as_uri()} jammy main"
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    repository = make_repository(tmp_path / "repo")
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+    script = workdir / "50_install.sh"
+    script.write_text('#!/bin/bash\n_TEST_PKGS="app ros-${ROS_DISTRO}-tool"\napt-get install -y ${_TEST_PKGS}\n')
+    packer_file = workdir / "packer.json"
+    packer_file.write_text(json.dumps({"provisioners": [{"type": "shell", "scripts": [str(script)]}]}))
+    cfg = build.BuildConfig(ros_distro="humble", apt_cache=True, apt_repositories=[repository])
+    build.compute_derived_values(cfg)
+    return cfg, str(packer_file)
+
+
+def count_deb_fetches(monkeypatch) -> list:
+    fetched = []
+    urlopen = urllib.request.urlopen
+
+    def counting_urlopen(url, *args, **kwargs):
+        if str(url).endswith(".deb"):
+            fetched.append(url)
+        return urlopen(url, *args, **kwargs)
+
+    monkeypatch.setattr(urllib.request, "urlopen", counting_urlopen)
+    return fetched
+
+
+def archive_names() -> set:
+    return {path.name for path in Path(build.APT_ARCHIVE_DIR).glob("*.deb")}
+
+
+def test_dependency_closure_is_cached(setup, monkeypatch):
+    cfg, packer_file = setup
+    fetched = count_deb_fetches(monkeypatch)
+
+    build.prefetch_apt_packages(cfg, packer_file)
+
+    expected = {f"{name}_{PACKAGES[name][0]}_arm64.deb" for name in EXPECTED}
+    assert archive_names() == expected
+    assert len(fetched) == len(EXPECTED)
+    for name in EXPECTED:
+        version = PACKAGES[name][0]
+        cached = Path(build.APT_ARCHIVE_DIR) / f"{name}_{version}_arm64.deb"
+        assert cached.read_bytes() == f"dummy package {name} {version}\n".encode() * 10
+
+
+def test_second_run_downloads_nothing(setup, monkeypatch, capsys):
+    cfg, packer_file = setup
+    build.prefetch_apt_packages(cfg, packer_file)
+    before = {path.name: path.stat().st_mtime_ns for path in Path(build.APT_ARCHIVE_DIR).glob("*.deb")}
+    fetched = count_deb_fetches(monkeypatch)
+    capsys.readouterr()
+
+    build.prefetch_apt_packages(cfg, packer_file)
+
+    assert fetched == []
+    assert f"{len(EXPECTED)} packages, 0 downloaded, {len(EXPECTED)} already cached" in capsys.readouterr().out
+    assert {path.name: path.stat().st_mtime_ns for path in Path(build.APT_ARCHIVE_DIR).glob("*.deb")} == before
+
+
+def test_corrupt_package_is_not_cached(setup, monkeypatch, tmp_path):
+    cfg, packer_file = setup
+    deb = next((tmp_path / "repo" / "pool").glob("**/libbar_*.deb"))
+    deb.write_bytes(b"tampered")
+
+    build.prefetch_apt_packages(cfg, packer_file)
+
+    names = archive_names()
+    assert not any(name.startswith("libbar_") for name in names)
+    assert len(names) == len(EXPECTED) - 1
@@ -0,0 +1,167 @@
+"""
+Tests for the bmap written by build.generate_bmap and build.stream_image.
+
+The fixtures are sparse files made with truncate plus pwrite at known
+offsets. Expected block ranges and digests are worked out from those
+offsets and the file bytes, not from build.py.
+
+Usage:
+    python -m pytest tests/test_bmap.py
+"""
+
+import hashlib
+import os
+import sys
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+from typing import List, Set, Tuple
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+BLOCK = 4096
+MIB = 1024 * 1024
+
+
+def make_sparse(path: Path, size: int, writes: List[Tuple[int, bytes]]) -> Path:
+    """Create a sparse file of ``size`` bytes with ``data`` written at each offset."""
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset, data in writes:
+            os.pwrite(f.fileno(), data, offset)
+    return path
+
+
+def pattern(length: int, seed: int) -> bytes:
+    """Non-zero bytes, so no block of written data is all zeros."""
+    return bytes((i * 7 + seed) % 255 + 1 for i in range(256)) * (length // 256) + b"\x01" * (length % 256)
+
+
+def digest(path: Path, first: int, last: int) -> str:
+    size = path.stat().st_size
+    with open(path, "rb") as f:
+        f.seek(first * BLOCK)
+        return hashlib.sha256(f.read(min((last + 1) * BLOCK, size) - first * BLOCK)).hexdigest()
+
+
+def parse(bmap_path: Path) -> dict:
+    text = bmap_path.read_text()
+    root = ElementTree.fromstring(text)
+    ranges = []
+    for element in root.find("BlockMap"):
+        first, _, last = element.text.strip().partition("-")
+        ranges.append((int(first), int(last or first), element.get("chksum")))
+    return {
+        "text": text,
+        "image_size": int(root.findtext("ImageSize")),
+        "blocks_count": int(root.findtext("BlocksCount")),
+        "mapped_count": int(root.findtext("MappedBlocksCount")),
+        "checksum": root.findtext("BmapFileChecksum").strip(),
+        "ranges": ranges,
+    }
+
+
+def blocks(ranges) -> Set[int]:
+    return {block for first, last, *_ in ranges for block in range(first, last + 1)}
+
+
+@pytest.fixture(autouse=True)
+def require_hole_support(tmp_path):
+    """Skip on filesystems that report sparse files as fully allocated."""
+    probe = make_sparse(tmp_path / "probe", 16 * MIB, [(8 * MIB, b"x")])
+    with open(probe, "rb") as f:
+        if build.data_extents(f.fileno(), 16 * MIB) != [(8 * MIB, 8 * MIB + BLOCK)]:
+            pytest.skip("filesystem does not report holes at block granularity")
+
+
+def test_file_without_data(tmp_path):
+    image = make_sparse(tmp_path / "empty.img", 10 * MIB + 100, [])
+    bmap = tmp_path / "empty.img.bmap"
+
+    size, mapped = build.generate_bmap(image, bmap)
+
+    result = parse(bmap)
+    assert (size, mapped) == (10 * MIB + 100, 0)
+    assert result["image_size"] == 10 * MIB + 100
+    assert result["blocks_count"] == 2561  # 2560 full blocks plus a 100-byte tail
+    assert result["mapped_count"] == 0
+    assert result["ranges"] == []
+
+
+def test_unaligned_extents(tmp_path):
+    size = 40 * MIB + 123
+    image = make_sparse(tmp_path / "unaligned.img", size, [
+        (3 * BLOCK + 500, pattern(100, 1)),           # inside block 3
+        (10 * BLOCK + 2000, pattern(6000, 2)),        # blocks 10-11
+        (5000 * BLOCK - 10, pattern(20, 3)),          # straddles blocks 4999-5000
+        (size - 50, pattern(50, 4)),                  # partial last block 10240
+    ])
+    bmap = tmp_path / "unaligned.img.bmap"
+
+    size_out, mapped = build.generate_bmap(image, bmap)
+
+    expected = [(3, 3), (10, 11), (4999, 5000), (10240, 10240)]
+    result = parse(bmap)
+    assert size_out == size
+    assert [(first, last) for first, last, _ in result["ranges"]] == expected
+    assert result["mapped_count"] == 6
+    assert mapped == 5 * BLOCK + 123  # the last block is only 123 bytes long
+    for first, last, chksum in result["ranges"]:
+        assert chksum == digest(image, first, last)
+
+
+def test_long_extent_is_split(tmp_path):
+    start_block = 1000
+    length = 70 * MIB
+    image = make_sparse(tmp_path / "long.img", 128 * MIB, [(start_block * BLOCK, pattern(length, 5))])
+    bmap = tmp_path / "long.img.bmap"
+
+    build.generate_bmap(image, bmap)
+
+    per_range = 64 * MIB // BLOCK  # 16384 blocks
+    last_block = start_block + length // BLOCK - 1
+    expected = [(start_block, start_block + per_range - 1), (start_block + per_range, last_block)]
+    result = parse(bmap)
+    assert [(first, last) for first, last, _ in result["ranges"]] == expected
+    assert result["mapped_count"] == length // BLOCK
+    for first, last, chksum in result["ranges"]:
+        assert chksum == digest(image, first, last)
+
+
+def test_bmap_file_checksum(tmp_path):
+    image = make_sparse(tmp_path / "checksum.img", 8 * MIB, [(BLOCK, pattern(BLOCK, 6))])
+    bmap = tmp_path / "checksum.img.bmap"
+
+    build.generate_bmap(image, bmap)
+
+    result = parse(bmap)
+    # bmaptool computes the checksum over the file with the checksum field zeroed
+    zeroed = result["text"].replace(result["checksum"], "0" * 64, 1)
+    assert result["checksum"] == hashlib.sha256(zeroed.encode()).hexdigest()
+
+
+def test_generate_bmap_matches_stream_image(tmp_path):
+    size = 100 * MIB + 4000
+    image = make_sparse(tmp_path / "stream.img", size, [
+        (7 * BLOCK + 1, pattern(300, 7)),
+        (2 * MIB, pattern(66 * MIB, 8)),
+        (size - 10, pattern(10, 9)),
+    ])
+    generated = tmp_path / "generated.bmap"
+    streamed = tmp_path / "streamed.bmap"
+
+    build.generate_bmap(image, generated)
+    result = build.stream_image(image, sparsify=True)
+    build.write_bmap(streamed, result.image_size, result.ranges)
+
+    from_generate, from_stream = parse(generated), parse(streamed)
+    assert from_generate["image_size"] == from_stream["image_size"] == size
+    assert from_generate["mapped_count"] == from_stream["mapped_count"]
+    # generate_bmap splits long extents, so compare the mapped blocks rather than the range lists
+    assert blocks(from_generate["ranges"]) == blocks(from_stream["ranges"])
+    for result in (from_generate, from_stream):
+        for first, last, chksum in result["ranges"]:
+            assert chksum == digest(image, first, last)
@@ -0,0 +1,183 @@
+"""
+Tests for the DDS middleware profiles generated from the [dds] section.
+
+Each mode is checked against the element paths Cyclone DDS and Fast DDS
+read, not against check_dds_profile, so a profile that is consistent with
+itself but uses the wrong elements fails here.
+
+Usage:
+    python -m pytest tests/test_dds.py
+"""
+
+import sys
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+CYCLONE = {"c": "https://cdds.io/config"}
+FASTDDS = {"f": "http://www.eprosima.com/XMLSchemas/fastRTPS_Profiles"}
+
+
+def config(middleware: str, **dds) -> build.BuildConfig:
+    cfg = build.BuildConfig(dds_middleware=middleware, **{f"dds_{key}": value for key, value in dds.items()})
+    build.validate_config(cfg)
+    return cfg
+
+
+def cyclone(cfg: build.BuildConfig) -> ElementTree.Element:
+    name, profile = build.dds_profile(cfg)
+    assert name == "cyclonedds.xml"
+    root = ElementTree.fromstring(profile)
+    assert root.tag == "{https://cdds.io/config}CycloneDDS"
+    return root.find("c:Domain", CYCLONE)
+
+
+def fastdds(cfg: build.BuildConfig) -> ElementTree.Element:
+    name, profile = build.dds_profile(cfg)
+    assert name == "fastdds.xml"
+    root = ElementTree.fromstring(profile)
+    assert root.tag == "{http://www.eprosima.com/XMLSchemas/fastRTPS_Profiles}profiles"
+    return root
+
+
+def fastdds_rtps(root: ElementTree.Element) -> ElementTree.Element:
+    (participant,) = root.findall("f:participant[@is_default_profile='true']", FASTDDS)
+    return participant.find("f:rtps", FASTDDS)
+
+
+def test_cyclonedds_peers():
+    domain = cyclone(config("cyclonedds", peers=["10.0.0.2", "robot2.local"]))
+
+    assert domain.get("Id") == "any"
+    peers = domain.findall("c:Discovery/c:Peers/c:Peer", CYCLONE)
+    assert [peer.get("address") for peer in peers] == ["10.0.0.2", "robot2.local"]
+    assert domain.findtext("c:General/c:AllowMulticast", namespaces=CYCLONE) == "default"
+
+
+def test_cyclonedds_multicast_off():
+    domain = cyclone(config("cyclonedds", peers=["10.0.0.2"], multicast=False))
+
+    assert domain.findtext("c:General/c:AllowMulticast", namespaces=CYCLONE) == "false"
+
+
+def test_cyclonedds_participant_limit():
+    domain = cyclone(config("cyclonedds", max_participants=8))
+
+    # Indices run from 0, so 8 participants use indices 0-7
+    assert domain.findtext("c:Discovery/c:ParticipantIndex", namespaces=CYCLONE) == "auto"
+    assert domain.findtext("c:Discovery/c:MaxAutoParticipantIndex", namespaces=CYCLONE) == "7"
+
+
+def test_cyclonedds_socket_buffers():
+    domain = cyclone(config("cyclonedds", socket_buffer_size="4M"))
+
+    assert domain.find("c:Internal/c:SocketReceiveBufferSize", CYCLONE).get("min") == "4194304B"
+    assert domain.find("c:Internal/c:SocketSendBufferSize", CYCLONE).get("min") == "4194304B"
+
+
+def test_cyclonedds_defaults_add_nothing():
+    domain = cyclone(config("cyclonedds"))
+
+    assert domain.find("c:Discovery/c:Peers", CYCLONE) is None
+    assert domain.find("c:Discovery/c:MaxAutoParticipantIndex", CYCLONE) is None
+    assert domain.find("c:Internal", CYCLONE) is None
+
+
+def test_fastdds_peers():
+    rtps = fastdds_rtps(fastdds(config("fastdds", peers=["10.0.0.2", "10.0.0.3"])))
+
+    addresses = rtps.findall("f:builtin/f:initialPeersList/f:locator/f:udpv4/f:address", FASTDDS)
+    assert [address.text for address in addresses] == ["10.0.0.2", "10.0.0.3"]
+    assert rtps.find("f:builtin/f:discovery_config", FASTDDS) is None
+
+
+@pytest.mark.parametrize("server, address, port", [
+    ("10.0.0.1", "10.0.0.1", 11811),
+    ("base.local:12000", "base.local", 12000),
+])
+def test_fastdds_discovery_server(server, address, port):
+    rtps = fastdds_rtps(fastdds(config("fastdds", discovery_server=server)))
+
+    discovery = rtps.find("f:builtin/f:discovery_config", FASTDDS)
+    assert discovery.findtext("f:discoveryProtocol", namespaces=FASTDDS) == "CLIENT"
+    (remote,) = discovery.findall("f:discoveryServersList/f:RemoteServer", FASTDDS)
+    assert remote.get("prefix") == "44.53.00.5f.45.50.52.4f.53.49.4d.41"
+    (locator,) = remote.findall("f:metatrafficUnicastLocatorList/f:locator/f:udpv4", FASTDDS)
+    assert locator.findtext("f:address", namespaces=FASTDDS) == address
+    assert locator.findtext("f:port", namespaces=FASTDDS) == str(port)
+
+
+def test_fastdds_discovery_server_is_not_an_environment_variable():
+    setup = build.dds_setup(config("fastdds", discovery_server="10.0.0.1"))
+
+    assert "ROS_DISCOVERY_SERVER" not in setup["environment"]
+    assert setup["environment"]["RMW_IMPLEMENTATION"] == "rmw_fastrtps_cpp"
+
+
+def test_fastdds_multicast_off():
+    rtps = fastdds_rtps(fastdds(config("fastdds", discovery_server="10.0.0.1", multicast=False)))
+
+    locators = rtps.findall("f:builtin/f:metatrafficUnicastLocatorList/f:locator", FASTDDS)
+    assert len(locators) == 1
+    assert rtps.find("f:builtin/f:metatrafficMulticastLocatorList", FASTDDS) is None
+
+
+def test_fastdds_participant_limit():
+    rtps = fastdds_rtps(fastdds(config("fastdds", max_participants=12)))
+
+    assert rtps.findtext("f:allocation/f:total_participants/f:maximum", namespaces=FASTDDS) == "12"
+
+
+def test_fastdds_socket_buffers_and_shared_memory():
+    root = fastdds(config("fastdds", socket_buffer_size="2M"))
+
+    descriptors = {d.findtext("f:transport_id", namespaces=FASTDDS): d
+                   for d in root.findall("f:transport_descriptors/f:transport_descriptor", FASTDDS)}
+    assert set(descriptors) == {"udp_transport", "shm_transport"}
+    assert descriptors["udp_transport"].findtext("f:sendBufferSize", namespaces=FASTDDS) == "2097152"
+    assert descriptors["udp_transport"].findtext("f:receiveBufferSize", namespaces=FASTDDS) == "2097152"
+    rtps = fastdds_rtps(root)
+    used = [t.text for t in rtps.findall("f:userTransports/f:transport_id", FASTDDS)]
+    assert used == ["udp_transport", "shm_transport"]
+    assert rtps.findtext("f:useBuiltinTransports", namespaces=FASTDDS) == "false"
+
+
+def test_fastdds_shared_memory_off():
+    root = fastdds(config("fastdds", shared_memory=False))
+
+    ids = [d.findtext("f:transport_id", namespaces=FASTDDS)
+           for d in root.findall("f:transport_descriptors/f:transport_descriptor", FASTDDS)]
+    assert ids == ["udp_transport"]
+    used = [t.text for t in fastdds_rtps(root).findall("f:userTransports/f:transport_id", FASTDDS)]
+    assert used == ["udp_transport"]
+
+
+@pytest.mark.parametrize("middleware, dds, message", [
+    ("cyclonedds", {"discovery_server": "10.0.0.1"}, "only supported with the fastdds middleware"),
+    ("cyclonedds", {"multicast": False}, "needs dds.peers or dds.discovery_server"),
+    ("fastdds", {"multicast": False}, "needs dds.peers or dds.discovery_server"),
+    ("cyclonedds", {"shared_memory": True}, "only supported with the fastdds middleware"),
+    ("fastdds", {"peers": ["10.0.0.2"], "discovery_server": "10.0.0.1"}, "not both"),
+    ("fastdds", {"discovery_server": "10.0.0.1:70000"}, "Must be HOST or HOST:PORT"),
+    ("fastdds", {"peers": ["bad host"]}, "Invalid dds peers"),
+    ("fastdds", {"max_participants": 0}, "Invalid dds max_participants"),
+    ("default", {"peers": ["10.0.0.2"]}, "need a middleware"),
+    ("zenoh", {}, "Invalid dds middleware"),
+])
+def test_validate_config_rejects(middleware, dds, message):
+    with pytest.raises(build.BuildError, match=message):
+        config(middleware, **dds)
+
+
+def test_check_dds_profile_rejects_missing_setting():
+    cfg = config("fastdds", discovery_server="10.0.0.1")
+    _, profile = build.dds_profile(cfg)
+    without_server = profile.replace("<discoveryProtocol>CLIENT</discoveryProtocol>", "")
+
+    with pytest.raises(build.BuildError, match="CLIENT"):
+        build.check_dds_profile(cfg, without_server)
@@ -0,0 +1,165 @@
+"""
+Tests for build.download_file against a local HTTP server.
+
+The stock SimpleHTTPRequestHandler ignores Range, so the server here
+answers Range requests itself. It can also drop chosen ranges part way
+through, or ignore Range to exercise the single-stream fallback.
+Expected digests come from hashlib over the served bytes.
+
+Usage:
+    python -m pytest tests/test_download.py
+"""
+
+import hashlib
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+CHUNK = 64 * 1024
+DATA = os.urandom(5 * CHUNK + 1234)  # six chunks, the last one short
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves ``server.data``, honouring single byte ranges unless ``server.ranged`` is false."""
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        data = server.data
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if not (server.ranged and match):
+            with server.lock:
+                server.requests.append(None)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+        with server.lock:
+            server.requests.append((start, end))
+            drop = server.drops.get((start, end), 0)
+            if drop:
+                server.drops[(start, end)] = drop - 1
+        body = data[start:end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # A dropped range sends half its body and closes the connection
+        self.wfile.write(body[:len(body) // 2] if drop else body)
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.daemon_threads = True
+    httpd.data = DATA
+    httpd.ranged = True
+    httpd.drops = {}
+    httpd.requests = []
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/image.img.xz"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def chunk_range(index: int) -> Tuple[int, int]:
+    return index * CHUNK, min((index + 1) * CHUNK, len(DATA)) - 1
+
+
+def chunk_requests(server) -> List[Tuple[int, int]]:
+    """Range requests for whole chunks, leaving out the 1-byte size probe."""
+    return [r for r in server.requests if r is not None and r != (0, 0)]
+
+
+def test_multi_chunk_download(server, tmp_path):
+    dest = tmp_path / "image.img.xz"
+
+    digest = build.download_file(server.url, dest, connections=3, chunk_size=CHUNK)
+
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    assert dest.read_bytes() == DATA
+    assert sorted(chunk_requests(server)) == [chunk_range(i) for i in range(6)]
+    assert not (tmp_path / "image.img.xz.part").exists()
+    assert not (tmp_path / "image.img.xz.part.json").exists()
+
+
+def test_dropped_connection_is_retried(server, tmp_path):
+    server.drops = {chunk_range(2): 1, chunk_range(5): 2}
+    dest = tmp_path / "image.img.xz"
+
+    digest = build.download_file(server.url, dest, connections=2, chunk_size=CHUNK)
+
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    assert dest.read_bytes() == DATA
+    requests = chunk_requests(server)
+    assert requests.count(chunk_range(2)) == 2
+    assert requests.count(chunk_range(5)) == 3
+    assert all(requests.count(chunk_range(i)) == 1 for i in (0, 1, 3, 4))
+
+
+def test_resume_from_part_and_journal(server, tmp_path):
+    dest = tmp_path / "image.img.xz"
+    part = tmp_path / "image.img.xz.part"
+    journal = tmp_path / "image.img.xz.part.json"
+    # Chunk 4 fails on every attempt, so the first run stops with some chunks journaled
+    server.drops = {chunk_range(4): build.DOWNLOAD_RETRIES}
+
+    with pytest.raises(build.BuildError):
+        build.download_file(server.url, dest, connections=1, chunk_size=CHUNK)
+
+    assert not dest.exists()
+    done = json.loads(journal.read_text())["done"]
+    assert done == [0, 1, 2, 3]
+    assert part.stat().st_size == len(DATA)
+
+    server.requests = []
+    digest = build.download_file(server.url, dest, connections=2, chunk_size=CHUNK)
+
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    assert dest.read_bytes() == DATA
+    assert sorted(chunk_requests(server)) == [chunk_range(4), chunk_range(5)]
+    assert not part.exists() and not journal.exists()
+
+
+def test_journal_for_another_file_is_ignored(server, tmp_path):
+    dest = tmp_path / "image.img.xz"
+    (tmp_path / "image.img.xz.part").write_bytes(b"\xff" * len(DATA))
+    (tmp_path / "image.img.xz.part.json").write_text(json.dumps(
+        {"url": server.url + "?old", "size": len(DATA), "chunk_size": CHUNK, "done": [0, 1, 2]}))
+
+    digest = build.download_file(server.url, dest, connections=2, chunk_size=CHUNK)
+
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    assert dest.read_bytes() == DATA
+    assert len(chunk_requests(server)) == 6
+
+
+def test_plain_200_fallback(server, tmp_path):
+    server.ranged = False
+    dest = tmp_path / "image.img.xz"
+
+    digest = build.download_file(server.url, dest, connections=4, chunk_size=CHUNK)
+
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    assert dest.read_bytes() == DATA
+    # The size probe and one full download, both answered with 200
+    assert server.requests == [None, None]
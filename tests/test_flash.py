@@ -0,0 +1,52 @@
+"""
+Tests for opening the targets of build.py flash.
+
+Regular files stand in for the targets; a target in a missing directory
+fails to open after the ones before it have been opened.
+
+Usage:
+    python -m pytest tests/test_flash.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+SIZE = 3 * 1024 * 1024 + 512
+
+
+def open_fds() -> set:
+    return set(os.listdir("/proc/self/fd"))
+
+
+def test_files_are_sized_to_the_image(tmp_path):
+    existing = tmp_path / "existing.img"
+    existing.write_bytes(b"x" * (2 * SIZE))
+
+    targets = build.prepare_flash_targets([existing, tmp_path / "new.img"], SIZE)
+    for target in targets:
+        os.close(target.fd)
+
+    assert [t.device for t in targets] == [False, False]
+    assert existing.stat().st_size == SIZE
+    assert (tmp_path / "new.img").stat().st_size == SIZE
+
+
+def test_failed_target_leaves_earlier_targets_untouched(tmp_path):
+    existing = tmp_path / "existing.img"
+    existing.write_bytes(b"keep me")
+    created = tmp_path / "created.img"
+    before = open_fds()
+
+    with pytest.raises(FileNotFoundError):
+        build.prepare_flash_targets([existing, created, tmp_path / "missing" / "target.img"], SIZE)
+
+    assert open_fds() == before
+    assert existing.read_bytes() == b"keep me"
+    assert not created.exists()
@@ -0,0 +1,75 @@
+"""
+Tests for the HTTP API of build.py serve with malformed requests.
+
+The server runs without its scheduler, so nothing is built; only the
+handler's answers are checked.
+
+Usage:
+    python -m pytest tests/test_serve.py
+"""
+
+import http.client
+import http.server
+import json
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), build._ServeHandler)
+    httpd.build_server = build.BuildServer("packer.json", 8, 32 * 1024 ** 3, 1024 ** 4)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def request(httpd, method: str, path: str, body: str = None):
+    connection = http.client.HTTPConnection("127.0.0.1", httpd.server_address[1], timeout=10)
+    connection.request(method, path, body=body.encode() if body is not None else None)
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response.status, data
+
+
+@pytest.mark.parametrize("text", [
+    "image = 3\n",
+    "[image]\nsize = 5\n",
+    '[ros]\ndomain_id = "x"\n',
+    "[image\n",
+])
+def test_invalid_config_is_a_400(server, text):
+    status, body = request(server, "POST", "/builds", text)
+
+    assert status == 400
+    assert "error" in json.loads(body)
+    assert server.build_server.jobs == {}
+
+
+def test_valid_config_is_queued(server):
+    status, body = request(server, "POST", "/builds", '[image]\nname = "tb3"\nversion = "v1"\n')
+
+    assert status == 202
+    assert json.loads(body)["status"] == "queued"
+
+
+@pytest.mark.parametrize("offset", ["abc", "-1"])
+def test_invalid_log_offset_is_a_400(server, offset):
+    status, body = request(server, "POST", "/builds", '[image]\nname = "tb3"\nversion = "v1"\n')
+    job_id = json.loads(body)["id"]
+
+    for log in ("log", "output"):
+        status, body = request(server, "GET", f"/builds/{job_id}/{log}?offset={offset}")
+        assert status == 400
+        assert "offset" in json.loads(body)["error"]